@@ -1,7 +1,10 @@
+import csv
 import io
 import os
+import threading
 import xml.etree.ElementTree as ET
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from tkinter import filedialog
 
@@ -13,6 +16,7 @@ from PIL import Image
 from object_detection.utils import dataset_util
 
 import PrintUtils
+from annotation_index import scale_boxes
 
 """
 This is a utils functions class.
@@ -72,6 +76,28 @@ def ask_empty_directory(force=True, **kwargs):
             return dire
     return dire
 
+def ask_resumable_directory(marker, force=True, **kwargs):
+    """
+    Asks the user to select an empty directory, or a directory of a previous run to resume.
+
+    :param marker: The name of the file that marks a directory of a previous run
+    :param force: Force the user to choose a valid directory
+    :param kwargs: arguments for the ask_directory:
+                initialdir: The initial directory to open in dialog
+                title: The title of the file dialog window
+    :return: The selected directory path
+    """
+    dire = ask_directory(force, **kwargs)
+    if not force and (dire == '' or dire is None):
+        return dire
+    while (dire == '' or dire is None) or not (len(os.listdir(dire)) == 0 or
+                                               os.path.isfile(os.path.join(dire, marker))):
+        PrintUtils.error('The directory must be empty or hold a previous run', show_time=False)
+        dire = ask_directory(force, **kwargs)
+        if not force and (dire == '' or dire is None):
+            return dire
+    return dire
+
 
 def ask_for_file(force=True, **kwargs):
     """
@@ -132,20 +158,59 @@ def download_file(url, output_path):
         file.write(r.content)
 
 
-def extract_zip(path, output_path):
+def extract_zip(path, output_path, members_filter=None, progress=None, num_workers=None):
     """
     Extracts a zip to the given output_path.
+    The members are split between a pool of threads, every thread reads the zip with its own handle.
 
     :param path: The path to the zip file
     :param output_path: The path to the extract direcory
+    :param members_filter: A function that gets a member name and returns True if it should be extracted,
+                           None to extract all the members
+    :param progress: A function called with (extracted members, total members) while extracting, from the threads
+    :param num_workers: The number of extracting threads, None for the number of cores
     :return: True if successful, False otherwise
     """
     ext = path.split('.')[-1]
     if ext == 'zip':
         PrintUtils.info('Got a zip file, extracting...')
         with zipfile.ZipFile(path, 'r') as zip_f:
-            zip_f.extractall(output_path)
-        PrintUtils.info(f'Finished extracting')
+            infos = [info for info in zip_f.infolist() if members_filter is None or members_filter(info.filename)]
+        files = [info for info in infos if not info.is_dir()]  # The file members to extract
+
+        # Create the directories first, so the threads don't race creating the same directory
+        for directory in {os.path.dirname(info.filename) for info in files} | \
+                {info.filename for info in infos if info.is_dir()}:
+            os.makedirs(os.path.join(output_path, *directory.split('/')), exist_ok=True)
+
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, len(files)))
+        # Split the members between the threads by size, biggest first to the thread with the least bytes
+        chunks = [[] for _ in range(num_workers)]  # The members of each thread
+        chunk_sizes = [0] * num_workers  # The total compressed size of each thread's members
+        for info in sorted(files, key=lambda i: i.compress_size, reverse=True):
+            smallest = chunk_sizes.index(min(chunk_sizes))
+            chunks[smallest].append(info)
+            chunk_sizes[smallest] += info.compress_size
+
+        lock = threading.Lock()  # Guards the extracted members counter
+        done = [0]  # The number of extracted members
+        step = max(1, len(files) // 100)  # Report the progress about every percent
+
+        def extract_chunk(chunk):
+            with zipfile.ZipFile(path, 'r') as thread_zip:
+                for info in chunk:
+                    thread_zip.extract(info, output_path)
+                    if progress is not None:
+                        with lock:
+                            done[0] += 1
+                            if done[0] % step == 0 or done[0] == len(files):
+                                progress(done[0], len(files))
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(extract_chunk, chunks))
+        PrintUtils.info(f'Finished extracting {len(files)} files')
         return True
     else:
         PrintUtils.error('The file is not a zip file')
@@ -166,12 +231,13 @@ def to_zip(path, output_file):
                             # os.path.relpath(os.path.join(root, f), os.path.join(path, '..')))
                             os.path.relpath(os.path.join(root, f), path))
 
-def xml_to_csv(path, classes_filter):
+def xml_to_csv(path, classes_filter, source=None):
     """
     Takes all the xml files from the path and converts them to a Pandas dataframe.
 
-    :param path: Path to the directory containing the xml files
+    :param path: Path to the directory containing the xml files, a member name of a directory if source is given
     :param classes_filter: Filter for the classes in the labels files
+    :param source: A file source to read the xml files from (e.g. a ZipSource), None to read them from the disk
     :return: A Pandas dataframe with the given columns: [image_name, image_width, image_height, class, xmin, ymin, xmax, ymax]
              Note: There is a row created for each label, if a file has more than one label
                    it will create a row for each one
@@ -183,8 +249,14 @@ def xml_to_csv(path, classes_filter):
     classes_names = []  # The names of the existing classes names in the dataset
     xml_list = []  # Every label in every file in format ['filename', 'image_width', 'image_height', 'class', 'xmin', 'ymin', 'xmax', 'ymax']
 
-    for xml_file in glob(os.path.join(path + '/*.xml')):
-        xml_tree = ET.parse(xml_file)  # The xml tree
+    if source is None:
+        xml_files = glob(os.path.join(path + '/*.xml'))  # The xml files in the directory
+    else:
+        xml_files = source.list(path.rstrip('/'), '.xml')
+
+    for xml_file in xml_files:
+        with open(xml_file, 'rb') if source is None else source.open(xml_file) as f:
+            xml_tree = ET.parse(f)  # The xml tree
         xml_root = xml_tree.getroot()  # The root element of the xml file
 
         filename = xml_root.find('filename').text + '.' + images_extension  # The image filename element
@@ -206,6 +278,41 @@ def xml_to_csv(path, classes_filter):
     classes_names.sort()
     return xml_df, classes_names
 
+def write_labels_csv(records, csv_path):
+    """
+    Write the labels of the given records to a csv file as they arrive, in the format of xml_to_csv.
+
+    :param records: An iterable of ImageRecord
+    :param csv_path: The path to the csv file
+    :return: The number of labels written
+    """
+    count = 0  # The number of labels written
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(['filename', 'image_width', 'image_height', 'class', 'xmin', 'ymin', 'xmax', 'ymax'])
+        for record in records:
+            for class_id, xmin, ymin, xmax, ymax in record.boxes.tolist():
+                writer.writerow([record.filename, record.width, record.height, record.class_names[class_id],
+                                 xmin, ymin, xmax, ymax])
+                count += 1
+    return count
+
+def iter_tf_examples(records, image_dir, label_to_id, source=None, max_side=None, jpeg_quality=95):
+    """
+    Create the serialized tf_example of every record as it arrives.
+
+    :param records: An iterable of ImageRecord
+    :param image_dir: The path to the directory of the images, a member name of a directory if source is given
+    :param label_to_id: A dict converting label string to id
+    :param source: A file source to read the images from (e.g. a ZipSource), None to read them from the disk
+    :param max_side: Downsize the images so their longer side is at most max_side, None to keep the original images
+    :param jpeg_quality: The jpg quality of the downsized images
+    :return: A generator of the serialized tf_examples
+    """
+    for record in records:
+        yield create_tf_example(record, image_dir, label_to_id, source=source, max_side=max_side,
+                                jpeg_quality=jpeg_quality).SerializeToString()
+
 def create_pbtxt(classes):
     """
     Creates a pbtxt file from the given classes.
@@ -222,38 +329,86 @@ def create_pbtxt(classes):
 
     return pbtxt_content.strip(), label_to_id
 
-def create_tf_example(group, image_dir, label_to_id):
+def resize_jpeg(encoded_jpg, max_side, quality=95):
+    """
+    Downsize a jpg image so its longer side is at most max_side and encode it again.
+
+    :param encoded_jpg: The bytes of the jpg image
+    :param max_side: The maximum size of the image's longer side
+    :param quality: The jpg quality of the encoded image
+    :return: The bytes of the resized jpg image, its width and height.
+             The original bytes are returned if the image is already small enough
+    """
+    image = Image.open(io.BytesIO(encoded_jpg))
+    width, height = image.size  # The image's original size
+    scale = max_side / max(width, height)  # The resize ratio of the image
+    if scale >= 1:
+        return encoded_jpg, width, height
+
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))  # The image's new (width, height)
+    image.draft('RGB', new_size)  # Let the jpg decoder skip the resolution that isn't needed
+    image = image.convert('RGB').resize(new_size, Image.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    return output.getvalue(), new_size[0], new_size[1]
+
+def create_tf_example(record, image_dir, label_to_id, source=None, max_side=None, jpeg_quality=95):
     """
     Create a tf_example for generating a record file from the given data point.
 
-    :param group: The given data point
-    :param image_dir: The path to the directory of the images
+    :param record: The given data point, an ImageRecord of the annotation index
+    :param image_dir: The path to the directory of the images, a member name of a directory if source is given
     :param label_to_id: A dict converting label string to id
+    :param source: A file source to read the images from (e.g. a ZipSource), None to read them from the disk
+    :param max_side: Downsize the image so its longer side is at most max_side, None to keep the original image
+    :param jpeg_quality: The jpg quality of a downsized image
     :return: The tf_example
     """
-    with tf.io.gfile.GFile(os.path.join(image_dir, '{}'.format(group.filename)), 'rb') as fid:
-        encoded_jpg = fid.read()
-    encoded_jpg_io = io.BytesIO(encoded_jpg)  # The encoded image to bytes
-    image = Image.open(encoded_jpg_io)
-    width, height = image.size  # The image's actual size and width
+    if source is None:
+        with tf.io.gfile.GFile(os.path.join(image_dir, '{}'.format(record.filename)), 'rb') as fid:
+            encoded_jpg = fid.read()
+    else:
+        encoded_jpg = source.read(image_dir.rstrip('/') + '/' + record.filename)
+
+    # The image size was already checked against the image during validation, no need to open it again
+    width, height, boxes = record.width, record.height, record.boxes
+    if max_side is not None and max(width, height) > max_side:
+        encoded_jpg, width, height = resize_jpeg(encoded_jpg, max_side, jpeg_quality)
+        boxes = scale_boxes(boxes, width / record.width, height / record.height)
+
+    return build_tf_example(record.filename, encoded_jpg, width, height, boxes, record.class_names, label_to_id)
 
-    filename = group.filename.encode('utf8')  # The filename label
+def build_tf_example(filename, encoded_jpg, width, height, boxes, class_names, label_to_id):
+    """
+    Build a tf_example from an encoded image and its boxes.
+    The boxes are normalized as whole arrays instead of one by one.
+
+    :param filename: The image's file name
+    :param encoded_jpg: The bytes of the jpg image
+    :param width: The image's width
+    :param height: The image's height
+    :param boxes: A structured numpy array of the boxes, in the BOX_DTYPE or SCALED_BOX_DTYPE of the annotation index
+    :param class_names: The names of the classes, indexed by the class_id of the boxes
+    :param label_to_id: A dict converting label string to id
+    :return: The tf_example
+    :raises KeyError: If a box's class isn't in label_to_id
+    """
+    class_ids = boxes['class_id']  # The class of each box
+    label_ids = np.array([label_to_id.get(name, -1) for name in class_names], dtype=np.int64)  # The id of each class
+    unknown = np.unique(class_ids[label_ids[class_ids] < 0])  # The classes of the boxes that aren't in the label map
+    if len(unknown):
+        raise KeyError('The classes of {} are not in the label map: [{}]'.format(
+            filename, ', '.join(class_names[class_id] for class_id in unknown)))
+    class_texts = [name.encode('utf8') for name in class_names]  # The encoded name of each class
+
+    filename = filename.encode('utf8')  # The filename label
     image_format = b'jpg'  # The image format in bytes
-    xmins = []  # The image's xmins
-    xmaxs = []  # The image's xmaxs
-    ymins = []  # The image's ymins
-    ymaxs = []  # The image's ymaxs
-    classes_text = []  # The name of the classes
-    classes = []  # The id of the classes
-
-    # Add each label to the lists
-    for index, row in group.object.iterrows():
-        xmins.append(row['xmin'] / width)
-        xmaxs.append(row['xmax'] / width)
-        ymins.append(row['ymin'] / height)
-        ymaxs.append(row['ymax'] / height)
-        classes_text.append(row['class'].encode('utf8'))
-        classes.append(label_to_id[row['class']])
+    xmins = (boxes['xmin'] / width).tolist()  # The image's xmins
+    xmaxs = (boxes['xmax'] / width).tolist()  # The image's xmaxs
+    ymins = (boxes['ymin'] / height).tolist()  # The image's ymins
+    ymaxs = (boxes['ymax'] / height).tolist()  # The image's ymaxs
+    classes_text = [class_texts[class_id] for class_id in class_ids]  # The name of the classes
+    classes = label_ids[class_ids].tolist()  # The id of the classes
 
     # Create the tf_example of the file
     tf_example = tf.train.Example(features=tf.train.Features(feature={
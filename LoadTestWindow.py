@@ -1,6 +1,8 @@
 import functools
+import queue
 import tkinter as tk
 from threading import Thread
+from tkinter import ttk
 
 from TestWindow import TestWindow
 from TrainTestExportWindow import TrainTestExportWindow
@@ -17,7 +19,11 @@ class LoadTestWindow(tk.Toplevel):
 
         self.__menubar = None  # The window's Exit menubar
         self.__data_btn = None  # The load data button
+        self.__encoded_btn = None  # The load encoded dataset button
+        self.__append_btn = None  # The append a batch to an encoded dataset button
         self.__test_btn = None  # The test a model button
+        self.__progress_label = None  # The label of the current task's progress
+        self.__progress_bar = None  # The progress bar of the current task
 
         self.__setup_window()
 
@@ -27,16 +33,27 @@ class LoadTestWindow(tk.Toplevel):
 
         :return: None
         """
-        self.geometry("200x120")  # define the window's size
+        self.geometry("240x250")  # define the window's size
         self.title("Choose load or test")
 
         self.__data_btn = tk.Button(self, bg="Yellow", text="Click here to load the data",
                                     command=self.__on_load_data)
+        self.__encoded_btn = tk.Button(self, bg="Yellow", text="Click here to load an encoded dataset",
+                                       command=self.__on_load_encoded)
+        self.__append_btn = tk.Button(self, bg="Yellow", text="Click here to append a labelled batch",
+                                      command=self.__on_append_batch)
         self.__test_btn = tk.Button(self, bg="Yellow", text="Click here to test a model",
                                     command=self.__on_test)
 
-        self.__data_btn.pack(pady=20)
+        self.__data_btn.pack(pady=(20, 0))
+        self.__encoded_btn.pack(pady=10)
+        self.__append_btn.pack(pady=(0, 10))
+        self.__progress_label = tk.Label(self, text='')
+        self.__progress_bar = ttk.Progressbar(self, orient='horizontal', length=200, mode='determinate')
+
         self.__test_btn.pack()
+        self.__progress_label.pack(pady=(10, 0))
+        self.__progress_bar.pack()
 
         self.protocol("WM_DELETE_WINDOW",
                       self.iconify)  # make the top right close button (X) minimize (iconify) the window/form
@@ -53,6 +70,8 @@ class LoadTestWindow(tk.Toplevel):
         :return: None
         """
         self.__data_btn.configure(state='normal')
+        self.__encoded_btn.configure(state='normal')
+        self.__append_btn.configure(state='normal')
         self.__test_btn.configure(state='normal')
         self.__menubar.entryconfigure('Exit', state='normal')
 
@@ -63,6 +82,8 @@ class LoadTestWindow(tk.Toplevel):
         :return: None
         """
         self.__data_btn.configure(state='disable')
+        self.__encoded_btn.configure(state='disable')
+        self.__append_btn.configure(state='disable')
         self.__test_btn.configure(state='disable')
         self.__menubar.entryconfigure('Exit', state='disabled')
 
@@ -78,6 +99,60 @@ class LoadTestWindow(tk.Toplevel):
         t.start()
         self.__wait_thread_finish(self.destroy, functools.partial(TrainTestExportWindow, self.gui, self))
 
+    def __on_load_encoded(self):
+        """
+        Called when pressing the load encoded dataset button,
+        Loads a dataset that was encoded in a previous session and then opens the train window.
+
+        :return: None
+        """
+        self.disable()
+
+        loaded = []  # The result of the load, set by the thread
+
+        def load():
+            loaded.append(self.gui.data_handler.load_encoded_dataset())
+            self.__on_thread_stop()
+
+        def on_loaded():
+            if loaded[0]:
+                self.destroy()
+                TrainTestExportWindow(self.gui, self)
+            else:
+                self.enable()
+                self.focus_force()
+
+        t = Thread(target=load)
+        t.start()
+        self.__wait_thread_finish(on_loaded)
+
+    def __on_append_batch(self):
+        """
+        Called when pressing the append batch button,
+        Appends a new batch of labelled images to an encoded dataset and then opens the train window.
+
+        :return: None
+        """
+        self.disable()
+
+        appended = []  # The result of the append, set by the thread
+
+        def append():
+            appended.append(self.gui.data_handler.append_batch())
+            self.__on_thread_stop()
+
+        def on_appended():
+            if appended[0]:
+                self.destroy()
+                TrainTestExportWindow(self.gui, self)
+            else:
+                self.enable()
+                self.focus_force()
+
+        t = Thread(target=append)
+        t.start()
+        self.__wait_thread_finish(on_appended)
+
     def __on_test(self):
         """
         Called when pressing the test model button,
@@ -87,9 +162,14 @@ class LoadTestWindow(tk.Toplevel):
         """
         self.disable()
 
+        loaded = []  # The result of the load, set by the thread
+
         def load():
-            result = self.gui.model_handler.load_model()
-            if result:
+            loaded.append(self.gui.model_handler.load_model())
+            self.__on_thread_stop()
+
+        def on_loaded():
+            if loaded[0]:
                 TestWindow(self.gui, self)
             else:
                 self.enable()
@@ -97,6 +177,24 @@ class LoadTestWindow(tk.Toplevel):
 
         t = Thread(target=load)
         t.start()
+        self.__wait_thread_finish(on_loaded)
+
+    def __show_progress(self):
+        """
+        Show the progress events the worker threads reported since the last call.
+
+        :return: None
+        """
+        event = None  # The latest progress event
+        try:
+            while True:
+                event = self.gui.progress_events.get_nowait()
+        except queue.Empty:
+            pass
+        if event is not None:
+            task, done, total = event
+            self.__progress_label.configure(text=f'{task}: {done}/{total}')
+            self.__progress_bar.configure(maximum=max(total, 1), value=done)
 
     def __on_thread_stop(self):
         """
@@ -113,6 +211,7 @@ class LoadTestWindow(tk.Toplevel):
         :param funcs: Functions to run when the thread finishes
         :return: None
         """
+        self.__show_progress()
         if self.__stop_thread:
             self.__stop_thread = False
             for func in funcs:
@@ -1,5 +1,7 @@
+import queue
 import tkinter as tk
 from threading import Thread
+from tkinter import ttk
 
 from BasicFunctions import *
 from TestWindow import TestWindow
@@ -19,6 +21,9 @@ class TrainTestExportWindow(tk.Toplevel):
         self.__new_model_btn = None  # The train new model button
         self.__test_existing_btn = None  # The test on exiting model button
         self.__export_model_btn = None  # The export trained model button
+        self.__cancel_btn = None  # The stop training button
+        self.__status_label = None  # The label of the training status
+        self.__progress_bar = None  # The progress bar of the training steps
 
         self.__setup_window()
 
@@ -28,7 +33,7 @@ class TrainTestExportWindow(tk.Toplevel):
 
         :return: None
         """
-        self.geometry("230x200")  # define the window's size
+        self.geometry("260x310")  # define the window's size
         self.title("Choose train test or export")
 
         self.__new_model_btn = tk.Button(self, bg="Yellow", text="Click here to train a new model",
@@ -37,10 +42,17 @@ class TrainTestExportWindow(tk.Toplevel):
                                              command=self.__on_test_existing)
         self.__export_model_btn = tk.Button(self, bg="Yellow", text="Click here to export a model",
                                             command=self.__on_export)
+        self.__cancel_btn = tk.Button(self, bg="Orange", text="Stop training", state='disable',
+                                      command=self.__on_cancel)
+        self.__status_label = tk.Label(self, text='', justify='left')
+        self.__progress_bar = ttk.Progressbar(self, orient='horizontal', length=220, mode='determinate')
 
         self.__new_model_btn.pack(pady=20)
         self.__test_existing_btn.pack()
         self.__export_model_btn.pack(pady=20)
+        self.__cancel_btn.pack()
+        self.__status_label.pack(pady=(10, 0))
+        self.__progress_bar.pack()
 
         self.protocol("WM_DELETE_WINDOW",
                       self.iconify)  # make the top right close button (X) minimize (iconify) the window/form
@@ -81,10 +93,49 @@ class TrainTestExportWindow(tk.Toplevel):
         :return: None
         """
         self.disable()
+        self.__cancel_btn.configure(state='normal')
         t = Thread(target=combine_functions(self.gui.model_handler.train_model, self.__on_thread_stop))
         t.start()
 
-        self.__wait_thread_finish(self.enable)
+        self.__wait_thread_finish(self.enable, lambda: self.__cancel_btn.configure(state='disable'))
+
+    def __on_cancel(self):
+        """
+        Called when pressing the stop training button.
+        Stops the training after its current step.
+
+        :return: None
+        """
+        self.__cancel_btn.configure(state='disable')
+        self.gui.model_handler.cancel_training()
+
+    def __show_training_status(self):
+        """
+        Show the latest status the training reported since the last call.
+
+        :return: None
+        """
+        status = None  # The latest training status
+        try:
+            while True:
+                status = self.gui.training_events.get_nowait()
+        except queue.Empty:
+            pass
+        url = self.gui.model_handler.tensorboard.url  # The url of the TensorBoard server, None until it serves
+        if status is not None:
+            # A num_steps of 0 trains until it's stopped, there is no end to show the progress to
+            steps = 'Step {}/{}'.format(status.step, status.num_steps) if status.num_steps > 0 else \
+                'Step {}'.format(status.step)
+            self.__status_label.configure(text='{}, loss {:.4f}\n{:.2f} steps/s, {:.1f} images/s{}'.format(
+                steps, status.losses.get('Loss/total_loss', float('nan')),
+                status.steps_per_sec, status.examples_per_sec, f'\nTensorBoard: {url}' if url else ''))
+            if status.num_steps > 0:
+                self.__progress_bar.configure(mode='determinate', maximum=status.num_steps, value=status.step)
+            else:
+                self.__progress_bar.configure(mode='indeterminate')
+                self.__progress_bar.step()
+        elif url is not None and self.__status_label.cget('text') == '':
+            self.__status_label.configure(text=f'TensorBoard: {url}')
 
     def __on_test_existing(self):
         """
@@ -134,6 +185,7 @@ class TrainTestExportWindow(tk.Toplevel):
         :param funcs: Functions to run when the thread finishes
         :return: None
         """
+        self.__show_training_status()
         if self.__stop_thread:
             self.__stop_thread = False
             for func in funcs:
@@ -0,0 +1,195 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import PrintUtils
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+"""
+This is the bulk annotation importers of the dataset, besides the Pascal VOC xml files.
+COCO: a single json file of all the images, streamed in one pass with the optional ijson package,
+without it the file is loaded whole with json.load, which needs several times the file's size in memory.
+YOLO: a txt file per image of normalized boxes and a classes.txt file of the class names.
+Both turn every image into a LabelEntry that goes through the same validation as the VOC annotations.
+"""
+
+ANNOTATION_FORMATS = ('voc', 'coco', 'yolo')  # The supported annotation formats
+YOLO_CLASSES_FILE = 'classes.txt'  # The name of the class names file of a YOLO dataset, in the annotations directory
+COCO_SECTIONS = ('images', 'annotations', 'categories')  # The top level lists of a COCO file that are read
+# The prefix of every needed field of the items when the file is streamed, to the name of the field
+COCO_FIELDS = {f'{section}.item.{field}': field for section, fields in
+               (('images', ('id', 'file_name', 'width', 'height')), ('annotations', ('image_id', 'category_id')),
+                ('categories', ('id', 'name'))) for field in fields}
+
+# The parsed label of a single image, before checking it against its image.
+# width and height are None if the label has no image size, normalized is True if the coordinates are relative.
+# errors are the errors found while parsing the label, a label with errors isn't checked against its image.
+LabelEntry = namedtuple('LabelEntry', ['name', 'image_name', 'width', 'height', 'objects', 'normalized', 'errors'])
+
+def detect_format(names, anns_dir='annotations'):
+    """
+    Detect the annotation format of a dataset from its member names.
+
+    :param names: The member names of the dataset
+    :param anns_dir: The member name of the directory of the annotations
+    :return: 'voc', 'coco', 'yolo' or None if there are no annotations
+    """
+    prefix = anns_dir + '/'  # The prefix of the annotations members
+    extensions = {os.path.splitext(name)[1] for name in names
+                  if name.startswith(prefix) and '/' not in name[len(prefix):]}  # The annotation extensions
+    if '.xml' in extensions:
+        return 'voc'
+    if '.json' in extensions:
+        return 'coco'
+    if '.txt' in extensions:
+        return 'yolo'
+    return None
+
+def __coco_items(source, coco_file):
+    """
+    Iterate over the items of the top level lists of a COCO file, in a single pass over the file.
+    With ijson the file is streamed and only the needed fields of the current item are kept,
+    without it the file is loaded with json.
+
+    :param source: The file source of the dataset
+    :param coco_file: The member name of the COCO json file
+    :return: A generator of (section, item), section is one of COCO_SECTIONS
+    """
+    if ijson is None:
+        PrintUtils.warning(f'ijson is not installed, loading the whole {coco_file} into memory')
+        with source.open(coco_file) as f:
+            data = json.load(f)
+        for section in COCO_SECTIONS:
+            for item in data.get(section, []):
+                yield section, item
+        return
+
+    item_prefixes = {section + '.item': section for section in COCO_SECTIONS}  # The prefix of each section's items
+    with source.open(coco_file) as f:
+        item = {}  # The needed fields of the current item, the rest of the item, e.g. its segmentation, is skipped
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix in COCO_FIELDS:
+                item[COCO_FIELDS[prefix]] = value
+            elif prefix == 'annotations.item.bbox.item':
+                item.setdefault('bbox', []).append(value)
+            elif event == 'end_map' and prefix in item_prefixes:
+                yield item_prefixes[prefix], item
+                item = {}
+
+def iter_coco_entries(source, coco_file):
+    """
+    Read the labels of a COCO json file.
+    The file is read once, the categories and images are kept in dicts by id and the boxes in lists,
+    grouped by image with a single numpy sort, so the sections can come in any order.
+    Without the optional ijson package the whole file is loaded with json.
+
+    :param source: The file source of the dataset
+    :param coco_file: The member name of the COCO json file
+    :return: A generator of LabelEntry, one for each image in the file,
+             and one more with the errors of the annotations of missing images, if there are any
+    """
+    categories = {}  # The name of each category, by id
+    images = {}  # The (file name, width, height) of each image, by id, in the order of the file
+    box_images = []  # The image id of each box
+    box_categories = []  # The category id of each box
+    bboxes = []  # The [x, y, width, height] of each box
+    for section, item in __coco_items(source, coco_file):
+        if section == 'annotations':
+            box_images.append(item['image_id'])
+            box_categories.append(item['category_id'])
+            bboxes.append(item['bbox'])
+        elif section == 'images':
+            images[item['id']] = (item['file_name'], item.get('width'), item.get('height'))
+        else:
+            categories[item['id']] = item['name']
+
+    # Group the boxes by image, the boxes of image i are order[starts[i]:starts[i + 1]]
+    position_of_id = {image_id: i for i, image_id in enumerate(images)}  # The position of each image id
+    box_positions = np.array([position_of_id.get(image_id, -1) for image_id in box_images], dtype=np.int64)
+    order = np.argsort(box_positions, kind='stable')  # The boxes sorted by their image
+    starts = np.searchsorted(box_positions[order], np.arange(len(images) + 1))
+    corners = np.rint(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4) @
+                      np.array([[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]])).astype(np.int64)
+
+    label_name = coco_file.split('/')[-1]  # The name of the file in the error messages
+    for i, (image_name, width, height) in enumerate(images.values()):
+        errors = []  # The errors of the current image's labels
+        objects = []  # The objects of the current image
+        for box in order[starts[i]:starts[i + 1]]:
+            clazz = categories.get(box_categories[box])  # The class of the current box
+            if clazz is None:
+                errors.append(f'Error in file {label_name}:{image_name}, unknown category {box_categories[box]}')
+                continue
+            objects.append((clazz, *corners[box].tolist()))
+        yield LabelEntry(f'{label_name}:{image_name}', image_name, width, height, objects, False, errors)
+
+    # The annotations whose image_id has no image can't be checked or trained on, they're reported as an error entry
+    orphans = box_positions < 0  # The boxes of missing images
+    if np.any(orphans):
+        missing_ids, counts = np.unique(np.asarray(box_images, dtype=object)[orphans].astype(str), return_counts=True)
+        errors = [f'Error in file {label_name}, {count} annotations of image_id {image_id} which is not in the images'
+                  for image_id, count in zip(missing_ids, counts)]
+        yield LabelEntry(f'{label_name}:missing images', None, None, None, [], False, errors)
+
+def read_yolo_classes(source, anns_dir='annotations'):
+    """
+    Read the class names of a YOLO dataset, a name per line, the line number is the class id.
+
+    :param source: The file source of the dataset
+    :param anns_dir: The member name of the directory of the annotations
+    :return: The list of class names
+    """
+    with source.open(anns_dir + '/' + YOLO_CLASSES_FILE) as f:
+        return [line.strip() for line in f.read().decode('utf8').splitlines() if line.strip()]
+
+def parse_yolo_label(label_name, text, class_names, image_ext='jpg'):
+    """
+    Parse a YOLO label, a "class_id center_x center_y width height" line of normalized values for every box.
+
+    :param label_name: The name of the txt file
+    :param text: The content of the txt file
+    :param class_names: The class names of the dataset
+    :param image_ext: The extension of the images
+    :return: The LabelEntry of the image
+    """
+    errors = []  # The errors of the label
+    objects = []  # The objects of the label
+    for i, line in enumerate(line for line in text.splitlines() if line.strip()):
+        try:
+            class_id, center_x, center_y, width, height = line.split()
+            class_id = int(class_id)
+            if class_id < 0:
+                raise ValueError(class_id)
+            center_x, center_y, width, height = float(center_x), float(center_y), float(width), float(height)
+            clazz = class_names[class_id]
+        except Exception:
+            errors.append(f'Error in file {label_name}, object {i}, reading the box line')
+            continue
+        objects.append((clazz, center_x - width / 2, center_y - height / 2,
+                        center_x + width / 2, center_y + height / 2))
+    image_name = os.path.splitext(label_name)[0] + '.' + image_ext  # The file name of the image
+    return LabelEntry(label_name, image_name, None, None, objects, True, errors)
+
+def read_yolo_entry(source, txt_file, class_names, image_ext='jpg'):
+    """
+    Read and parse a YOLO label file.
+
+    :param source: The file source of the dataset
+    :param txt_file: The member name of the txt file
+    :param class_names: The class names of the dataset
+    :param image_ext: The extension of the images
+    :return: The LabelEntry of the image
+    """
+    label_name = txt_file.split('/')[-1]  # The name of the txt file
+    try:
+        text = source.read(txt_file).decode('utf8')
+    except Exception:
+        return LabelEntry(label_name, os.path.splitext(label_name)[0] + '.' + image_ext, None, None, [], True,
+                          [f'Error parsing file {label_name}'])
+    return parse_yolo_label(label_name, text, class_names, image_ext)
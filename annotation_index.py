@@ -0,0 +1,238 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+"""
+This is the annotation index of the dataset.
+It holds every label of the dataset in columnar form, so the annotation files are parsed only once.
+"""
+
+# The dtype of a single bounding box, class_id is the index of the class in the class_names of the index
+BOX_DTYPE = np.dtype([('class_id', np.int32),
+                      ('xmin', np.int32), ('ymin', np.int32),
+                      ('xmax', np.int32), ('ymax', np.int32)])
+
+# The dtype of a bounding box after resizing its image, the coordinates aren't rounded
+SCALED_BOX_DTYPE = np.dtype([('class_id', np.int32),
+                             ('xmin', np.float64), ('ymin', np.float64),
+                             ('xmax', np.float64), ('ymax', np.float64)])
+
+# A single image of the index with its boxes
+ImageRecord = namedtuple('ImageRecord', ['filename', 'width', 'height', 'boxes', 'class_names'])
+
+CHUNK_SIZE = 8192  # The number of rows of a chunk of a ChunkedColumn
+
+class ChunkedColumn:
+    """
+    A numpy column that grows a fixed size chunk at a time,
+    so appending a row doesn't keep a Python object for it like a list of tuples does.
+    """
+    def __init__(self, dtype, chunk_size=CHUNK_SIZE):
+        self.dtype = dtype  # The dtype of the column
+        self.chunk_size = chunk_size  # The number of rows of a chunk
+        self.__chunks = []  # The full chunks
+        self.__chunk = np.empty(chunk_size, dtype=dtype)  # The chunk being filled
+        self.__filled = 0  # The number of rows in the chunk being filled
+
+    def append(self, row):
+        """
+        Append a row to the column.
+
+        :param row: The value of the row, a tuple for a structured dtype
+        :return: None
+        """
+        if self.__filled == self.chunk_size:
+            self.__chunks.append(self.__chunk)
+            self.__chunk = np.empty(self.chunk_size, dtype=self.dtype)
+            self.__filled = 0
+        self.__chunk[self.__filled] = row
+        self.__filled += 1
+
+    def __len__(self):
+        return len(self.__chunks) * self.chunk_size + self.__filled
+
+    def to_array(self):
+        """
+        :return: The column as a single numpy array
+        """
+        return np.concatenate(self.__chunks + [self.__chunk[:self.__filled]])
+
+class AnnotationIndex:
+    """
+    A columnar store of the dataset's annotations.
+    Every image is a row in the image columns, the boxes of image i are boxes[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, xml_names, filenames, widths, heights, offsets, boxes, class_names):
+        self.xml_names = np.asarray(xml_names, dtype=str)  # The name of the annotation file of each image
+        self.filenames = np.asarray(filenames, dtype=str)  # The file name of each image
+        self.widths = np.asarray(widths, dtype=np.int32)  # The width of each image
+        self.heights = np.asarray(heights, dtype=np.int32)  # The height of each image
+        self.offsets = np.asarray(offsets, dtype=np.int64)  # The offset of each image's boxes, has one extra entry
+        self.boxes = np.asarray(boxes, dtype=BOX_DTYPE)  # The boxes of all the images
+        self.class_names = list(class_names)  # The names of the classes, indexed by the class_id of the boxes
+
+    @staticmethod
+    def from_records(records):
+        """
+        Build an index from parsed annotations.
+
+        :param records: An iterable of (xml_name, filename, width, height, objects) tuples,
+                        objects is a list of (class, xmin, ymin, xmax, ymax) tuples
+        :return: The AnnotationIndex
+        """
+        xml_names = []  # The name of the annotation file of each image
+        filenames = []  # The file name of each image
+        widths = ChunkedColumn(np.int32)  # The width of each image
+        heights = ChunkedColumn(np.int32)  # The height of each image
+        offsets = ChunkedColumn(np.int64)  # The offset of each image's boxes
+        boxes = ChunkedColumn(BOX_DTYPE)  # The boxes of all the images
+        class_to_id = {}  # The class name to class_id dictionary
+
+        offsets.append(0)
+        for xml_name, filename, width, height, objects in records:
+            xml_names.append(xml_name)
+            filenames.append(filename)
+            widths.append(width)
+            heights.append(height)
+            for clazz, xmin, ymin, xmax, ymax in objects:
+                class_id = class_to_id.setdefault(clazz, len(class_to_id))
+                boxes.append((class_id, xmin, ymin, xmax, ymax))
+            offsets.append(len(boxes))
+
+        return AnnotationIndex(xml_names, filenames, widths.to_array(), heights.to_array(), offsets.to_array(),
+                               boxes.to_array(), list(class_to_id))
+
+    @staticmethod
+    def load(path):
+        """
+        Load an index saved with save.
+
+        :param path: The path to the .npz file
+        :return: The AnnotationIndex
+        """
+        with np.load(path) as data:
+            return AnnotationIndex(data['xml_names'], data['filenames'], data['widths'], data['heights'],
+                                   data['offsets'], data['boxes'], data['class_names'].tolist())
+
+    def save(self, path):
+        """
+        Save the index to a .npz file.
+
+        :param path: The path to the .npz file
+        :return: None
+        """
+        np.savez(path, xml_names=self.xml_names, filenames=self.filenames, widths=self.widths,
+                 heights=self.heights, offsets=self.offsets, boxes=self.boxes,
+                 class_names=np.asarray(self.class_names, dtype=str))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def num_boxes(self):
+        """
+        :return: The number of boxes of each image
+        """
+        return np.diff(self.offsets)
+
+    def record(self, i):
+        """
+        Get a single image of the index.
+
+        :param i: The position of the image in the index
+        :return: The ImageRecord of the image
+        """
+        return ImageRecord(str(self.filenames[i]), int(self.widths[i]), int(self.heights[i]),
+                           self.boxes[self.offsets[i]:self.offsets[i + 1]], self.class_names)
+
+    def iter_records(self):
+        """
+        :return: A generator of the ImageRecord of every image in the index
+        """
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def subset(self, indices):
+        """
+        Create an index of some of the images.
+
+        :param indices: The positions of the images to keep
+        :return: The new AnnotationIndex
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = np.diff(self.offsets)[indices]  # The number of boxes of each kept image
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # The positions of the kept boxes in the boxes column
+        box_positions = np.repeat(self.offsets[:-1][indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return AnnotationIndex(self.xml_names[indices], self.filenames[indices], self.widths[indices],
+                               self.heights[indices], offsets, self.boxes[box_positions], self.class_names)
+
+    def filter_classes(self, classes_filter):
+        """
+        Create an index with only the boxes of the given classes.
+        Images left without boxes are dropped.
+
+        :param classes_filter: The names of the classes to keep
+        :return: The new AnnotationIndex
+        """
+        class_ids = [i for i, name in enumerate(self.class_names) if name in classes_filter]
+        return self.filter_boxes(np.isin(self.boxes['class_id'], class_ids))
+
+    def filter_boxes(self, keep, drop_empty=True):
+        """
+        Create an index with only some of the boxes.
+
+        :param keep: A boolean numpy array, the mask of the kept boxes
+        :param drop_empty: Drop the images left without boxes
+        :return: The new AnnotationIndex
+        """
+        image_of_box = np.repeat(np.arange(len(self)), self.num_boxes())  # The image position of each box
+        kept_per_image = np.bincount(image_of_box[keep], minlength=len(self))  # The number of kept boxes of each image
+        images = np.flatnonzero(kept_per_image) if drop_empty else np.arange(len(self))  # The kept images
+        offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        np.cumsum(kept_per_image[images], out=offsets[1:])
+        return AnnotationIndex(self.xml_names[images], self.filenames[images], self.widths[images],
+                               self.heights[images], offsets, self.boxes[keep], self.class_names)
+
+    def present_classes(self):
+        """
+        :return: The sorted names of the classes that have boxes in the index
+        """
+        return sorted(self.class_names[i] for i in np.unique(self.boxes['class_id']))
+
+    def to_dataframe(self):
+        """
+        Convert the index to a Pandas dataframe in the format of xml_to_csv.
+
+        :return: A Pandas dataframe with the given columns: [filename, image_width, image_height, class, xmin, ymin, xmax, ymax]
+        """
+        image_of_box = np.repeat(np.arange(len(self)), self.num_boxes())  # The image position of each box
+        return pd.DataFrame({
+            'filename': self.filenames[image_of_box],
+            'image_width': self.widths[image_of_box],
+            'image_height': self.heights[image_of_box],
+            'class': np.asarray(self.class_names, dtype=object)[self.boxes['class_id']]
+            if len(self.class_names) > 0 else np.empty(0, dtype=object),
+            'xmin': self.boxes['xmin'],
+            'ymin': self.boxes['ymin'],
+            'xmax': self.boxes['xmax'],
+            'ymax': self.boxes['ymax'],
+        })
+
+def scale_boxes(boxes, scale_x, scale_y):
+    """
+    Scale boxes to match a resized image.
+
+    :param boxes: A structured numpy array of the boxes, in BOX_DTYPE
+    :param scale_x: The ratio between the new and the original width of the image
+    :param scale_y: The ratio between the new and the original height of the image
+    :return: The scaled boxes, in SCALED_BOX_DTYPE
+    """
+    scaled = np.empty(len(boxes), dtype=SCALED_BOX_DTYPE)  # The scaled boxes
+    scaled['class_id'] = boxes['class_id']
+    scaled['xmin'] = boxes['xmin'] * scale_x
+    scaled['xmax'] = boxes['xmax'] * scale_x
+    scaled['ymin'] = boxes['ymin'] * scale_y
+    scaled['ymax'] = boxes['ymax'] * scale_y
+    return scaled
@@ -0,0 +1,142 @@
+import io
+import os
+import sys
+import time
+
+"""
+This is a utils functions class for the benchmarks.
+It sets up the import paths like project_main and builds synthetic datasets.
+"""
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # The root directory of the project
+
+def setup_paths():
+    """
+    Add the project and the Object Detection API to the import paths.
+
+    :return: None
+    """
+    for path in (PROJECT_DIR,
+                 os.path.join(PROJECT_DIR, 'resources', 'models'),
+                 os.path.join(PROJECT_DIR, 'resources', 'models', 'research'),
+                 os.path.join(PROJECT_DIR, 'resources', 'models', 'research', 'slim')):
+        if path not in sys.path:
+            sys.path.append(path)
+
+def make_jpeg(width, height, seed=0):
+    """
+    Create a random jpg image.
+
+    :param width: The image's width
+    :param height: The image's height
+    :param seed: The random seed of the pixels
+    :return: The bytes of the jpg image
+    """
+    import numpy as np
+    from PIL import Image
+
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)  # The random pixels
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+def synthetic_index(num_images, width=1280, height=720, max_boxes=4, seed=0):
+    """
+    Create an annotation index of random boxes.
+
+    :param num_images: The number of images in the index
+    :param width: The width of every image
+    :param height: The height of every image
+    :param max_boxes: The maximum number of boxes of an image
+    :param seed: The random seed of the boxes
+    :return: The AnnotationIndex
+    """
+    import numpy as np
+    from annotation_index import AnnotationIndex
+
+    rng = np.random.default_rng(seed)
+    records = []  # The (xml_name, filename, width, height, objects) of every image
+    for i in range(num_images):
+        objects = []  # The boxes of the current image
+        for _ in range(rng.integers(1, max_boxes + 1)):
+            xmin, xmax = sorted(rng.integers(0, width, 2))
+            ymin, ymax = sorted(rng.integers(0, height, 2))
+            objects.append(('pistol', int(xmin), int(ymin), int(xmax) + 1, int(ymax) + 1))
+        records.append((f'{i}.xml', f'{i}.jpg', width, height, objects))
+    return AnnotationIndex.from_records(records)
+
+class MemorySource:
+    """
+    A file source returning the same image bytes for every member, so the benchmarks don't measure the disk.
+    """
+    def __init__(self, data):
+        self.data = data  # The bytes returned for every member
+
+    def read(self, name):
+        return self.data
+
+    def open(self, name):
+        return io.BytesIO(self.data)
+
+def timed(func, *args, **kwargs):
+    """
+    Run a function and measure it.
+
+    :return: The function's result and the time it took in seconds
+    """
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+def peak_rss_mb():
+    """
+    Get the peak resident memory of the current process.
+
+    :return: The peak RSS in MB, None if it can't be measured on this platform
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on Linux, bytes on macOS
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+def write_voc_dataset(directory, annotation_index, image_bytes):
+    """
+    Write an annotation index as a Pascal VOC dataset, annotations/*.xml and images/*.jpg.
+    Every image is a hard link to the same file when the file system allows it.
+
+    :param directory: The path to the dataset directory
+    :param annotation_index: The AnnotationIndex to write
+    :param image_bytes: The bytes of the jpg image used for every image
+    :return: None
+    """
+    anns_dir = os.path.join(directory, 'annotations')  # The directory of the annotations
+    images_dir = os.path.join(directory, 'images')  # The directory of the images
+    os.makedirs(anns_dir, exist_ok=True)
+    os.makedirs(images_dir, exist_ok=True)
+
+    image_path = os.path.join(directory, 'image.jpg')  # The image every image links to
+    with open(image_path, 'wb') as f:
+        f.write(image_bytes)
+
+    for i in range(len(annotation_index)):
+        record = annotation_index.record(i)
+        objects = ''.join('<object><name>{}</name><bndbox><xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax>'
+                          '<ymax>{}</ymax></bndbox></object>'.format(record.class_names[class_id], *box)
+                          for class_id, *box in record.boxes.tolist())
+        with open(os.path.join(anns_dir, str(annotation_index.xml_names[i])), 'w') as f:
+            f.write('<annotation><filename>{}</filename><size><width>{}</width><height>{}</height></size>{}'
+                    '</annotation>'.format(os.path.splitext(record.filename)[0], record.width, record.height, objects))
+
+        target = os.path.join(images_dir, record.filename)  # The path to the current image
+        try:
+            os.link(image_path, target)
+        except OSError:
+            with open(target, 'wb') as f:
+                f.write(image_bytes)
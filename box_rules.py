@@ -0,0 +1,105 @@
+import numpy as np
+
+"""
+This is the box geometry rule engine of the dataset validation.
+Every rule is a numpy mask over all the boxes (or all the images) of an annotation index,
+so checking the whole dataset is a few array operations instead of a Python loop over the objects.
+"""
+
+# The message of each box rule, in the format of the validation error messages
+BOX_RULE_MESSAGES = {
+    'xmin_bounds': 'xmin value',
+    'ymin_bounds': 'ymin value',
+    'xmax_bounds': 'xmax value',
+    'ymax_bounds': 'ymax value',
+    'inverted': 'xmin > xmax or ymin > ymax',
+    'zero_area': 'zero area box',
+    'min_size': 'box smaller than the minimum size',
+    'duplicate': 'duplicate box',
+}
+
+def box_rule_masks(annotation_index, min_width=None, min_height=None):
+    """
+    Evaluate the box rules over all the boxes.
+
+    :param annotation_index: The AnnotationIndex to check
+    :param min_width: The minimum width of a box in pixels, None for no minimum
+    :param min_height: The minimum height of a box in pixels, None for no minimum
+    :return: A dict of rule name to a boolean numpy array, True for the boxes that break the rule
+    """
+    image_of_box = np.repeat(np.arange(len(annotation_index)), annotation_index.num_boxes())  # The image of each box
+    widths = annotation_index.widths[image_of_box]  # The width of each box's image
+    heights = annotation_index.heights[image_of_box]  # The height of each box's image
+    boxes = annotation_index.boxes  # The boxes of all the images
+    xmin, ymin, xmax, ymax = boxes['xmin'], boxes['ymin'], boxes['xmax'], boxes['ymax']
+    box_widths = xmax - xmin  # The width of each box
+    box_heights = ymax - ymin  # The height of each box
+
+    masks = {
+        'xmin_bounds': (xmin < 0) | (xmin > widths),
+        'ymin_bounds': (ymin < 0) | (ymin > heights),
+        'xmax_bounds': (xmax < 0) | (xmax > widths),
+        'ymax_bounds': (ymax < 0) | (ymax > heights),
+        'inverted': (box_widths < 0) | (box_heights < 0),
+        'zero_area': (box_widths == 0) | (box_heights == 0),
+        'min_size': np.zeros(len(boxes), dtype=bool),
+    }
+    if min_width is not None:
+        masks['min_size'] |= (box_widths > 0) & (box_widths < min_width)
+    if min_height is not None:
+        masks['min_size'] |= (box_heights > 0) & (box_heights < min_height)
+
+    # A box is a duplicate if an earlier box of the same image has the same class and coordinates
+    order = np.lexsort((np.arange(len(boxes)), ymax, xmax, ymin, xmin, boxes['class_id'], image_of_box))
+    same_as_previous = np.zeros(len(boxes), dtype=bool)  # In sorted order, the box equals the box before it
+    if len(boxes) > 1:
+        same_as_previous[1:] = ((image_of_box[order][1:] == image_of_box[order][:-1]) &
+                                (boxes[order][1:] == boxes[order][:-1]))
+    masks['duplicate'] = np.zeros(len(boxes), dtype=bool)
+    masks['duplicate'][order] = same_as_previous
+    return masks
+
+def image_rule_masks(annotation_index, max_objects=None):
+    """
+    Evaluate the image rules over all the images.
+
+    :param annotation_index: The AnnotationIndex to check
+    :param max_objects: The maximum number of boxes of an image, None for no maximum
+    :return: A dict of rule name to a boolean numpy array, True for the images that break the rule
+    """
+    num_boxes = annotation_index.num_boxes()  # The number of boxes of each image
+    return {'max_objects': num_boxes > max_objects if max_objects is not None
+            else np.zeros(len(annotation_index), dtype=bool)}
+
+def evaluate_rules(annotation_index, min_width=None, min_height=None, max_objects=None, drop_duplicates=True):
+    """
+    Check an annotation index against the geometry rules.
+    Only the boxes and images that break a rule are looped over, to build their error messages.
+
+    :param annotation_index: The AnnotationIndex to check
+    :param min_width: The minimum width of a box in pixels, None for no minimum
+    :param min_height: The minimum height of a box in pixels, None for no minimum
+    :param max_objects: The maximum number of boxes of an image, None for no maximum
+    :param drop_duplicates: Drop the duplicate boxes instead of failing their images
+    :return: A tuple (errors, keep_boxes), errors is a dict of image position to its list of error messages,
+             keep_boxes is the mask of the boxes to keep in the index
+    """
+    box_masks = box_rule_masks(annotation_index, min_width, min_height)  # The boxes that break each rule
+    image_masks = image_rule_masks(annotation_index, max_objects)  # The images that break each rule
+    keep_boxes = ~box_masks['duplicate'] if drop_duplicates else np.ones(len(annotation_index.boxes), dtype=bool)
+    if drop_duplicates:
+        box_masks = {name: mask for name, mask in box_masks.items() if name != 'duplicate'}
+
+    image_of_box = np.repeat(np.arange(len(annotation_index)), annotation_index.num_boxes())  # The image of each box
+    object_of_box = np.arange(len(annotation_index.boxes)) - annotation_index.offsets[image_of_box]  # The object number
+
+    errors = {}  # The error messages of each image that breaks a rule
+    for name, mask in box_masks.items():
+        for box in np.flatnonzero(mask):
+            image = int(image_of_box[box])
+            errors.setdefault(image, []).append('Error in file {}, object {}, {}'.format(
+                annotation_index.xml_names[image], object_of_box[box], BOX_RULE_MESSAGES[name]))
+    for image in np.flatnonzero(image_masks['max_objects']):
+        errors.setdefault(int(image), []).append('Error in file {}, {} objects, more than {}'.format(
+            annotation_index.xml_names[image], annotation_index.num_boxes()[image], max_objects))
+    return errors, keep_boxes
@@ -1,44 +1,315 @@
+import functools
 import shutil
-from collections import namedtuple
-
-import cv2
-from sklearn.model_selection import train_test_split
+import time
 
 from BasicFunctions import *
+from annotation_importers import YOLO_CLASSES_FILE, detect_format, iter_coco_entries, read_yolo_classes
+from annotation_index import AnnotationIndex
+from box_rules import evaluate_rules
+from dataset_manifest import (append_batch, create_manifest, images_path, load_images, load_manifest, manifest_path,
+                              save_images, save_manifest)
+from dataset_profiler import profile_index, save_profile, summarize_profile
+from file_source import DirectorySource, ZipSource
+from image_dedup import collapse_exact_duplicates, compute_hashes, find_duplicate_groups, label_keys, match_duplicates
+from label_store import write_label_store
+from pipeline_stages import STATE_FILE, StageRunner, file_identity, hash_inputs
+from record_writer import archive_records, generation_files, shard_pattern, write_sharded_records
+from split_manifest import create_split, load_split, materialize_split, save_split, stable_split
+from validation_cache import ValidationCache, file_hash
+from validation_engine import validate_annotations, validate_entries, validate_yolo_labels
+
+CLASSES_FILTER = ['pistol']  # The classes that are encoded
+CACHE_WRITE_BATCH = 1024  # The number of validation results written to the cache at once
+DATASET_DIRS = ('annotations', 'images')  # The directories the dataset zip is extracted to
+STAGE_FILES = ('annotations_index.npz', 'image_hashes.npz', 'split.json')  # The files the stages write
 
 class DataHandler:
     """
     Handles anything regarding the dataset.
     This class loads the data, validates it, splits it to train and test, and finally encodes it.
+    Every stage is recorded in the extracted data dir, so a re-run skips the completed stages.
     """
     def __init__(self, gui):
         self.gui = gui  # The main gui class
         self.root = gui.root  # The tkinter root
-        self.extracted_dir = None  # The path to the extracted data dir
+        self.data_zip = None  # The path to the dataset zip file
+        self.extracted_dir = None  # The path to the extracted data dir, holds the dataset files if it isn't extracted
+        self.source = None  # The file source the dataset is read from
         self.split_dir = None  # The path to the split data dir
         self.encoded_dir = None  # The path to the encoded data dir
-        self.train_record_path = None  # The path to the train .record file
-        self.eval_record_path = None  # The path to the eval .record file
+        self.train_record_path = None  # The glob pattern of the train .record shards
+        self.eval_record_path = None  # The glob pattern of the eval .record shards
         self.label_map_path = None  # The path to the label_map.pbtxt file
         self.num_train = None  # Number of train input images
         self.num_eval = None  # Number of test input images
+        self.manifest = None  # The manifest of the encoded dataset
+        self.annotation_index = None  # The AnnotationIndex of the valid annotations
+        self.dataset_format = None  # The annotation format of the current dataset
+        self.train_index = None  # The AnnotationIndex of the train images
+        self.eval_index = None  # The AnnotationIndex of the eval images
+        self.split = None  # The split manifest, the members of each split
+        self.image_groups = None  # The near-duplicate group of every image, None if the dedup stage is off
+        self.image_hashes = None  # The (dHashes, pHashes, hashed) of every image, None if the dedup stage is off
+        self.num_workers = None  # Number of worker processes for the dataset stages, None for the number of cores
+        self.num_shards = None  # Number of shards of each .record file, None for the number of workers
+        self.label_formats = ['csv', 'parquet']  # The formats of the exported labels: 'csv', 'parquet', 'arrow'
+        self.resize_max_side = None  # Downsize the encoded images to this longer side (e.g. 1024), None to keep them
+        self.jpeg_quality = 95  # The jpg quality of the downsized images
+        self.model_input_size = (640, 640)  # The (width, height) of the pipeline's image resizer, for the profile
+        # The compression of the archive copies of the .record shards: 'GZIP', 'ZLIB' or None for no copies.
+        # The training always reads the uncompressed shards, the input reader can't read compressed records
+        self.archive_compression = None
+        self.extract_dataset = True  # Extract the dataset zip, otherwise the stages read it straight from the zip
+        self.annotation_format = None  # The annotation format: 'voc', 'coco', 'yolo' or None to detect it
+        self.min_box_size = (1, 1)  # The minimum (width, height) of a box in pixels, None for no minimum
+        self.max_objects_per_image = None  # The maximum number of boxes of an image, None for no maximum
+        self.use_validation_cache = True  # Keep the validation results next to the dataset zip for the next ingest
+        self.dedup_distance = 6  # The max hash hamming distance of near-duplicate images, None to skip the dedup
+        # Keep a single image of every group of exact duplicates, the same bytes with the same labels
+        self.collapse_exact_duplicates = False
+        self.train_size = 0.8  # The part of the dataset used for training
+        self.split_seed = 42  # The random seed of the train/eval split
+        self.split_materialize = None  # Also create split directories: 'hardlink', 'symlink', 'copy' or None
+        self.stages = None  # The StageRunner of the dataset stages
 
     def handle_dataset(self):
         """
         Handle the entire dataset from zip to encoded.
 
+        Choosing the extracted data dir of a previous run resumes it,
+        the stages that already completed with the same inputs are skipped.
+
         :return: None
         """
-        self.__get_data()
-        self.__validate_data()
-        self.__split_data()
-        self.__encode_data()
+        self.__choose_data()
+        self.stages = StageRunner(self.extracted_dir)
+
+        num_shards = self.num_shards or self.num_workers or os.cpu_count() or 1  # The number of shards per record
+        get_hash = hash_inputs(file_identity(self.data_zip), self.extract_dataset)  # The inputs of each stage
+        validate_hash = hash_inputs(get_hash, self.annotation_format, self.min_box_size, self.max_objects_per_image)
+        dedup_hash = hash_inputs(validate_hash, self.dedup_distance, self.collapse_exact_duplicates)
+        split_hash = hash_inputs(dedup_hash, self.train_size, self.split_seed, self.split_materialize)
+        encode_hash = hash_inputs(split_hash, CLASSES_FILTER, self.label_formats, num_shards,
+                                  self.resize_max_side, self.jpeg_quality, self.archive_compression,
+                                  self.model_input_size)
+
+        rerun = False  # Once a stage runs, all the stages after it run too
+        for name, inputs_hash, func in (('get', get_hash, self.__get_data),
+                                        ('validate', validate_hash, self.__validate_data),
+                                        ('dedup', dedup_hash, self.__dedup_data),
+                                        ('split', split_hash, self.__split_data),
+                                        ('encode', encode_hash, self.__encode_data)):
+            outputs = None if rerun else self.stages.completed(name, inputs_hash)  # The outputs of a completed stage
+            if outputs is not None:
+                PrintUtils.info(f'Skipping the {name} stage, it already completed')
+                self.__restore_stage(name, outputs)
+                continue
+            rerun = True
+            outputs = func(self.stages.begin(name, inputs_hash))
+            self.stages.complete(name, **outputs)
+
+    def __restore_stage(self, name, outputs):
+        """
+        Restore the state a completed stage left, instead of running it again.
 
-    def __get_data(self):
+        :param name: The name of the stage
+        :param outputs: The outputs the stage recorded
+        :return: None
+        """
+        if name == 'get':
+            if self.extract_dataset:
+                self.source.extracted_at = outputs.get('extracted_at')
+        elif name == 'validate':
+            self.dataset_format = outputs.get('annotation_format', 'voc')
+            self.annotation_index = AnnotationIndex.load(os.path.join(self.extracted_dir, 'annotations_index.npz'))
+        elif name == 'dedup':
+            self.__apply_dedup(os.path.join(self.extracted_dir, 'image_hashes.npz') if outputs['enabled'] else None)
+        elif name == 'split':
+            self.split = load_split(os.path.join(self.extracted_dir, 'split.json'))
+            self.train_index = self.annotation_index.subset(self.split['train'])
+            self.eval_index = self.annotation_index.subset(self.split['eval'])
+            self.split_dir = outputs['split_dir']
+        elif name == 'encode':
+            self.__apply_manifest(outputs['encoded_dir'], load_manifest(outputs['encoded_dir']))
+
+    def load_encoded_dataset(self):
+        """
+        Load a dataset that was already encoded, from the manifest in its encoded directory.
+        Restores everything the training needs without extracting, validating or encoding the dataset again.
+        The user chooses the encoded directory.
+
+        :return: True if the dataset was loaded, False otherwise
+        """
+        PrintUtils.inputmsg('Select the encoded dataset folder')
+        encoded_dir = ask_directory(force=False, initialdir=os.getcwd(), title='Select encoded directory')
+        if encoded_dir == '' or encoded_dir is None:
+            return False
+        try:
+            manifest = load_manifest(encoded_dir)
+        except (ValueError, OSError, KeyError) as e:
+            PrintUtils.error(f'Unable to load the encoded dataset: {e}')
+            return False
+
+        self.__apply_manifest(encoded_dir, manifest)
+        PrintUtils.info(f'Loaded the encoded dataset from {encoded_dir}: '
+                        f'{self.num_train} train and {self.num_eval} eval examples, '
+                        'classes [{}]'.format(', '.join(manifest['classes'])))
+        return True
+
+    def append_batch(self):
+        """
+        Append a new batch of labelled images to an encoded dataset, without encoding the dataset again.
+        The batch zip has the layout of the dataset zip and goes through the same validation and dedup.
+        Every image goes to train or eval by a hash of its duplicate group, so the images already in the dataset
+        never move, and the batch is written to shards of its own next to the existing shards.
+        A group with a near-duplicate among the images of the dataset goes to the split of its duplicate,
+        and the batch images named like images of the dataset are left out.
+        The user chooses the encoded dataset if none is loaded, the batch zip and the directory for its files.
+
+        :return: True if the batch was appended, False otherwise
+        """
+        if self.manifest is None and not self.load_encoded_dataset():
+            return False
+
+        PrintUtils.inputmsg('Choose the zip file of the new batch')
+        batch_zip = ask_for_file(force=False, title='Select batch zip', initialdir=os.getcwd(),
+                                 filetypes=(('ZIP files', '*.zip'),))  # The batch zip file
+        if batch_zip == '' or batch_zip is None:
+            return False
+        batch_hash = file_hash(batch_zip)  # The content hash of the batch zip
+        if any(batch['hash'] == batch_hash for batch in self.manifest.get('batches', [])):
+            PrintUtils.error(f'{batch_zip} was already appended to the dataset')
+            return False
+
+        self.data_zip = batch_zip
+        PrintUtils.inputmsg('Choose an empty directory for the files of the batch')
+        self.extracted_dir = ask_empty_directory(force=True, initialdir=os.getcwd(), title='Select batch directory')
+        self.source = DirectorySource(self.extracted_dir, self.data_zip) if self.extract_dataset \
+            else ZipSource(self.data_zip)
+        self.__get_data({})
+        self.__validate_data({})
+
+        # Leave out the batch images named like images of the dataset, their examples couldn't be told apart
+        existing = load_images(self.manifest, self.encoded_dir)  # The images already in the dataset
+        if not self.manifest['image_files']:
+            PrintUtils.warning('The dataset has no images file, the batch is not checked against its images')
+        collisions = np.isin(self.annotation_index.filenames, existing['filenames'])  # The batch images to leave out
+        if np.any(collisions):
+            names = self.annotation_index.filenames[collisions].tolist()  # The colliding file names
+            PrintUtils.error(f'Leaving out {len(names)} batch images whose file names are already in the dataset: '
+                             '{}{}'.format(', '.join(names[:10]), ', ...' if len(names) > 10 else ''))
+            self.annotation_index = self.annotation_index.subset(np.flatnonzero(~collisions))
+        self.__dedup_data({})
+
+        # Assign the batch images to the splits, the images of a duplicate group share the key of the group
+        settings = self.manifest['settings']  # The settings the dataset was encoded with
+        filenames = self.annotation_index.filenames  # The file name of every image
+        keys = (filenames if self.image_groups is None else filenames[self.image_groups]).astype(object)
+        train = stable_split(keys, settings.get('train_size', self.train_size),
+                             settings.get('split_seed', self.split_seed))  # The images that go to train
+
+        # A group with a near-duplicate in the dataset joins the group and the split of the duplicate,
+        # the first encoding split the groups at random, so only the duplicate's split keeps the group together
+        if self.image_hashes is not None and np.any(existing['hashed']):
+            dhashes, phashes, hashed = self.image_hashes
+            matches = match_duplicates(dhashes, phashes, existing['dhashes'], existing['phashes'],
+                                       self.dedup_distance, hashed, existing['hashed'])  # The duplicate of every image
+            group_matches = {}  # The duplicate of every batch group that has one, of its first matching image
+            for i in np.flatnonzero(matches >= 0):
+                group_matches.setdefault(self.image_groups[i], matches[i])
+            for i, group in enumerate(self.image_groups):
+                match = group_matches.get(group)  # The duplicate of the image's group
+                if match is not None:
+                    keys[i] = existing['groups'][match]
+                    train[i] = existing['train'][match]
+            if group_matches:
+                PrintUtils.info(f'{int(np.sum(matches >= 0))} batch images are near-duplicates of images '
+                                'in the dataset, their groups go to the split of their duplicates')
+
+        label_to_id = self.manifest['classes']  # The label map of the dataset, the batch can't add classes
+        unknown = sorted(set(self.annotation_index.present_classes()) & set(CLASSES_FILTER) - set(label_to_id))
+        if unknown:
+            PrintUtils.warning('Leaving out the classes that are not in the label map: '
+                               '[{}]'.format(', '.join(unknown)))
+        classes = [clazz for clazz in CLASSES_FILTER if clazz in label_to_id]  # The encoded classes of the batch
+
+        generation = len(self.manifest.get('batches', [])) + 1  # The number of the batch's shards
+        splits = {}  # The (shard paths, number of examples, number of boxes) of every split of the batch
+        label_files = []  # The paths to the written label files of the batch
+        archive_files = []  # The paths to the compressed copies of the batch's shards
+        split_indexes = {}  # The labels of the batch images written to every split
+        for name, positions in (('train', np.flatnonzero(train)), ('eval', np.flatnonzero(~train))):
+            split_index = self.annotation_index.subset(positions).filter_classes(classes)  # The split's batch labels
+            if len(split_index) == 0:
+                continue
+            split_indexes[name] = split_index
+
+            labels_path = os.path.join(self.encoded_dir, f'{name}_labels-g{generation:04d}')
+            for label_format in self.label_formats:
+                if label_format == 'csv':
+                    write_labels_csv(split_index.iter_records(), labels_path + '.csv')
+                    label_files.append(labels_path + '.csv')
+                else:
+                    path = write_label_store(split_index, labels_path, label_format)
+                    if path is not None:
+                        label_files.append(path)
+
+            # Size the new shards like the existing shards of the split
+            split = self.manifest['splits'][name]  # The manifest entry of the split
+            per_shard = max(1, split['num_examples'] // max(1, len(split['shards'])))  # The examples per shard
+            # The path to the split's records without the shard suffix, the pattern without its -*
+            record_path = os.path.join(self.encoded_dir, os.path.basename(split['record_pattern'])[:-2])
+            archive_path = os.path.join(self.encoded_dir, 'archive', os.path.basename(record_path))
+            for path in generation_files(record_path, generation) + generation_files(archive_path, generation):
+                os.remove(path)  # Left by an append that failed before updating the manifest
+            PrintUtils.info(f'Creating {name} record files of the batch...')
+            shard_paths, count = write_sharded_records(split_index, 'images', label_to_id, self.source, record_path,
+                                                       -(-len(split_index) // per_shard),
+                                                       num_workers=self.num_workers,
+                                                       max_side=settings.get('resize_max_side'),
+                                                       jpeg_quality=settings.get('jpeg_quality', self.jpeg_quality),
+                                                       generation=generation)
+            PrintUtils.info(f'Wrote {count} {name} examples to {len(shard_paths)} shards')
+            if self.archive_compression is not None:
+                archive_files.extend(archive_records(shard_paths, self.archive_compression,
+                                                     os.path.join(self.encoded_dir, 'archive'), self.num_workers))
+            splits[name] = (shard_paths, count, split_index.num_boxes().sum())
+
+        if not splits:
+            PrintUtils.error('The batch has no valid images of the encoded classes')
+            return False
+        batch_images = images_path(self.encoded_dir, generation)  # The path to the images file of the batch
+        save_images(batch_images, **self.__encoded_images(split_indexes, keys))
+        append_batch(self.manifest, self.encoded_dir,
+                     {'generation': generation, 'dataset_zip': os.path.basename(batch_zip), 'hash': batch_hash},
+                     splits, label_files=label_files, archive_files=archive_files, image_files=[batch_images])
+        save_manifest(self.manifest, self.encoded_dir)
+        self.__apply_manifest(self.encoded_dir, self.manifest)
+        PrintUtils.info(f'Appended the batch, the dataset has {self.num_train} train and {self.num_eval} eval examples')
+        return True
+
+    def __apply_manifest(self, encoded_dir, manifest):
+        """
+        Set the encoded dataset state from its manifest.
+
+        :param encoded_dir: The path to the encoded directory
+        :param manifest: The manifest dict of the encoded directory
+        :return: None
+        """
+        self.manifest = manifest
+        self.encoded_dir = encoded_dir
+        self.label_map_path = manifest_path(encoded_dir, manifest['label_map']['path'])
+        self.train_record_path = manifest_path(encoded_dir, manifest['splits']['train']['record_pattern'])
+        self.eval_record_path = manifest_path(encoded_dir, manifest['splits']['eval']['record_pattern'])
+        self.num_train = manifest['splits']['train']['num_examples']
+        self.num_eval = manifest['splits']['eval']['num_examples']
+        self.archive_compression = manifest['archive']['compression']
+
+    def __choose_data(self):
         """
-        Gets the dataset zip from github or local and extracts it.
         The user chooses to download or use a local zip.
-        The user chooses where to extract the zip to.
+        The user chooses where to extract the zip to, an empty directory or the directory of a run to resume.
+        If extract_dataset is off the zip isn't extracted and the next stages read it in place.
 
         :return: None
         """
@@ -55,216 +326,346 @@ class DataHandler:
         #     PrintUtils.info('Finished downloading.')
         # else:
         PrintUtils.inputmsg('Choose the dataset zip file')
-        data_zip = ask_for_file(force=True, title='Select dataset zip', initialdir=os.getcwd(),
-                                filetypes=(('ZIP files', '*.zip'),))  # The dataset zip file
-
-        PrintUtils.inputmsg('Choose an empty directory where the data will be unzipped to')
-        self.extracted_dir = ask_empty_directory(force=True, initialdir=os.getcwd(), title='Select output directory')
-        extract_zip(data_zip, self.extracted_dir)
+        self.data_zip = ask_for_file(force=True, title='Select dataset zip', initialdir=os.getcwd(),
+                                     filetypes=(('ZIP files', '*.zip'),))  # The dataset zip file
+
+        if self.extract_dataset:
+            PrintUtils.inputmsg('Choose an empty directory where the data will be unzipped to, '
+                                'or the directory of a previous run to resume it')
+            self.extracted_dir = ask_resumable_directory(STATE_FILE, force=True, initialdir=os.getcwd(),
+                                                         title='Select output directory')
+            self.source = DirectorySource(self.extracted_dir, self.data_zip)
+        else:
+            PrintUtils.inputmsg('Choose an empty directory for the dataset files, '
+                                'or the directory of a previous run to resume it')
+            self.extracted_dir = ask_resumable_directory(STATE_FILE, force=True, initialdir=os.getcwd(),
+                                                         title='Select output directory')
+            self.source = ZipSource(self.data_zip)
+
+    def __get_data(self, resumed):
+        """
+        Gets the dataset zip from github or local and extracts it.
 
-    def __validate_data(self):
+        :param resumed: The partial outputs of an unfinished run of the stage
+        :return: The outputs of the stage
         """
-        Check the annotations in the dataset and delete the corrupted files.
+        # The stage runs again when the zip changed, the files of the previous zip must not mix with the new ones
+        self.__clear_working_dir()
+        if self.extract_dataset:
+            extract_zip(self.data_zip, self.extracted_dir, members_filter=self.__dataset_members(),
+                        progress=functools.partial(self.gui.report_progress, 'Extracting'),
+                        num_workers=self.num_workers)
+            # A file modified after this time isn't the zip's member any more, its zip CRC can't fingerprint it
+            self.source.extracted_at = time.time_ns()
+            return {'extracted_at': self.source.extracted_at}
+        PrintUtils.info('Reading the dataset straight from the zip file')
+        return {}
+
+    def __clear_working_dir(self):
+        """
+        Remove the extracted files and the stage outputs of a previous run from the working directory.
+        Only the files the pipeline writes are removed, and the state file is kept.
 
         :return: None
         """
-        PrintUtils.info('Validating dataset...')
-        images_dir = os.path.join(self.extracted_dir, 'images')  # The directory of the extracted images
-        anns_dir = os.path.join(self.extracted_dir, 'annotations')   # The directory of the extracted annotations
-        image_ext = 'jpg'  # The extention of the images
-
-        cnt = 0  # The count of the valid annotation files
-        err_cnt = 0  # The count of the error files
-        error_files = []  # A list of the files with errors
-        for xml_file in glob(anns_dir + '/*.xml'):
-            error = False  # If there is an error in the file
-
-            xml_file_name = os.path.split(xml_file)[1]  # The current file's name
-            try:
-                xml_tree = ET.parse(xml_file)  # The xml tree
-                xml_root = xml_tree.getroot()  # The root element of the xml file
-            except Exception:
-                PrintUtils.error(f'Error parsing file {xml_file_name}')
-                error = True
-
-            if not error:
-                try:
-                    filename = xml_root.find('filename').text  # The filename taken from the label file
-                except Exception:
-                    PrintUtils.error(f'Error in file {xml_file_name}, reading filename attribute ')
-                    error = True
-
-                try:
-                    img_width = int(xml_root.find('size').find('width').text)  # The image width taken from the label file
-                except Exception:
-                    PrintUtils.error(f'Error in file {xml_file_name}, reading width attribute')
-                    error = True
-
-                try:
-                    img_height = int(xml_root.find('size').find('height').text)  # The image height taken from the label file
-                except Exception:
-                    PrintUtils.error(f'Error in file {xml_file_name}, reading height attribute')
-                    error = True
-
-                try:
-                    xml_objects = xml_root.findall('object')  # The image's objects taken from the label file
-                except Exception:
-                    PrintUtils.error(f'Error in file {xml_file_name}, reading objects')
-                    error = True
-
-            if not error:
-                objects = []  # The objects in the current label file
-                for i, member in enumerate(xml_objects):
-                    obj_err = False  # There is an error in the current object
-
-                    try:
-                        clazz = member.find('name').text  # The class of the current object
-                    except Exception:
-                        PrintUtils.error(f'Error in file {xml_file_name}, object {i}, reading class name attribute')
-                        obj_err = True
-                        error = True
+        removed = False  # True if anything of a previous run was removed
+        for name in DATASET_DIRS:
+            path = os.path.join(self.extracted_dir, name)  # The path to the extracted directory
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                removed = True
+        for name in STAGE_FILES:
+            path = os.path.join(self.extracted_dir, name)  # The path to the stage output
+            if os.path.isfile(path):
+                os.remove(path)
+                removed = True
+        if removed:
+            PrintUtils.info(f'Removed the files of the previous run from {self.extracted_dir}')
+
+    def __dataset_members(self):
+        """
+        Get a filter of the dataset members worth extracting,
+        the annotation files and the images they point to, without any other files in the zip.
 
+        :return: A function that gets a member name and returns True if it should be extracted
+        """
+        with zipfile.ZipFile(self.data_zip, 'r') as zip_f:
+            names = zip_f.namelist()  # All the members of the zip
+            if (self.annotation_format or detect_format(names)) != 'voc':
+                # The bulk formats keep every label in a few files, keep the whole annotations and images directories
+                return lambda name: name.startswith('annotations/') or name.startswith('images/')
+
+            images = set()  # The member names of the images the annotation files point to
+            for name in names:
+                if name.startswith('annotations/') and name.endswith('.xml'):
                     try:
-                        if member.find('bndbox') is None:
-                            raise Exception
+                        images.add('images/' + ET.fromstring(zip_f.read(name)).find('filename').text + '.jpg')
                     except Exception:
-                        PrintUtils.error(f'Error in file {xml_file_name}, object {i}, reading bndbox attribute')
-                        obj_err = True
-                        error = True
-
-                    if not obj_err:
-                        try:
-                            xmin = int(member.find('bndbox').find('xmin').text)  # The left bound of the current object
-                        except Exception:
-                            PrintUtils.error(f'Error in file {xml_file_name}, object {i}, reading xmin attribute')
-                            obj_err = True
-                            error = True
-                        try:
-                            ymin = int(member.find('bndbox').find('ymin').text)  # The bottom bound of the current object
-                        except Exception:
-                            PrintUtils.error(f'Error in file {xml_file_name}, object {i}, reading ymin attribute')
-                            obj_err = True
-                            error = True
-                        try:
-                            xmax = int(member.find('bndbox').find('xmax').text)  # The right bound of the current object
-                        except Exception:
-                            PrintUtils.error(f'Error in file {xml_file_name}, object {i}, reading xmax attribute')
-                            obj_err = True
-                            error = True
-                        try:
-                            ymax = int(member.find('bndbox').find('ymax').text)  # The top bound of the current object
-                        except Exception:
-                            PrintUtils.error(f'Error in file {xml_file_name}, object {i}, reading ymax attribute')
-                            obj_err = True
-                            error = True
-
-                    if not obj_err:
-                        objects.append((clazz, xmin, ymin, xmax, ymax))
-
-            if not error:
-                try:
-                    img_path = os.path.join(images_dir, filename + '.' + image_ext)  # The path to the image file
-                    img = cv2.imread(img_path)  # The loaded image file
-                    if img is None:
-                        raise Exception
-                except Exception:
-                    PrintUtils.error(f'Error in file {xml_file_name}, filename attribute ')
-                    error = True
-
-            if not error:
-                org_height, org_width = img.shape[:2]  # The real image dimentions
-
-                if not org_width == img_width:
-                    PrintUtils.error(f'Error in file {xml_file_name}, width {img_width} != {org_width}')
-                    error = True
-                if not org_height == img_height:
-                    PrintUtils.error(f'Error in file {xml_file_name}, width {img_height} != {org_height}')
-                    error = True
-
-                for i, (clazz, xmin, ymin, xmax, ymax) in enumerate(objects):
-                    if xmin < 0 or xmin > org_width:
-                        PrintUtils.error(f'Error in file {xml_file_name}, object {i}, xmin value')
-                        error = True
-                    if ymin < 0 or ymin > org_height:
-                        PrintUtils.error(f'Error in file {xml_file_name}, object {i}, ymin value')
-                        error = True
-                    if xmax < 0 or xmax > org_width:
-                        PrintUtils.error(f'Error in file {xml_file_name}, object {i}, xmax value')
-                        error = True
-                    if ymax < 0 or ymax > org_height:
-                        PrintUtils.error(f'Error in file {xml_file_name}, object {i}, ymax value')
-                        error = True
-
-            if error:
-                PrintUtils.error(f'Error(s) in file {xml_file_name}')
-                error_files.append(xml_file)
-                err_cnt += 1
-            else:
-                cnt += 1
+                        pass  # The validation reports the broken annotation file
 
-        PrintUtils.info(f'Checked {cnt + err_cnt} files, {cnt} ok, found {err_cnt} errors')
-        PrintUtils.info('Deleting files with error: \n{}'.format('\n'.join(error_files)))
-        for file in error_files:
-            os.remove(file)
+        def members_filter(name):
+            return (name.startswith('annotations/') and name.endswith('.xml')) or name in images
+        return members_filter
 
-    def __split_data(self):
+    def __validate_data(self, resumed):
         """
-        Split the data to train and validation.
-        The user chooses the directory for the split data.
+        Check the annotations in the dataset and delete the corrupted files.
+        The annotations are Pascal VOC xml files, COCO json files or YOLO txt files,
+        the labels of every format go through the same checks against their images.
 
-        :return: None
+        :param resumed: The partial outputs of an unfinished run of the stage
+        :return: The outputs of the stage
         """
-        PrintUtils.inputmsg('Select an empty folder for the split dataset')
-        self.split_dir = ask_empty_directory(force=True, initialdir=os.getcwd(), title='Select split data directory')
+        PrintUtils.info('Validating dataset...')
+        images_dir = 'images'  # The directory of the images in the dataset
+        anns_dir = 'annotations'  # The directory of the annotations in the dataset
+        image_ext = 'jpg'  # The extention of the images
 
-        anns_dir = os.path.join(self.extracted_dir, 'annotations')  # The directory of the extracted annotations
+        annotation_format = self.annotation_format or detect_format(self.source.list(anns_dir, ''), anns_dir)
+        PrintUtils.info(f'Annotation format: {annotation_format}')
+        self.dataset_format = annotation_format
 
-        train_dir = os.path.join(self.split_dir, 'training/')  # The directory of the split train data
-        eval_dir = os.path.join(self.split_dir, 'evaluating/')  # The directory of the split eval data
+        error_files = []  # A list of the files with errors
+        record_files = []  # The annotation file of each record
+        cache = None  # The validation cache, only for the VOC files
+        if self.use_validation_cache and annotation_format == 'voc':
+            cache = ValidationCache(os.path.join(os.path.dirname(self.data_zip), 'validation_cache.sqlite'))
+        new_entries = []  # The validation results to store in the cache
+
+        if annotation_format == 'voc':
+            xml_files = self.source.list(anns_dir, '.xml')  # All of the annotation files, sorted for determinism
+            results = validate_annotations(self.source, xml_files, images_dir, image_ext, num_workers=self.num_workers,
+                                           cache_path=None if cache is None else cache.path)
+        elif annotation_format == 'coco':
+            def coco_entries():
+                # The labels of all the images in the COCO files, streamed into the validation a file at a time
+                for coco_file in self.source.list(anns_dir, '.json'):
+                    PrintUtils.info(f'Reading {coco_file}...')
+                    yield from iter_coco_entries(self.source, coco_file)
+            results = validate_entries(self.source, coco_entries(), images_dir, num_workers=self.num_workers)
+        elif annotation_format == 'yolo':
+            class_names = read_yolo_classes(self.source, anns_dir)  # The class names of the YOLO labels
+            txt_files = [name for name in self.source.list(anns_dir, '.txt')
+                         if name != anns_dir + '/' + YOLO_CLASSES_FILE]  # All of the label files
+            results = validate_yolo_labels(self.source, txt_files, class_names, images_dir, image_ext,
+                                           num_workers=self.num_workers)
+        else:
+            PrintUtils.error(f'No annotations found in {anns_dir}')
+            results = []
+
+        def valid_records():
+            # Report the results as they arrive and pass the parsed annotations straight to the index,
+            # so the parsed records of the whole dataset are never held at once
+            for result in results:
+                for message in result.errors:
+                    PrintUtils.error(message)
+
+                if cache is not None:
+                    if result.cache_hit:
+                        cache.hits += 1
+                    else:
+                        cache.misses += 1
+                        new_entries.append(result.cache_entry)
+                        if len(new_entries) >= CACHE_WRITE_BATCH:
+                            cache.put_many(new_entries)
+                            new_entries.clear()
+
+                if result.valid:
+                    record_files.append(result.xml_file)
+                    yield result.record
+                else:
+                    error_files.append(result.xml_file)
+
+        annotation_index = AnnotationIndex.from_records(valid_records())  # The parsed annotations of the valid files
+        cnt = len(annotation_index)  # The count of the valid annotation files
+        err_cnt = len(error_files)  # The count of the error files
+
+        if cache is not None:
+            cache.put_many(new_entries)
+            cache.close()
+            PrintUtils.info(f'Validation cache: {cache.hits} hits, {cache.misses} misses')
+
+        # Check the geometry of all the boxes at once
+        min_width, min_height = self.min_box_size or (None, None)
+        rule_errors, keep_boxes = evaluate_rules(annotation_index, min_width, min_height, self.max_objects_per_image)
+        num_duplicates = int(np.sum(~keep_boxes))  # The number of dropped duplicate boxes
+        if num_duplicates:
+            PrintUtils.warning(f'Dropped {num_duplicates} duplicate boxes')
+        for image in sorted(rule_errors):
+            for message in rule_errors[image]:
+                PrintUtils.error(message)
+            PrintUtils.error(f'Error(s) in file {annotation_index.xml_names[image]}')
+            error_files.append(record_files[image])
+        cnt -= len(rule_errors)
+        err_cnt += len(rule_errors)
+        valid_images = np.setdiff1d(np.arange(len(annotation_index)), list(rule_errors))  # The images without errors
 
-        os.mkdir(train_dir)
-        os.mkdir(eval_dir)
+        PrintUtils.info(f'Checked {cnt + err_cnt} files, {cnt} ok, found {err_cnt} errors')
+        if self.source.can_remove() and annotation_format != 'coco':
+            PrintUtils.info('Deleting files with error: \n{}'.format('\n'.join(error_files)))
+            for file in error_files:
+                self.source.remove(file)
+        else:
+            PrintUtils.info('Leaving files with error out of the dataset: \n{}'.format('\n'.join(error_files)))
+
+        # Save the parsed annotations so the next stages don't parse the files again
+        self.annotation_index = annotation_index.filter_boxes(keep_boxes, drop_empty=False).subset(valid_images)
+        self.annotation_index.save(os.path.join(self.extracted_dir, 'annotations_index.npz'))
+        return {'num_valid': cnt, 'num_errors': err_cnt, 'annotation_format': annotation_format}
+
+    def __dedup_data(self, resumed):
+        """
+        Find the duplicate and near-duplicate images of the dataset by their perceptual hashes.
+        The near-duplicate groups are kept for the split, so every group goes entirely to train or to eval.
+        If collapse_exact_duplicates is set, the exact duplicates (the same bytes with the same labels)
+        are left out of the dataset.
 
-        files = glob(anns_dir + '/*.xml')  # All of the annotation files
-        train, eval = train_test_split(files, train_size=0.8, test_size=0.2, shuffle=True, random_state=42)
-        PrintUtils.info(f'Train size: {len(train)}')
-        PrintUtils.info(f'Eval size: {len(eval)}')
+        :param resumed: The partial outputs of an unfinished run of the stage
+        :return: The outputs of the stage
+        """
+        if self.dedup_distance is None:
+            self.__apply_dedup(None)
+            return {'enabled': False}
+
+        PrintUtils.info('Hashing the images to find duplicates...')
+        image_files = ['images/' + filename for filename in self.annotation_index.filenames]  # The image members
+        dhashes, phashes, content_hashes, hashed = compute_hashes(self.source, image_files,
+                                                                  num_workers=self.num_workers)
+        keep = np.ones(len(image_files), dtype=bool)  # The images left in the dataset
+        if self.collapse_exact_duplicates:
+            keep, num_conflicts = collapse_exact_duplicates(content_hashes, label_keys(self.annotation_index), hashed)
+            if num_conflicts:
+                PrintUtils.warning(f'Kept {num_conflicts} images that have the same bytes as another image '
+                                   f'with different labels')
+        groups = find_duplicate_groups(dhashes[keep], phashes[keep], self.dedup_distance, hashed[keep])
+
+        hashes_path = os.path.join(self.extracted_dir, 'image_hashes.npz')  # The path to the hashes file
+        np.savez(hashes_path, filenames=self.annotation_index.filenames, dhashes=dhashes, phashes=phashes,
+                 content_hashes=content_hashes, hashed=hashed, keep=keep, groups=groups)
+        self.__apply_dedup(hashes_path)
+
+        num_grouped = int(np.sum(np.bincount(groups) > 1))  # The number of groups with more than one image
+        PrintUtils.info(f'Left out {int(np.sum(~keep))} exact duplicate images, '
+                        f'found {num_grouped} groups of near-duplicate images')
+        return {'enabled': True, 'num_removed': int(np.sum(~keep)), 'num_groups': num_grouped}
+
+    def __apply_dedup(self, hashes_path):
+        """
+        Leave the exact duplicates out of the annotation index and set the near-duplicate groups.
 
-        PrintUtils.info(f'Copying training files to {train_dir}')
-        for file in train:
-            shutil.copy(file, train_dir)
+        :param hashes_path: The path to the hashes file of the dedup stage, None if the stage is off
+        :return: None
+        """
+        if hashes_path is None:
+            self.image_groups = None
+            self.image_hashes = None
+            return
+        with np.load(hashes_path) as hashes:
+            keep = hashes['keep']  # The images left in the dataset
+            self.annotation_index = self.annotation_index.subset(np.flatnonzero(keep))
+            self.image_groups = hashes['groups']
+            self.image_hashes = (hashes['dhashes'][keep], hashes['phashes'][keep], hashes['hashed'][keep])
+
+    def __encoded_images(self, split_indexes, keys):
+        """
+        Describe the images written to the record shards, for the images file of the manifest.
 
-        PrintUtils.info(f'Copying eval files to {eval_dir}')
-        for file in eval:
-            shutil.copy(file, eval_dir)
+        :param split_indexes: A dict of split name to the AnnotationIndex of the images written to its shards
+        :param keys: The near-duplicate group key of every image of the annotation index
+        :return: A dict of the arrays of dataset_manifest.save_images
+        """
+        position = {filename: i for i, filename in enumerate(self.annotation_index.filenames)}  # By file name
+        positions = np.array([position[filename] for split_index in split_indexes.values()
+                              for filename in split_index.filenames], dtype=np.int64)  # The positions of the images
+        train = np.array([name == 'train' for name, split_index in split_indexes.items()
+                          for _ in range(len(split_index))], dtype=bool)  # The images in the train shards
+        if self.image_hashes is None:
+            dhashes = phashes = np.zeros(len(self.annotation_index), dtype=np.uint64)
+            hashed = np.zeros(len(self.annotation_index), dtype=bool)
+        else:
+            dhashes, phashes, hashed = self.image_hashes
+        return {'filenames': self.annotation_index.filenames[positions], 'train': train,
+                'groups': np.asarray(keys, dtype=str)[positions], 'dhashes': dhashes[positions],
+                'phashes': phashes[positions], 'hashed': hashed[positions]}
+
+    def __split_data(self, resumed):
+        """
+        Split the data to train and validation.
+        The split is saved as a manifest next to the annotation index.
+        If split_materialize is set, the user chooses the directory for the split data files.
 
-    def __encode_data(self):
+        :param resumed: The partial outputs of an unfinished run of the stage
+        :return: The outputs of the stage
+        """
+        self.split = create_split(self.annotation_index, train_size=self.train_size, seed=self.split_seed,
+                                  groups=self.image_groups)
+        self.train_index = self.annotation_index.subset(self.split['train'])
+        self.eval_index = self.annotation_index.subset(self.split['eval'])
+        PrintUtils.info(f'Train size: {len(self.train_index)}')
+        PrintUtils.info(f'Eval size: {len(self.eval_index)}')
+
+        split_path = os.path.join(self.extracted_dir, 'split.json')  # The path to the split manifest
+        save_split(self.split, split_path)
+        PrintUtils.info(f'Split manifest saved to {split_path}')
+        self.split_dir = self.extracted_dir
+
+        if self.split_materialize is not None and self.dataset_format == 'coco':
+            PrintUtils.warning('The COCO labels are in a single file, skipping the split directories')
+        elif self.split_materialize is not None:
+            PrintUtils.inputmsg('Select an empty folder for the split dataset')
+            self.split_dir = ask_empty_directory(force=True, initialdir=os.getcwd(),
+                                                 title='Select split data directory')
+            PrintUtils.info(f'Creating the split directories in {self.split_dir} ({self.split_materialize})')
+            materialize_split(self.split, self.source, 'annotations', self.split_dir, self.split_materialize)
+        return {'split_dir': self.split_dir}
+
+    def __encode_data(self, resumed):
         """
-        Encode the split labels to csv files.
+        Encode the split labels to csv (and parquet) files.
         then encode to tensorflow record files.
         Creates the label_map.pbtxt.
 
-        The user chooses the directory for the encoded files.
-        :return: None
+        The user chooses the directory for the encoded files,
+        if an unfinished run of the stage already chose one, it's reused and the finished shards are kept.
+        :param resumed: The partial outputs of an unfinished run of the stage
+        :return: The outputs of the stage
         """
-        PrintUtils.inputmsg('Select an empty folder for the encoded dataset')
-        self.encoded_dir = ask_empty_directory(force=True, initialdir=os.getcwd(), title='Select encoded directory')
-
-        train_dir = os.path.join(self.split_dir, 'training/')  # The directory of the train data
-        eval_dir = os.path.join(self.split_dir, 'evaluating/')  # The directory of the eval data
-
-        train_df, classes_train = xml_to_csv(train_dir, ['pistol'])  # All of the train data converted to csv
-        eval_df, classes_eval = xml_to_csv(eval_dir, ['pistol'])  # All of the eval data converted to csv
-
-        # Convert train and eval data to csv
-        PrintUtils.info('Converting train labels to csv...')
-        train_df.to_csv(os.path.join(self.encoded_dir, 'train_labels.csv'), index=None)
-        PrintUtils.info('Converting eval labels to csv...')
-        eval_df.to_csv(os.path.join(self.encoded_dir, 'eval_labels.csv'), index=None)
+        self.encoded_dir = resumed.get('encoded_dir')
+        if self.encoded_dir is not None and os.path.isdir(self.encoded_dir):
+            PrintUtils.info(f'Resuming the encoding in {self.encoded_dir}')
+        else:
+            PrintUtils.inputmsg('Select an empty folder for the encoded dataset')
+            self.encoded_dir = ask_empty_directory(force=True, initialdir=os.getcwd(),
+                                                   title='Select encoded directory')
+            self.stages.update('encode', encoded_dir=self.encoded_dir)
+
+        train_index = self.train_index.filter_classes(CLASSES_FILTER)  # The train labels of the filtered classes
+        eval_index = self.eval_index.filter_classes(CLASSES_FILTER)  # The eval labels of the filtered classes
+
+        # Convert train and eval data to the label formats
+        label_files = []  # The paths to the written label files
+        for name, split_index in (('train', train_index), ('eval', eval_index)):
+            labels_path = os.path.join(self.encoded_dir, f'{name}_labels')  # The labels path without the extension
+            for label_format in self.label_formats:
+                PrintUtils.info(f'Converting {name} labels to {label_format}...')
+                if label_format == 'csv':
+                    write_labels_csv(split_index.iter_records(), labels_path + '.csv')
+                    label_files.append(labels_path + '.csv')
+                else:
+                    path = write_label_store(split_index, labels_path, label_format)
+                    if path is not None:
+                        label_files.append(path)
+
+        # Profile the train labels, the boxes distributions and the suggested anchors
+        PrintUtils.info('Profiling the train labels...')
+        profile = profile_index(train_index, input_size=self.model_input_size)  # The statistics of the train labels
+        for line in summarize_profile(profile):
+            PrintUtils.info(line)
+        save_profile(profile, os.path.join(self.encoded_dir, 'dataset_profile.json'))
 
         # Create the label_map.pbtxt
         PrintUtils.info('Creating label map file...')
-        classes = list(set(classes_train + classes_eval))
+        classes = sorted(set(train_index.present_classes() + eval_index.present_classes()))
         PrintUtils.info('Classes found: [{}]'.format(', '.join(classes)))
         pbtxt_content, label_to_id = create_pbtxt(classes)
         self.label_map_path = os.path.join(self.encoded_dir, 'label_map.pbtxt')
@@ -272,28 +673,54 @@ class DataHandler:
             f.write(pbtxt_content)
 
         # Create the record files
-        data_f = namedtuple('data', ['filename', 'object'])
-        self.train_record_path = os.path.join(self.encoded_dir, 'train_labels.record')
-        self.eval_record_path = os.path.join(self.encoded_dir, 'eval_labels.record')
+        if self.resize_max_side is not None:
+            PrintUtils.info(f'Downsizing the images to a longer side of {self.resize_max_side} '
+                            f'(jpg quality {self.jpeg_quality})')
+        self.train_record_path = shard_pattern(os.path.join(self.encoded_dir, 'train_labels.record'))
+        self.eval_record_path = shard_pattern(os.path.join(self.encoded_dir, 'eval_labels.record'))
+        num_shards = self.num_shards or self.num_workers or os.cpu_count() or 1  # The number of shards per record
 
         # Create the train record files
         PrintUtils.info('Creating train record files...')
-        gb = train_df.groupby('filename')
-        data = [data_f(filename, gb.get_group(x)) for filename, x in zip(gb.groups.keys(), gb.groups)]
-        self.num_train = 0
-        with tf.io.TFRecordWriter(self.train_record_path) as writer:
-            for d in data:
-                tf_example = create_tf_example(d, os.path.join(self.extracted_dir, 'images'), label_to_id)
-                writer.write(tf_example.SerializeToString())
-                self.num_train += 1
+        train_shards, self.num_train = write_sharded_records(train_index, 'images', label_to_id, self.source,
+                                                       os.path.join(self.encoded_dir, 'train_labels.record'),
+                                                       num_shards, num_workers=self.num_workers,
+                                                       max_side=self.resize_max_side, jpeg_quality=self.jpeg_quality,
+                                                       resume=True)
+        PrintUtils.info(f'Wrote {self.num_train} train examples to {len(train_shards)} shards')
 
         # Create the eval record files
         PrintUtils.info('Creating eval record files...')
-        gb = eval_df.groupby('filename')
-        data = [data_f(filename, gb.get_group(x)) for filename, x in zip(gb.groups.keys(), gb.groups)]
-        self.num_eval = 0
-        with tf.io.TFRecordWriter(self.eval_record_path) as writer:
-            for d in data:
-                tf_example = create_tf_example(d, os.path.join(self.extracted_dir, 'images'), label_to_id)
-                writer.write(tf_example.SerializeToString())
-                self.num_eval += 1
+        eval_shards, self.num_eval = write_sharded_records(eval_index, 'images', label_to_id, self.source,
+                                                      os.path.join(self.encoded_dir, 'eval_labels.record'),
+                                                      num_shards, num_workers=self.num_workers,
+                                                      max_side=self.resize_max_side, jpeg_quality=self.jpeg_quality,
+                                                      resume=True)
+        PrintUtils.info(f'Wrote {self.num_eval} eval examples to {len(eval_shards)} shards')
+
+        # Archive the record files, compressed copies to store or transfer the dataset, the training doesn't read them
+        archive_files = []  # The paths to the compressed copies of the shards
+        if self.archive_compression is not None:
+            archive_files = archive_records(train_shards + eval_shards, self.archive_compression,
+                                            os.path.join(self.encoded_dir, 'archive'), self.num_workers)
+
+        # Save the names, splits, groups and hashes of the encoded images, a new batch is checked against them
+        filenames = self.annotation_index.filenames  # The file name of every image
+        keys = filenames if self.image_groups is None else filenames[self.image_groups]  # The group key of every image
+        images_file = images_path(self.encoded_dir)  # The path to the images file
+        save_images(images_file, **self.__encoded_images({'train': train_index, 'eval': eval_index}, keys))
+
+        # Create the manifest, so the next sessions can load the encoded dataset without the previous stages
+        PrintUtils.info('Creating the dataset manifest...')
+        self.manifest = create_manifest(
+            self.encoded_dir, self.label_map_path, label_to_id,
+            {'train': (self.train_record_path, train_shards, self.num_train, train_index.num_boxes().sum()),
+             'eval': (self.eval_record_path, eval_shards, self.num_eval, eval_index.num_boxes().sum())},
+            label_files=label_files, archive_files=archive_files, archive_compression=self.archive_compression,
+            image_files=[images_file],
+            settings={'dataset_zip': os.path.basename(self.data_zip), 'num_shards': num_shards,
+                      'resize_max_side': self.resize_max_side, 'jpeg_quality': self.jpeg_quality,
+                      'split_seed': self.split_seed, 'train_size': self.train_size})
+        PrintUtils.info(f'Manifest saved to {save_manifest(self.manifest, self.encoded_dir)}')
+
+        return {'encoded_dir': self.encoded_dir}
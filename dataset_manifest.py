@@ -0,0 +1,218 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from validation_cache import file_hash
+
+"""
+This is the manifest of an encoded dataset.
+It describes everything the training needs, the record shards, the label map, the example and box counts
+and the content hash of every file, so a new session can train on the dataset without encoding it again.
+The record shards are uncompressed, the compressed copies to archive or transfer the dataset are listed in its archive.
+The paths are relative to the encoded directory, so the directory can be moved.
+New batches of images are appended as shards of their own, listed in the manifest's batches.
+The file name, split, duplicate group and hashes of every encoded image are kept in image files next to the shards,
+so a new batch is checked against the images that are already in the dataset.
+"""
+
+MANIFEST_FILE = 'dataset_manifest.json'  # The name of the manifest file in the encoded directory
+MANIFEST_VERSION = 1  # The version of the manifest format
+IMAGES_FILE = 'dataset_images'  # The name of the images file of the encoded images, without the extension
+IMAGE_ARRAYS = {'filenames': str, 'train': bool, 'groups': str, 'dhashes': np.uint64, 'phashes': np.uint64,
+                'hashed': bool}  # The arrays of an images file and their types
+
+def describe_file(path, encoded_dir):
+    """
+    Describe a single file of the encoded dataset.
+
+    :param path: The path to the file
+    :param encoded_dir: The path to the encoded directory
+    :return: The file's entry: relative path, size and content hash
+    """
+    return {'path': os.path.relpath(path, encoded_dir).replace(os.path.sep, '/'),
+            'size': os.path.getsize(path), 'hash': file_hash(path)}
+
+def create_manifest(encoded_dir, label_map_path, label_to_id, splits, label_files=(), settings=None,
+                    archive_files=(), archive_compression=None, image_files=()):
+    """
+    Create the manifest of an encoded dataset, hashing the files on a thread pool.
+
+    :param encoded_dir: The path to the encoded directory
+    :param label_map_path: The path to the label_map.pbtxt file
+    :param label_to_id: A dict converting label string to id
+    :param splits: A dict of split name to (record pattern, shard paths, number of examples, number of boxes)
+    :param label_files: The paths to the exported label files
+    :param settings: A dict of the encoding settings, e.g. the resize and shards settings
+    :param archive_files: The paths to the compressed copies of the record shards
+    :param archive_compression: The compression of the copies, 'GZIP', 'ZLIB' or None without copies
+    :param image_files: The paths to the images files of the encoded images, see save_images
+    :return: The manifest dict
+    """
+    paths = [label_map_path] + list(label_files) + list(archive_files) + list(image_files)  # All the files to describe
+    for _, shard_paths, _, _ in splits.values():
+        paths.extend(shard_paths)
+    with ThreadPoolExecutor(max_workers=min(8, len(paths))) as executor:
+        files = dict(zip(paths, executor.map(describe_file, paths, [encoded_dir] * len(paths))))
+
+    return {
+        'version': MANIFEST_VERSION,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'label_map': files[label_map_path],
+        'classes': label_to_id,
+        'splits': {name: {'record_pattern': os.path.relpath(pattern, encoded_dir).replace(os.path.sep, '/'),
+                          'num_examples': int(num_examples), 'num_boxes': int(num_boxes),
+                          'shards': [files[path] for path in shard_paths]}
+                   for name, (pattern, shard_paths, num_examples, num_boxes) in splits.items()},
+        'label_files': [files[path] for path in label_files],
+        'archive': {'compression': archive_compression, 'files': [files[path] for path in archive_files]},
+        'image_files': [files[path] for path in image_files],
+        'settings': settings or {},
+    }
+
+def append_batch(manifest, encoded_dir, batch, splits, label_files=(), archive_files=(), image_files=()):
+    """
+    Add the shards of a new batch of images to the manifest of an encoded dataset.
+    The files that are already in the manifest aren't touched or hashed again.
+
+    :param manifest: The manifest dict, it's updated in place
+    :param encoded_dir: The path to the encoded directory
+    :param batch: A dict describing the batch, e.g. its zip file and generation
+    :param splits: A dict of split name to (shard paths, number of examples, number of boxes) of the batch
+    :param label_files: The paths to the exported label files of the batch
+    :param archive_files: The paths to the compressed copies of the batch's shards
+    :param image_files: The paths to the images files of the batch, see save_images
+    :return: The manifest dict
+    """
+    paths = list(label_files) + list(archive_files) + list(image_files)  # All the new files to describe
+    for shard_paths, _, _ in splits.values():
+        paths.extend(shard_paths)
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(paths)))) as executor:
+        files = dict(zip(paths, executor.map(describe_file, paths, [encoded_dir] * len(paths))))
+
+    for name, (shard_paths, num_examples, num_boxes) in splits.items():
+        split = manifest['splits'][name]  # The manifest entry of the split
+        split['num_examples'] += int(num_examples)
+        split['num_boxes'] += int(num_boxes)
+        split['shards'].extend(files[path] for path in shard_paths)
+    manifest['label_files'].extend(files[path] for path in label_files)
+    manifest['archive']['files'].extend(files[path] for path in archive_files)
+    manifest['image_files'].extend(files[path] for path in image_files)
+    manifest.setdefault('batches', []).append(dict(batch, created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                   num_examples={name: int(num_examples) for name, (_, num_examples, _)
+                                                                 in splits.items()}))
+    return manifest
+
+def save_manifest(manifest, encoded_dir):
+    """
+    Save a manifest to the encoded directory.
+
+    :param manifest: The manifest dict
+    :param encoded_dir: The path to the encoded directory
+    :return: The path to the manifest file
+    """
+    path = os.path.join(encoded_dir, MANIFEST_FILE)  # The path to the manifest file
+    # Write a temporary file and rename it, an append that fails midway leaves the previous manifest
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, path)
+    return path
+
+def load_manifest(encoded_dir, verify_hashes=False):
+    """
+    Load the manifest of an encoded directory and check its files.
+    By default only the sizes of the files are checked, which takes no time even for a large dataset.
+
+    :param encoded_dir: The path to the encoded directory
+    :param verify_hashes: Also check the content hash of every file
+    :return: The manifest dict
+    :raises ValueError: If the manifest is missing or doesn't match the files
+    """
+    path = os.path.join(encoded_dir, MANIFEST_FILE)  # The path to the manifest file
+    if not os.path.isfile(path):
+        raise ValueError(f'{encoded_dir} has no {MANIFEST_FILE}')
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version {}'.format(manifest.get('version')))
+    if manifest.get('compression') is not None:
+        raise ValueError('The record shards are {} compressed, the training reads uncompressed shards, '
+                         'encode the dataset again'.format(manifest['compression']))
+    manifest.setdefault('archive', {'compression': None, 'files': []})
+    manifest.setdefault('image_files', [])  # Missing in the manifests of the datasets encoded before them
+
+    # The archive copies aren't checked, the training doesn't read them and they may be moved away
+    entries = [manifest['label_map']] + manifest['label_files'] + manifest['image_files']  # All the described files
+    for split in manifest['splits'].values():
+        entries.extend(split['shards'])
+    for entry in entries:
+        file_path = manifest_path(encoded_dir, entry['path'])
+        if not os.path.isfile(file_path):
+            raise ValueError(f'Missing file {entry["path"]}')
+        if os.path.getsize(file_path) != entry['size']:
+            raise ValueError(f'The size of {entry["path"]} changed')
+
+    if verify_hashes:
+        paths = [manifest_path(encoded_dir, entry['path']) for entry in entries]
+        with ThreadPoolExecutor(max_workers=min(8, len(paths))) as executor:
+            for entry, digest in zip(entries, executor.map(file_hash, paths)):
+                if digest != entry['hash']:
+                    raise ValueError(f'The content of {entry["path"]} changed')
+    return manifest
+
+def manifest_path(encoded_dir, relative_path):
+    """
+    Get the full path of a path in the manifest.
+
+    :param encoded_dir: The path to the encoded directory
+    :param relative_path: The path relative to the encoded directory, as saved in the manifest
+    :return: The full path
+    """
+    return os.path.join(encoded_dir, *relative_path.split('/'))
+
+def images_path(encoded_dir, generation=None):
+    """
+    Get the path to an images file of the encoded dataset.
+
+    :param encoded_dir: The path to the encoded directory
+    :param generation: The number of the appended batch, None for the images of the first encoding
+    :return: The path, e.g. dataset_images.npz or dataset_images-g0002.npz
+    """
+    suffix = '' if generation is None else '-g{:04d}'.format(generation)  # The suffix of the batch's file
+    return os.path.join(encoded_dir, IMAGES_FILE + suffix + '.npz')
+
+def save_images(path, **images):
+    """
+    Save the encoded images of the first encoding or of a batch, an entry for every image in the record shards.
+    The arrays are, by IMAGE_ARRAYS:
+    filenames, the file name of every image; train, True for the images in the train shards;
+    groups, the near-duplicate group key of every image, the file name of the group's first image;
+    dhashes and phashes, the hashes of every image; hashed, False for the images without hashes.
+
+    :param path: The path to the images file, see images_path
+    :param images: The arrays of the images, an array for every key of IMAGE_ARRAYS
+    :return: None
+    """
+    # Write a temporary file and rename it, like the manifest
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **{key: np.asarray(images[key], dtype=dtype) for key, dtype in IMAGE_ARRAYS.items()})
+    os.replace(temp_path, path)
+
+def load_images(manifest, encoded_dir):
+    """
+    Load the encoded images of all the images files of a manifest.
+
+    :param manifest: The manifest dict
+    :param encoded_dir: The path to the encoded directory
+    :return: A dict of the concatenated arrays, by IMAGE_ARRAYS
+    """
+    parts = {key: [np.array([], dtype=dtype)] for key, dtype in IMAGE_ARRAYS.items()}  # The arrays of every file
+    for entry in manifest.get('image_files', []):
+        with np.load(manifest_path(encoded_dir, entry['path'])) as images:
+            for key in IMAGE_ARRAYS:
+                parts[key].append(images[key])
+    return {key: np.concatenate(arrays) for key, arrays in parts.items()}
@@ -0,0 +1,197 @@
+import json
+
+import numpy as np
+
+"""
+This is the statistics profiler of the dataset's labels.
+It computes the distributions of the boxes and images from the columns of an annotation index, without a loop
+over the images, and suggests the anchors of the SSD FPN anchor generator from a k-means over the box shapes.
+The box shapes are measured in the model's input space, after the fixed shape resizer of the pipeline config.
+"""
+
+FPN_LEVELS = (3, 7)  # The lowest and highest FPN levels the ResNet FPN feature extractor supports
+
+def box_shapes(annotation_index, input_size=(640, 640)):
+    """
+    Get the width and height of every box in the model's input space.
+
+    :param annotation_index: The AnnotationIndex of the labels
+    :param input_size: The (width, height) the pipeline's image resizer resizes the images to
+    :return: A (num boxes, 2) numpy array of the boxes' (width, height) in input pixels
+    """
+    image_of_box = np.repeat(np.arange(len(annotation_index)), annotation_index.num_boxes())  # The image of each box
+    boxes = annotation_index.boxes  # The boxes of all the images
+    widths = (boxes['xmax'] - boxes['xmin']) / annotation_index.widths[image_of_box] * input_size[0]
+    heights = (boxes['ymax'] - boxes['ymin']) / annotation_index.heights[image_of_box] * input_size[1]
+    return np.stack([widths, heights], axis=1).astype(np.float64)
+
+def histogram(values, bins=20, log=False):
+    """
+    Get the histogram of values as a json friendly dict.
+
+    :param values: A numpy array of the values
+    :param bins: The number of bins
+    :param log: Use log spaced bins, for values like aspect ratios
+    :return: A dict of the bin edges, the counts and the percentiles of the values
+    """
+    if len(values) == 0:
+        return {'edges': [], 'counts': [], 'percentiles': {}}
+    if log:
+        edges = np.geomspace(values.min(), values.max(), bins + 1) if values.min() < values.max() else bins
+    else:
+        edges = bins
+    counts, edges = np.histogram(values, bins=edges)
+    percentiles = np.percentile(values, [1, 5, 25, 50, 75, 95, 99])  # The percentiles of the values
+    return {'edges': np.round(edges, 4).tolist(), 'counts': counts.tolist(),
+            'percentiles': {str(p): round(float(v), 4) for p, v in zip((1, 5, 25, 50, 75, 95, 99), percentiles)}}
+
+def iou_matrix(shapes, centroids):
+    """
+    Get the IoU of every box shape with every centroid shape, as if they had the same center.
+
+    :param shapes: A (n, 2) numpy array of (width, height)
+    :param centroids: A (k, 2) numpy array of (width, height)
+    :return: A (n, k) numpy array of the IoUs
+    """
+    intersection = (np.minimum(shapes[:, None, 0], centroids[None, :, 0]) *
+                    np.minimum(shapes[:, None, 1], centroids[None, :, 1]))
+    union = (shapes[:, 0] * shapes[:, 1])[:, None] + (centroids[:, 0] * centroids[:, 1])[None, :] - intersection
+    return intersection / union
+
+def kmeans_shapes(shapes, k=6, max_iterations=300, seed=42):
+    """
+    Cluster the box shapes with k-means on a 1 - IoU distance, the anchor clustering of YOLOv2.
+    The centroids start with k-means++ and every iteration is a single matrix operation over all the boxes.
+
+    :param shapes: A (n, 2) numpy array of the boxes' (width, height)
+    :param k: The number of clusters
+    :param max_iterations: The max number of iterations
+    :param seed: The random seed of the initial centroids
+    :return: The (k, 2) centroids sorted by area and the mean IoU of the boxes with their centroid
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(np.unique(shapes, axis=0)))
+    centroids = shapes[rng.integers(len(shapes))][None, :]  # The centroids chosen so far
+    while len(centroids) < k:
+        distances = 1 - iou_matrix(shapes, centroids).max(axis=1)  # The distance of each box to its closest centroid
+        centroids = np.vstack([centroids, shapes[rng.choice(len(shapes), p=distances / distances.sum())]])
+
+    assignments = None  # The cluster of each box
+    for _ in range(max_iterations):
+        new_assignments = iou_matrix(shapes, centroids).argmax(axis=1)
+        if assignments is not None and np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+        counts = np.bincount(assignments, minlength=k)  # The number of boxes in each cluster
+        for axis in (0, 1):
+            sums = np.bincount(assignments, weights=shapes[:, axis], minlength=k)
+            centroids[:, axis] = np.where(counts > 0, sums / np.maximum(counts, 1), centroids[:, axis])
+
+    mean_iou = float(iou_matrix(shapes, centroids).max(axis=1).mean())
+    return centroids[np.argsort(centroids[:, 0] * centroids[:, 1])], mean_iou
+
+def suggest_anchors(shapes, k=6, anchor_scale=4.0, scales_per_octave=2, max_boxes=100000, seed=42):
+    """
+    Suggest the multiscale anchor generator settings of an SSD FPN pipeline from the box shapes.
+    The aspect ratios come from the k-means centroids, the levels are the FPN levels whose anchors
+    (anchor_scale * 2 ^ level pixels) cover the box sizes between the 1st and the 99th percentile,
+    the fpn min_level and max_level of the feature extractor must match them.
+
+    :param shapes: A (n, 2) numpy array of the boxes' (width, height) in input pixels
+    :param k: The number of k-means clusters
+    :param anchor_scale: The anchor_scale of the anchor generator
+    :param scales_per_octave: The scales_per_octave of the anchor generator
+    :param max_boxes: Cluster a random sample of this many boxes at most
+    :param seed: The random seed of the sample and the clustering
+    :return: A dict of the suggested settings and the clusters they came from
+    """
+    shapes = shapes[(shapes[:, 0] > 0) & (shapes[:, 1] > 0)]
+    if len(shapes) == 0:
+        return {}
+    if len(shapes) > max_boxes:
+        shapes = shapes[np.random.default_rng(seed).choice(len(shapes), max_boxes, replace=False)]
+
+    centroids, mean_iou = kmeans_shapes(shapes, k=k, seed=seed)
+    # Round the centroid aspect ratios to half octaves, 0.5, 0.71, 1.0, 1.41, 2.0, ..., so close clusters share anchors
+    aspect_ratios = sorted({round(float(2 ** (np.round(np.log2(w / h) * 2) / 2)), 2) for w, h in centroids})
+
+    sizes = np.sqrt(shapes[:, 0] * shapes[:, 1])  # The size of each box, the side of a square of the same area
+    low, high = np.percentile(sizes, [1, 99])
+    largest_scale = 2 ** ((scales_per_octave - 1) / scales_per_octave)  # The largest anchor of a level, in octaves
+    min_level = int(np.clip(np.floor(np.log2(low / anchor_scale)), FPN_LEVELS[0], FPN_LEVELS[1]))
+    max_level = int(np.clip(np.ceil(np.log2(high / (anchor_scale * largest_scale))), min_level, FPN_LEVELS[1]))
+    return {
+        'aspect_ratios': aspect_ratios,
+        'min_level': min_level,
+        'max_level': max_level,
+        'anchor_scale': anchor_scale,
+        'scales_per_octave': scales_per_octave,
+        'anchors_per_location': len(aspect_ratios) * scales_per_octave,
+        'clusters': np.round(centroids, 1).tolist(),
+        'clusters_mean_iou': round(mean_iou, 4),
+    }
+
+def profile_index(annotation_index, input_size=(640, 640), bins=20, k=6):
+    """
+    Profile the labels of an annotation index.
+
+    :param annotation_index: The AnnotationIndex of the labels
+    :param input_size: The (width, height) the pipeline's image resizer resizes the images to
+    :param bins: The number of bins of the histograms
+    :param k: The number of k-means clusters of the anchors suggestion
+    :return: The profile dict
+    """
+    shapes = box_shapes(annotation_index, input_size)  # The (width, height) of every box in input pixels
+    widths, heights = shapes[:, 0], shapes[:, 1]
+    valid = (widths > 0) & (heights > 0)  # The boxes with a positive area
+    objects_per_image = annotation_index.num_boxes()  # The number of boxes of each image
+    class_counts = np.bincount(annotation_index.boxes['class_id'], minlength=len(annotation_index.class_names))
+
+    return {
+        'num_images': len(annotation_index),
+        'num_boxes': len(annotation_index.boxes),
+        'input_size': list(input_size),
+        'classes': {name: int(count) for name, count in zip(annotation_index.class_names, class_counts)},
+        'box_width': histogram(widths, bins),
+        'box_height': histogram(heights, bins),
+        'box_area': histogram(widths * heights, bins),
+        'box_aspect_ratio': histogram(widths[valid] / heights[valid], bins, log=True),
+        'objects_per_image': {'counts': np.bincount(objects_per_image).tolist(),
+                              'mean': round(float(objects_per_image.mean()), 4) if len(objects_per_image) else 0},
+        'image_width': histogram(annotation_index.widths, bins),
+        'image_height': histogram(annotation_index.heights, bins),
+        'anchors': suggest_anchors(shapes, k=k),
+    }
+
+def summarize_profile(profile):
+    """
+    Get the readable summary lines of a profile.
+
+    :param profile: The profile dict
+    :return: A list of summary lines
+    """
+    lines = [f'{profile["num_images"]} images, {profile["num_boxes"]} boxes, '
+             f'{profile["objects_per_image"]["mean"]} boxes per image']
+    for name in ('box_width', 'box_height', 'box_aspect_ratio', 'image_width', 'image_height'):
+        percentiles = profile[name]['percentiles']
+        if percentiles:
+            lines.append('{}: median {}, 1%-99% {} - {}'.format(name.replace('_', ' '), percentiles['50'],
+                                                                 percentiles['1'], percentiles['99']))
+    anchors = profile['anchors']
+    if anchors:
+        lines.append('Suggested anchors: aspect_ratios {}, min_level {}, max_level {} '
+                     '({} anchors per location, clusters mean IoU {})'.format(
+                         anchors['aspect_ratios'], anchors['min_level'], anchors['max_level'],
+                         anchors['anchors_per_location'], anchors['clusters_mean_iou']))
+    return lines
+
+def save_profile(profile, path):
+    """
+    Save a profile to a json file.
+
+    :param profile: The profile dict
+    :param path: The path to the json file
+    :return: None
+    """
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
@@ -0,0 +1,172 @@
+import json
+import os
+import subprocess
+import threading
+
+from BasicFunctions import *
+from training_metrics import read_scalars
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+"""
+This is the evaluation sidecar of a training session.
+It runs the Object Detection evaluation loop (model_main_tf2.py --checkpoint_dir) next to the training,
+the loop waits for every new checkpoint in the training directory and evaluates it on the eval records.
+The sidecar runs at a low priority on a few capped threads, pinned to the last cores when possible,
+so it doesn't starve the training's input pipeline, and writes the mAP of every checkpoint to eval_metrics.jsonl.
+"""
+
+MAP_TAG = 'DetectionBoxes_Precision/mAP'  # The COCO mAP tag of the evaluation summaries
+EVAL_METRICS_FILE = 'eval_metrics.jsonl'  # The name of the per checkpoint metrics file in the training directory
+
+class EvalSidecar:
+    """
+    Evaluates the checkpoints of a training directory in a low priority process while the training runs.
+    """
+    def __init__(self, pipeline_config_path, training_dir, num_threads=2, niceness=10, use_gpu=False,
+                 eval_timeout=3600, poll_seconds=30):
+        self.pipeline_config_path = pipeline_config_path  # The path to the pipeline.config file
+        self.training_dir = training_dir  # The path to the training directory, the checkpoints and the summaries
+        self.num_threads = num_threads  # The number of TensorFlow threads of the evaluation
+        self.niceness = niceness  # How much to lower the priority of the evaluation process
+        self.use_gpu = use_gpu  # Let the evaluation use the GPU, otherwise the GPU is left to the training
+        self.eval_timeout = eval_timeout  # The seconds the evaluation loop waits for a new checkpoint
+        self.poll_seconds = poll_seconds  # The seconds between the checks of new evaluation summaries
+        self.results = {}  # The evaluated checkpoint step to its metrics
+        self.__process = None  # The evaluation process
+        self.__stopped = threading.Event()  # Set when the sidecar stops
+        self.__watcher = None  # The thread that collects the evaluation summaries
+
+    def start(self):
+        """
+        Start the evaluation process and the thread that collects its results.
+
+        :return: None
+        """
+        env = dict(os.environ, TF_NUM_INTRAOP_THREADS=str(self.num_threads), TF_NUM_INTEROP_THREADS='1',
+                   OMP_NUM_THREADS=str(self.num_threads))  # The environment of the evaluation process
+        if not self.use_gpu:
+            env['CUDA_VISIBLE_DEVICES'] = '-1'
+        os.makedirs(os.path.join(self.training_dir, 'eval'), exist_ok=True)
+        log = open(os.path.join(self.training_dir, 'eval', 'sidecar.log'), 'a')  # The output of the evaluation
+        self.__process = subprocess.Popen(
+            ['python', os.path.join(os.getcwd(), 'resources/models/research/object_detection/model_main_tf2.py'),
+             '--pipeline_config_path={}'.format(self.pipeline_config_path.replace(os.path.sep, '/')),
+             '--model_dir={}'.format(self.training_dir),
+             '--checkpoint_dir={}'.format(self.training_dir),
+             '--eval_timeout={}'.format(self.eval_timeout),
+             '--alsologtostderr'],
+            env=env, stdout=log, stderr=subprocess.STDOUT,
+            creationflags=getattr(subprocess, 'BELOW_NORMAL_PRIORITY_CLASS', 0))  # The Windows low priority
+        log.close()
+        self.__lower_priority(self.__process.pid)
+        PrintUtils.info(f'Evaluating the checkpoints in the background, the log is in '
+                        f'{os.path.join(self.training_dir, "eval", "sidecar.log")}')
+
+        self.__stopped.clear()
+        self.__watcher = threading.Thread(target=self.__watch, daemon=True)
+        self.__watcher.start()
+
+    def finish(self, timeout=600):
+        """
+        Stop the sidecar after the training ended.
+        The evaluation loop exits by itself after evaluating the checkpoint of the last training step,
+        it's given up to timeout seconds for it, e.g. when the training was cancelled before the last step.
+
+        :param timeout: The max seconds to wait for the evaluation of the last checkpoint
+        :return: The evaluated checkpoint step to its metrics
+        """
+        if self.__process is not None:
+            try:
+                self.__process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.__process.terminate()
+                self.__process.wait()
+            self.__process = None
+        self.__stopped.set()
+        if self.__watcher is not None:
+            self.__watcher.join()
+            self.__watcher = None
+        self.__collect()
+        return self.results
+
+    def best(self):
+        """
+        :return: The (step, mAP) of the checkpoint with the highest mAP, None if none was evaluated
+        """
+        scored = [(step, metrics[MAP_TAG]) for step, metrics in self.results.items() if MAP_TAG in metrics]
+        return max(scored, key=lambda item: item[1]) if scored else None
+
+    def __lower_priority(self, pid):
+        """
+        Lower the priority of the evaluation process and pin it to the last cores, from this process.
+        No code runs in the child between fork and exec, that isn't safe while this process has threads.
+        It's done right after the process starts, long before it imports TensorFlow and starts the threads
+        that inherit the priority and the affinity.
+
+        :param pid: The process id of the evaluation process
+        :return: None
+        """
+        try:
+            if os.name == 'posix':
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + self.niceness)
+            if hasattr(os, 'sched_setaffinity'):
+                cores = sorted(os.sched_getaffinity(pid))  # The cores the process may run on
+                if len(cores) > self.num_threads:
+                    os.sched_setaffinity(pid, cores[-self.num_threads:])
+                return
+        except OSError as e:
+            PrintUtils.warning(f'Unable to lower the priority of the evaluation process: {e}')
+            return
+        if psutil is not None:
+            self.__pin(pid)
+
+    def __pin(self, pid):
+        """
+        Pin a process to the last cores with psutil, where os can't set the affinity.
+
+        :param pid: The process id
+        :return: None
+        """
+        try:
+            process = psutil.Process(pid)  # The psutil handle of the process
+            cores = process.cpu_affinity()  # The cores the process may run on
+            if len(cores) > self.num_threads:
+                process.cpu_affinity(cores[-self.num_threads:])
+        except (psutil.Error, AttributeError):
+            pass  # Not every platform supports the affinity, the priority still applies
+
+    def __watch(self):
+        """
+        Collect the new evaluation results until the sidecar stops.
+        Runs on its own thread.
+
+        :return: None
+        """
+        while not self.__stopped.wait(self.poll_seconds):
+            self.__collect()
+
+    def __collect(self):
+        """
+        Read the evaluation summaries, and report and save the results of the newly evaluated checkpoints.
+
+        :return: None
+        """
+        try:
+            scalars = read_scalars(os.path.join(self.training_dir, 'eval'))  # The step to the evaluation metrics
+        except Exception as e:
+            PrintUtils.warning(f'Unable to read the evaluation summaries: {e}')
+            return
+        new_steps = sorted(step for step in scalars if step not in self.results and MAP_TAG in scalars[step])
+        if not new_steps:
+            return
+        with open(os.path.join(self.training_dir, EVAL_METRICS_FILE), 'a') as f:
+            for step in new_steps:
+                self.results[step] = scalars[step]
+                f.write(json.dumps(dict(scalars[step], step=step)) + '\n')
+                PrintUtils.info('Checkpoint of step {}: mAP {:.4f}, mAP@.50IOU {:.4f}'.format(
+                    step, scalars[step][MAP_TAG],
+                    scalars[step].get('DetectionBoxes_Precision/mAP@.50IOU', float('nan'))))
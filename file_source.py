@@ -0,0 +1,232 @@
+import os
+import shutil
+import threading
+import zipfile
+
+"""
+This is the file sources of the dataset.
+A file source reads the dataset's files by their member name (e.g. 'images/1.jpg'),
+so the dataset stages can work the same on an extracted directory or straight on the dataset zip.
+"""
+
+_zip_handles = threading.local()  # The open ZipFile handles of the current thread, by zip path
+
+class DirectorySource:
+    """
+    A file source over an extracted dataset directory.
+    """
+    def __init__(self, root, zip_path=None, extracted_at=None):
+        self.root = root  # The path to the dataset directory
+        # The zip the directory was extracted from, its CRCs fingerprint the extracted members
+        self.zip_source = ZipSource(zip_path) if zip_path is not None else None
+        self.extracted_at = extracted_at  # The time the zip finished extracting in ns, None if it's unknown
+
+    def path(self, name):
+        """
+        :param name: The member name
+        :return: The path to the member on disk
+        """
+        return os.path.join(self.root, *name.split('/'))
+
+    def list(self, directory, ext):
+        """
+        List the members of a directory in the source.
+        If the directory was extracted from a zip, only the members of the zip are listed.
+
+        :param directory: The member name of the directory
+        :param ext: The extension of the members to list, e.g. '.xml'
+        :return: The sorted member names
+        """
+        dir_path = self.path(directory)  # The path to the directory
+        if not os.path.isdir(dir_path):
+            return []
+        names = sorted(directory + '/' + name for name in os.listdir(dir_path)
+                       if name.endswith(ext) and os.path.isfile(os.path.join(dir_path, name)))
+        if self.zip_source is not None:
+            # Only the members of the current zip, a file left by another zip isn't part of the dataset
+            names = [name for name in names if self.zip_source.exists(name)]
+        return names
+
+    def exists(self, name):
+        """
+        :param name: The member name
+        :return: True if the member exists, False otherwise
+        """
+        return os.path.isfile(self.path(name))
+
+    def open(self, name):
+        """
+        Open a member for reading.
+
+        :param name: The member name
+        :return: A binary file object
+        """
+        return open(self.path(name), 'rb')
+
+    def read(self, name):
+        """
+        Read the content of a member.
+
+        :param name: The member name
+        :return: The member's bytes
+        """
+        with self.open(name) as f:
+            return f.read()
+
+    def fingerprint(self, name):
+        """
+        Get a fingerprint of a member's content, without reading it.
+        A member extracted from the zip and not modified since has the CRC and size of its zip member,
+        like in a ZipSource, so the fingerprint is the same for every extraction of the zip.
+        Any other member, or a member modified after the extraction, has its size and modification time.
+
+        :param name: The member name
+        :return: The fingerprint of the member
+        """
+        stat = os.stat(self.path(name))  # The size and modification time of the member
+        if self.zip_source is not None and self.extracted_at is not None and stat.st_mtime_ns <= self.extracted_at \
+                and self.zip_source.exists(name):
+            info = self.zip_source.getinfo(name)  # The zip header of the member
+            if info.file_size == stat.st_size:
+                return '{:08x}-{}'.format(info.CRC, info.file_size)
+        return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+    def can_remove(self):
+        """
+        :return: True if members can be removed from the source
+        """
+        return True
+
+    def remove(self, name):
+        """
+        Remove a member from the source.
+
+        :param name: The member name
+        :return: None
+        """
+        os.remove(self.path(name))
+
+    def materialize(self, name, output_dir, mode='copy'):
+        """
+        Write a member as a file in the given directory.
+        Links fall back to a copy if the file system doesn't support them.
+
+        :param name: The member name
+        :param output_dir: The path to the output directory
+        :param mode: 'hardlink', 'symlink' or 'copy'
+        :return: None
+        """
+        src = self.path(name)  # The path to the member
+        dst = os.path.join(output_dir, name.split('/')[-1])  # The path to the created file
+        try:
+            if mode == 'hardlink':
+                os.link(src, dst)
+                return
+            if mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+                return
+        except OSError:
+            pass
+        shutil.copy(src, dst)
+
+class ZipSource:
+    """
+    A file source reading the members of the dataset zip on demand, without extracting it.
+    Every thread of every worker process opens its own ZipFile handle, so the source can be shared by workers.
+    """
+    def __init__(self, zip_path):
+        self.zip_path = zip_path  # The path to the zip file
+
+    def __zip(self):
+        """
+        :return: The ZipFile handle of the current thread
+        """
+        # A forked worker must not share the file position of its parent's handles
+        if getattr(_zip_handles, 'pid', None) != os.getpid():
+            _zip_handles.pid = os.getpid()
+            _zip_handles.handles = {}
+        zip_f = _zip_handles.handles.get(self.zip_path)
+        if zip_f is None:
+            zip_f = zipfile.ZipFile(self.zip_path, 'r')
+            _zip_handles.handles[self.zip_path] = zip_f
+        return zip_f
+
+    def getinfo(self, name):
+        """
+        :param name: The member name
+        :return: The ZipInfo header of the member
+        """
+        return self.__zip().getinfo(name)
+
+    def list(self, directory, ext):
+        """
+        List the members of a directory in the source.
+
+        :param directory: The member name of the directory
+        :param ext: The extension of the members to list, e.g. '.xml'
+        :return: The sorted member names
+        """
+        prefix = directory + '/'  # The prefix of the directory's members
+        return sorted(name for name in self.__zip().namelist()
+                      if name.startswith(prefix) and name.endswith(ext) and '/' not in name[len(prefix):])
+
+    def exists(self, name):
+        """
+        :param name: The member name
+        :return: True if the member exists, False otherwise
+        """
+        try:
+            self.__zip().getinfo(name)
+            return True
+        except KeyError:
+            return False
+
+    def open(self, name):
+        """
+        Open a member for reading.
+
+        :param name: The member name
+        :return: A binary file object
+        """
+        return self.__zip().open(name, 'r')
+
+    def read(self, name):
+        """
+        Read the content of a member.
+
+        :param name: The member name
+        :return: The member's bytes
+        """
+        return self.__zip().read(name)
+
+    def fingerprint(self, name):
+        """
+        Get a fingerprint of a member's content.
+        The zip already holds the CRC of every member, so nothing has to be read.
+
+        :param name: The member name
+        :return: The CRC and size of the member
+        """
+        info = self.getinfo(name)  # The member's zip header
+        return '{:08x}-{}'.format(info.CRC, info.file_size)
+
+    def can_remove(self):
+        """
+        Members can't be removed from the zip, rejected members are left out of the annotation index instead.
+
+        :return: True if members can be removed from the source
+        """
+        return False
+
+    def materialize(self, name, output_dir, mode='copy'):
+        """
+        Write a member as a file in the given directory.
+        The members of a zip can't be linked, so they are always copied.
+
+        :param name: The member name
+        :param output_dir: The path to the output directory
+        :param mode: Ignored, kept for the same interface as DirectorySource
+        :return: None
+        """
+        with self.open(name) as src, open(os.path.join(output_dir, name.split('/')[-1]), 'wb') as dst:
+            shutil.copyfileobj(src, dst)
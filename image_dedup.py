@@ -0,0 +1,263 @@
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+from PIL import Image
+
+"""
+This is the near-duplicate image detection of the dataset.
+Every image gets a dHash and a pHash (64 bit perceptual hashes, close images have hashes with a small hamming distance),
+the hashes are indexed in a BK-tree and the images that are close on both hashes are joined to duplicate groups.
+Close hashes only mean similar looking images, so the groups are used to split the dataset,
+and only images with the same bytes and the same labels are exact duplicates.
+"""
+
+HASH_SIZE = 8  # The side of the hash grid, 8 for 64 bit hashes
+__PHASH_SIZE = 32  # The side of the image the pHash DCT runs on
+__DCT_MATRIX = np.cos(np.pi * np.outer(np.arange(__PHASH_SIZE), 2 * np.arange(__PHASH_SIZE) + 1) /
+                      (2 * __PHASH_SIZE))  # The DCT-II basis of the pHash
+__BIT_WEIGHTS = 1 << np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64)  # The weight of every hash bit
+
+def bits_to_int(bits):
+    """
+    Pack a grid of hash bits to an int.
+
+    :param bits: A boolean numpy array of HASH_SIZE x HASH_SIZE bits
+    :return: The hash as an int
+    """
+    return int(np.sum(__BIT_WEIGHTS[bits.ravel()], dtype=np.uint64))
+
+def dhash(image):
+    """
+    Calculate the difference hash of an image, a bit for every pair of horizontally adjacent pixels.
+
+    :param image: A grayscale PIL image
+    :return: The hash as an int
+    """
+    pixels = np.asarray(image.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def phash(image):
+    """
+    Calculate the perceptual hash of an image, a bit for every low frequency of the image's DCT.
+
+    :param image: A grayscale PIL image
+    :return: The hash as an int
+    """
+    pixels = np.asarray(image.resize((__PHASH_SIZE, __PHASH_SIZE), Image.BILINEAR), dtype=np.float64)
+    low = (__DCT_MATRIX @ pixels @ __DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]  # The lowest frequencies
+    return bits_to_int(low > np.median(low.ravel()[1:]))
+
+def hash_image(source, image_file):
+    """
+    Calculate the hashes of a single image.
+    Runs inside the worker processes, the jpg is decoded at a reduced scale since the hashes only need a thumbnail.
+
+    :param source: The file source of the dataset
+    :param image_file: The member name of the image file
+    :return: The (dHash, pHash, content hash) of the image, (None, None, None) if the image can't be read
+    """
+    try:
+        data = source.read(image_file)  # The bytes of the image
+        image = Image.open(io.BytesIO(data))
+        image.draft('L', (__PHASH_SIZE * 2, __PHASH_SIZE * 2))
+        image = image.convert('L')
+        return dhash(image), phash(image), hashlib.blake2b(data, digest_size=16).digest()
+    except Exception:
+        return None, None, None
+
+def compute_hashes(source, image_files, num_workers=None, chunk_size=None):
+    """
+    Calculate the hashes of the given images on a pool of worker processes.
+
+    :param source: The file source of the dataset, every worker reads it with its own handles
+    :param image_files: A list of member names of the image files
+    :param num_workers: The number of worker processes, None for the number of cores
+    :param chunk_size: The number of images sent to a worker at once, None to pick one from the number of images
+    :return: The dHashes, the pHashes (uint64 numpy arrays), the content hashes (a bytes numpy array)
+             and a boolean array of the images that were hashed
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(image_files)))
+
+    if num_workers == 1:
+        hashes = list(map(hash_image, repeat(source), image_files))
+    else:
+        if chunk_size is None:
+            chunk_size = max(1, min(256, len(image_files) // (num_workers * 4)))
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            hashes = list(executor.map(hash_image, repeat(source), image_files, chunksize=chunk_size))
+
+    hashed = np.array([d is not None for d, _, _ in hashes], dtype=bool)
+    dhashes = np.array([d or 0 for d, _, _ in hashes], dtype=np.uint64)
+    phashes = np.array([p or 0 for _, p, _ in hashes], dtype=np.uint64)
+    content_hashes = np.array([c or b'' for _, _, c in hashes], dtype='S16')
+    return dhashes, phashes, content_hashes, hashed
+
+def hamming(a, b):
+    """
+    :return: The number of different bits between two int hashes
+    """
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """
+    A BK-tree of hashes, finds all the hashes within a hamming distance without comparing to every hash.
+    Every node keeps its children by their distance from it, so the triangle inequality prunes the search.
+    """
+    def __init__(self):
+        self.__root = None  # The root node, a [hash, items, {distance: child}] list
+        self.size = 0  # The number of distinct hashes in the tree
+
+    def add(self, value, item):
+        """
+        Add a hash to the tree.
+
+        :param value: The hash as an int
+        :param item: The item of the hash, e.g. the image position
+        :return: None
+        """
+        if self.__root is None:
+            self.__root = [value, [item], {}]
+            self.size = 1
+            return
+        node = self.__root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        Find the hashes within a hamming distance.
+
+        :param value: The hash as an int
+        :param max_distance: The max hamming distance
+        :return: A list of the items of the close hashes
+        """
+        found = []  # The items of the close hashes
+        nodes = [] if self.__root is None else [self.__root]  # The nodes left to check
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend(node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+def find_duplicate_groups(dhashes, phashes, max_distance=6, hashed=None):
+    """
+    Join the images with close hashes to groups.
+    Two images are duplicates if both their dHashes and their pHashes are within max_distance,
+    the groups are the connected components of the duplicate pairs.
+
+    :param dhashes: The dHashes of the images
+    :param phashes: The pHashes of the images
+    :param max_distance: The max hamming distance of duplicate images, 0 for exact duplicates only
+    :param hashed: A boolean array of the images that were hashed, the others are left in groups of their own
+    :return: The group of every image, the position of the group's first image
+    """
+    if hashed is None:
+        hashed = np.ones(len(dhashes), dtype=bool)
+    parents = np.arange(len(dhashes))  # The union-find parent of every image
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    tree = BKTree()  # The index of the dHashes
+    for i in np.flatnonzero(hashed):
+        value = int(dhashes[i])
+        for j in tree.search(value, max_distance):
+            if hamming(int(phashes[i]), int(phashes[j])) <= max_distance:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+        tree.add(value, i)
+
+    return np.array([find(i) for i in range(len(parents))], dtype=np.int64)
+
+def match_duplicates(dhashes, phashes, known_dhashes, known_phashes, max_distance=6, hashed=None,
+                     known_hashed=None):
+    """
+    Find a duplicate of every image among known images, e.g. the images already in an encoded dataset.
+    An image matches a known image if both their dHashes and their pHashes are within max_distance,
+    the known dHashes are indexed in a BK-tree so the images aren't compared to every known image.
+
+    :param dhashes: The dHashes of the images
+    :param phashes: The pHashes of the images
+    :param known_dhashes: The dHashes of the known images
+    :param known_phashes: The pHashes of the known images
+    :param max_distance: The max hamming distance of duplicate images, 0 for exact duplicates only
+    :param hashed: A boolean array of the images that were hashed, the others match nothing
+    :param known_hashed: A boolean array of the known images that were hashed, the others are never matched
+    :return: The position of the first matching known image of every image, -1 for the images without a match
+    """
+    if hashed is None:
+        hashed = np.ones(len(dhashes), dtype=bool)
+    if known_hashed is None:
+        known_hashed = np.ones(len(known_dhashes), dtype=bool)
+
+    tree = BKTree()  # The index of the known dHashes
+    for j in np.flatnonzero(known_hashed):
+        tree.add(int(known_dhashes[j]), j)
+
+    matches = np.full(len(dhashes), -1, dtype=np.int64)  # The matching known image of every image
+    for i in np.flatnonzero(hashed):
+        close = [j for j in tree.search(int(dhashes[i]), max_distance)
+                 if hamming(int(phashes[i]), int(known_phashes[j])) <= max_distance]  # The matching known images
+        if close:
+            matches[i] = min(close)
+    return matches
+
+def label_keys(annotation_index):
+    """
+    Get a key of the labels of every image, images with the same boxes in any order have the same key.
+
+    :param annotation_index: The AnnotationIndex of the images
+    :return: A list of the label key of every image
+    """
+    class_names = annotation_index.class_names  # The names of the classes, by class_id
+    boxes = annotation_index.boxes.tolist()  # The (class_id, xmin, ymin, xmax, ymax) of all the boxes
+    offsets = annotation_index.offsets  # The offset of each image's boxes
+    return [tuple(sorted((class_names[class_id], *coords) for class_id, *coords in boxes[offsets[i]:offsets[i + 1]]))
+            for i in range(len(annotation_index))]
+
+def collapse_exact_duplicates(content_hashes, label_keys, hashed):
+    """
+    Find the images that are exact duplicates of an earlier image, the same bytes with the same labels.
+    Images with the same bytes and different labels are all kept, their labels aren't dropped.
+
+    :param content_hashes: The content hashes of the images
+    :param label_keys: The label key of every image, see label_keys
+    :param hashed: A boolean array of the images that were hashed
+    :return: A boolean array of the images to keep, the first image of every exact duplicate group,
+             and the number of images that have the bytes of an earlier image with different labels
+    """
+    keep = np.ones(len(content_hashes), dtype=bool)  # The images that weren't hashed are always kept
+    first_labels = {}  # The content hash to the label keys of the kept images with it
+    num_conflicts = 0  # The number of images with the bytes of an earlier image and different labels
+    for i in np.flatnonzero(hashed):
+        seen = first_labels.setdefault(content_hashes[i], set())  # The label keys of the earlier images
+        if label_keys[i] in seen:
+            keep[i] = False
+            continue
+        if seen:
+            num_conflicts += 1
+        seen.add(label_keys[i])
+    return keep, num_conflicts
@@ -0,0 +1,123 @@
+import struct
+
+from PIL import Image
+
+"""
+This module reads image dimensions without decoding the pixels.
+JPEG files are probed by walking their markers up to the SOF (start of frame) segment,
+other formats fall back to PIL which only reads the header when opening a file.
+"""
+
+__SOI = b'\xff\xd8'  # The JPEG start of image marker
+__EOI = b'\xff\xd9'  # The JPEG end of image marker
+__SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}  # The start of frame markers, they hold the image size
+__STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}  # Markers without a length field
+__SOS = 0xDA  # The start of scan marker, the compressed data starts after it
+__TAIL_SIZE = 1024 * 1024  # The number of bytes at the end of the file searched for the EOI marker
+
+
+def probe_jpeg(f):
+    """
+    Read the dimensions of a JPEG image from its SOF marker.
+    Also checks that the file has an EOI marker near its end, so truncated files are rejected.
+    Trailing data after the EOI marker (padding, an appended thumbnail, a camera trailer) is allowed,
+    a file without an EOI marker in its tail is only rejected if PIL fails to decode it.
+
+    :param f: A seekable binary file object of the image
+    :return: The image's (width, height)
+    :raises ValueError: If the file isn't a valid JPEG file
+    """
+    if f.read(2) != __SOI:
+        raise ValueError('Missing JPEG SOI marker')
+
+    size = None  # The image's (width, height)
+    while size is None:
+        byte = f.read(1)
+        if byte != b'\xff':
+            raise ValueError('Invalid JPEG marker')
+        # Markers may be padded with any number of 0xFF fill bytes
+        while byte == b'\xff':
+            byte = f.read(1)
+        if byte == b'':
+            raise ValueError('Truncated JPEG header')
+        marker = byte[0]  # The current marker code
+
+        if marker in __STANDALONE_MARKERS:
+            continue
+        if marker == __SOS:
+            raise ValueError('No JPEG SOF marker before the scan data')
+
+        length_bytes = f.read(2)
+        if len(length_bytes) != 2:
+            raise ValueError('Truncated JPEG header')
+        length = struct.unpack('>H', length_bytes)[0]  # The length of the segment, including the length field
+        if length < 2:
+            raise ValueError('Invalid JPEG segment length')
+
+        if marker in __SOF_MARKERS:
+            segment = f.read(5)
+            if len(segment) != 5:
+                raise ValueError('Truncated JPEG SOF segment')
+            height, width = struct.unpack('>HH', segment[1:5])  # The first byte is the sample precision
+            if width == 0 or height == 0:
+                raise ValueError('Invalid JPEG dimensions')
+            size = (width, height)
+        else:
+            f.seek(length - 2, 1)
+
+    # A truncated file is missing the EOI marker, it's searched backwards from the end of the file.
+    # The search starts after the SOF segment, so the EOI of an EXIF thumbnail in the header isn't found
+    header_end = f.tell()  # The offset of the end of the SOF segment
+    f.seek(0, 2)
+    file_size = f.tell()  # The size of the file in bytes
+    f.seek(max(header_end, file_size - __TAIL_SIZE))
+    if f.read().rfind(__EOI) == -1 and not __decodes(f):
+        raise ValueError('Missing JPEG EOI marker, the file is truncated')
+
+    return size
+
+def __decodes(f):
+    """
+    Check if PIL decodes an image, for the rare valid files the header probe can't confirm.
+
+    :param f: A seekable binary file object of the image
+    :return: True if the whole image decoded
+    """
+    f.seek(0)
+    try:
+        with Image.open(f) as image:
+            image.load()
+        return True
+    except Exception:
+        return False
+
+def probe_image_file(f):
+    """
+    Read the dimensions of an image without decoding it.
+
+    :param f: A seekable binary file object of the image
+    :return: The image's (width, height)
+    :raises ValueError: If the file isn't a valid image
+    """
+    if f.read(2) == __SOI:
+        f.seek(0)
+        return probe_jpeg(f)
+
+    f.seek(0)
+    try:
+        with Image.open(f) as image:
+            return image.size
+    except Exception as e:
+        raise ValueError(f'Unable to read the image header: {e}')
+
+def probe_image(path):
+    """
+    Read the dimensions of an image file without decoding it.
+
+    :param path: The path to the image file
+    :return: The image's (width, height)
+    :raises ValueError: If the file isn't a valid image
+    """
+    with open(path, 'rb') as f:
+        return probe_image_file(f)
@@ -0,0 +1,172 @@
+import math
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from object_detection import inputs
+from object_detection.builders import model_builder
+
+"""
+This is the auto-tuner of the training's CPU input pipeline and TensorFlow thread pools.
+The input reader settings of the pipeline config are derived from the core count and the encoded dataset
+(the number of shards and the size of an example), and checked against the base config's settings
+by short alternating dry runs of the Object Detection input pipeline, the faster settings by their median win.
+"""
+
+SHUFFLE_MEMORY_BUDGET = 512 * 1024 * 1024  # The max bytes of serialized examples the shuffle buffer holds
+PREFETCH_MEMORY_BUDGET = 1024 * 1024 * 1024  # The max bytes of decoded batches the prefetch buffer holds
+TUNED_FIELDS = ('num_readers', 'num_parallel_batches', 'num_prefetch_batches', 'shuffle_buffer_size',
+                'filenames_shuffle_buffer_size')  # The input reader fields the tuner sets
+
+def available_cores():
+    """
+    :return: The number of cores this process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def suggest_thread_settings(num_cores):
+    """
+    Suggest the TensorFlow thread pools, the intra-op pool runs the math of an op on all the cores
+    and a few inter-op threads run the independent ops side by side.
+
+    :param num_cores: The number of cores
+    :return: A dict of intra_op and inter_op thread counts
+    """
+    return {'intra_op': num_cores, 'inter_op': int(min(4, max(2, num_cores // 4)))}
+
+def apply_thread_settings(settings):
+    """
+    Set the TensorFlow thread pools of this process.
+    They can only be set before TensorFlow runs its first op.
+
+    :param settings: A dict of intra_op and inter_op thread counts
+    :return: True if they were set, False if TensorFlow already started
+    """
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(settings['intra_op'])
+        tf.config.threading.set_inter_op_parallelism_threads(settings['inter_op'])
+        return True
+    except RuntimeError:
+        return False
+
+def thread_environment(settings):
+    """
+    Get the environment variables that set the TensorFlow thread pools of a subprocess.
+
+    :param settings: A dict of intra_op and inter_op thread counts
+    :return: A dict of environment variables
+    """
+    return {'TF_NUM_INTRAOP_THREADS': str(settings['intra_op']), 'TF_NUM_INTEROP_THREADS': str(settings['inter_op']),
+            'OMP_NUM_THREADS': str(settings['intra_op'])}
+
+def suggest_input_settings(num_cores, batch_size, num_shards, num_examples, bytes_per_example, input_size=(640, 640)):
+    """
+    Suggest the input reader settings of the train input.
+
+    :param num_cores: The number of cores
+    :param batch_size: The batch size of the train config
+    :param num_shards: The number of train .record shards
+    :param num_examples: The number of train examples
+    :param bytes_per_example: The mean size of a serialized example
+    :param input_size: The (width, height) of the model input, the size of a decoded image in a batch
+    :return: A dict of the input reader fields
+    """
+    batch_bytes = batch_size * input_size[0] * input_size[1] * 3 * 4  # The bytes of a decoded float batch
+    return {
+        # A reader per shard, no more readers than cores
+        'num_readers': int(max(1, min(num_shards, num_cores))),
+        # The map decodes batch_size * num_parallel_batches examples at once, enough to keep every core busy
+        'num_parallel_batches': int(max(1, math.ceil(num_cores / batch_size))),
+        'num_prefetch_batches': int(min(8, max(2, PREFETCH_MEMORY_BUDGET // batch_bytes))),
+        'shuffle_buffer_size': int(max(batch_size, min(num_examples, SHUFFLE_MEMORY_BUDGET // max(1, bytes_per_example),
+                                                       8192))),
+        'filenames_shuffle_buffer_size': int(max(1, num_shards)),
+    }
+
+def read_input_settings(input_reader):
+    """
+    :param input_reader: An InputReader config
+    :return: A dict of the tuned fields of the input reader
+    """
+    return {name: getattr(input_reader, name) for name in TUNED_FIELDS}
+
+def apply_input_settings(input_reader, settings):
+    """
+    Set the fields of an InputReader config.
+
+    :param input_reader: An InputReader config
+    :param settings: A dict of the input reader fields
+    :return: None
+    """
+    for name, value in settings.items():
+        setattr(input_reader, name, value)
+
+def measure_input_pipeline(pipeline, detection_model, num_batches=20, warmup_batches=5):
+    """
+    Measure the throughput of the train input pipeline of a pipeline config, without training.
+    The pipeline runs exactly like in the training, with the model's preprocessing and the augmentations.
+
+    :param pipeline: A TrainEvalPipelineConfig
+    :param detection_model: The detection model of the pipeline, built once for all the measurements
+    :param num_batches: The number of measured batches
+    :param warmup_batches: The number of batches read before measuring, while the buffers fill
+    :return: The examples per second
+    """
+    dataset = inputs.train_input(train_config=pipeline.train_config, train_input_config=pipeline.train_input_reader,
+                                 model_config=pipeline.model, model=detection_model)
+    iterator = iter(dataset.repeat())
+    for _ in range(warmup_batches):
+        next(iterator)
+    start_time = time.time()
+    for _ in range(num_batches):
+        next(iterator)
+    return num_batches * pipeline.train_config.batch_size / (time.time() - start_time)
+
+def tune_pipeline(pipeline, num_shards, num_examples, bytes_per_example, num_cores=None, dry_run_batches=20,
+                  dry_run_rounds=3, input_size=(640, 640)):
+    """
+    Tune the train input reader of a pipeline config in place.
+    The suggested settings are kept only if dry runs measure them faster than the config's own settings.
+    A shared unmeasured run first warms the page cache and the TensorFlow runtime, then the base and the suggested
+    settings are measured in alternating order for a few rounds and their median throughputs are compared,
+    so neither of them gains from running second.
+
+    :param pipeline: A TrainEvalPipelineConfig
+    :param num_shards: The number of train .record shards
+    :param num_examples: The number of train examples
+    :param bytes_per_example: The mean size of a serialized example
+    :param num_cores: The number of cores, None for the cores of this process
+    :param dry_run_batches: The number of batches of each dry run, 0 to keep the suggestion without a dry run
+    :param dry_run_rounds: The number of measurements of each settings
+    :param input_size: The (width, height) of the model input
+    :return: A dict of the chosen settings, the base settings and the measured examples per second
+    """
+    num_cores = num_cores or available_cores()
+    reader = pipeline.train_input_reader  # The train input reader config
+    base = read_input_settings(reader)  # The settings of the base config
+    suggested = suggest_input_settings(num_cores, pipeline.train_config.batch_size, num_shards, num_examples,
+                                       bytes_per_example, input_size)
+    report = {'cores': num_cores, 'base': base, 'suggested': suggested, 'chosen': 'suggested'}
+
+    if dry_run_batches > 0 and suggested != base:
+        detection_model = model_builder.build(model_config=pipeline.model, is_training=True)
+        measure_input_pipeline(pipeline, detection_model, dry_run_batches)  # The shared warmup, not measured
+        rates = {'base': [], 'suggested': []}  # The measured examples per second of each settings
+        for round_index in range(max(1, dry_run_rounds)):
+            for name in (('base', 'suggested') if round_index % 2 == 0 else ('suggested', 'base')):
+                apply_input_settings(reader, report[name])
+                rates[name].append(measure_input_pipeline(pipeline, detection_model, dry_run_batches))
+        for name, values in rates.items():
+            report[f'{name}_examples_per_sec'] = round(float(np.median(values)), 2)
+            report[f'{name}_runs'] = [round(value, 2) for value in values]
+        if report['suggested_examples_per_sec'] < report['base_examples_per_sec']:
+            apply_input_settings(reader, base)
+            report['chosen'] = 'base'
+        else:
+            apply_input_settings(reader, suggested)
+    else:
+        apply_input_settings(reader, suggested)
+    return report
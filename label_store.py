@@ -0,0 +1,107 @@
+import numpy as np
+
+import PrintUtils
+from annotation_index import BOX_DTYPE, AnnotationIndex
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+"""
+This is the columnar label store of the dataset.
+It saves the labels as a typed table, int32 coordinates with a dictionary encoded filename and class,
+in Parquet (compact) or Arrow IPC (memory mapped, zero-copy reads) format.
+Needs the optional pyarrow package.
+"""
+
+LABEL_STORE_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}  # The supported formats and their extensions
+
+def is_available():
+    """
+    :return: True if pyarrow is installed, False otherwise
+    """
+    return pa is not None
+
+def index_to_table(annotation_index):
+    """
+    Convert an annotation index to an Arrow table, a row for every label.
+
+    :param annotation_index: The AnnotationIndex to convert
+    :return: The pyarrow Table
+    """
+    image_of_box = np.repeat(np.arange(len(annotation_index), dtype=np.int32),
+                             annotation_index.num_boxes())  # The image position of each box
+    boxes = annotation_index.boxes  # The boxes of all the images
+    return pa.table({
+        'filename': pa.DictionaryArray.from_arrays(image_of_box, pa.array(annotation_index.filenames.tolist(),
+                                                                          type=pa.string())),
+        'image_width': pa.array(annotation_index.widths[image_of_box], type=pa.int32()),
+        'image_height': pa.array(annotation_index.heights[image_of_box], type=pa.int32()),
+        'class': pa.DictionaryArray.from_arrays(np.ascontiguousarray(boxes['class_id']),
+                                                pa.array(annotation_index.class_names, type=pa.string())),
+        'xmin': pa.array(np.ascontiguousarray(boxes['xmin']), type=pa.int32()),
+        'ymin': pa.array(np.ascontiguousarray(boxes['ymin']), type=pa.int32()),
+        'xmax': pa.array(np.ascontiguousarray(boxes['xmax']), type=pa.int32()),
+        'ymax': pa.array(np.ascontiguousarray(boxes['ymax']), type=pa.int32()),
+    })
+
+def table_to_index(table):
+    """
+    Convert a label table back to an annotation index, e.g. for a re-encoding run.
+    The rows of an image must be next to each other, like in the tables written by write_label_store.
+
+    :param table: The pyarrow Table of the labels
+    :return: The AnnotationIndex, the xml_names are left empty
+    """
+    filenames = table.column('filename').combine_chunks()  # The dictionary encoded filename of each label
+    classes = table.column('class').combine_chunks()  # The dictionary encoded class of each label
+    image_of_box = filenames.indices.to_numpy(zero_copy_only=False)  # The image position of each label
+    starts = np.flatnonzero(np.diff(image_of_box, prepend=-1))  # The first label of each image
+
+    boxes = np.empty(len(table), dtype=BOX_DTYPE)  # The boxes of all the images
+    boxes['class_id'] = classes.indices.to_numpy(zero_copy_only=False)
+    for column in ('xmin', 'ymin', 'xmax', 'ymax'):
+        boxes[column] = table.column(column).to_numpy()
+
+    return AnnotationIndex(np.full(len(starts), '', dtype=str),
+                           filenames.dictionary.to_numpy(zero_copy_only=False)[image_of_box[starts]],
+                           table.column('image_width').to_numpy()[starts],
+                           table.column('image_height').to_numpy()[starts],
+                           np.append(starts, len(table)), boxes, classes.dictionary.to_pylist())
+
+def write_label_store(annotation_index, path_without_ext, label_format='parquet'):
+    """
+    Write the labels of an annotation index to the label store.
+
+    :param annotation_index: The AnnotationIndex of the labels
+    :param path_without_ext: The path to the output file, the format's extension is added to it
+    :param label_format: 'parquet' or 'arrow'
+    :return: The path to the written file, None if pyarrow isn't installed
+    """
+    if not is_available():
+        PrintUtils.warning('pyarrow is not installed, skipping the {} label store'.format(label_format))
+        return None
+
+    path = path_without_ext + LABEL_STORE_FORMATS[label_format]  # The path to the output file
+    table = index_to_table(annotation_index)  # The labels table
+    if label_format == 'parquet':
+        pq.write_table(table, path, use_dictionary=True, compression='zstd')
+    else:
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+def read_label_store(path):
+    """
+    Read a label store written with write_label_store.
+    Arrow files are memory mapped, so the columns are read without copying them.
+
+    :param path: The path to the .parquet or .arrow file
+    :return: The pyarrow Table of the labels
+    """
+    if path.endswith(LABEL_STORE_FORMATS['arrow']):
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return pq.read_table(path, memory_map=True)
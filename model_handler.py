@@ -1,3 +1,5 @@
+import functools
+import json
 import shutil
 import subprocess
 import sys
@@ -10,6 +12,12 @@ from object_detection.protos import pipeline_pb2
 from object_detection.utils import visualization_utils as vis_util, label_map_util
 
 from BasicFunctions import *
+from eval_sidecar import EvalSidecar
+from input_tuner import (apply_thread_settings, available_cores, suggest_thread_settings, thread_environment,
+                         tune_pipeline)
+from tensorboard_manager import TensorBoardManager
+from training_metrics import MetricsCollector, summary_lines
+from training_runner import TrainingRunner
 
 class ModelHandler:
     """
@@ -24,6 +32,18 @@ class ModelHandler:
 
         # Training
         self.training_dir = None  # The path to the current training session directory
+        self.train_in_process = True  # Train in this process, otherwise in a model_main_tf2.py subprocess
+        self.checkpoint_every_n = 1000  # The number of training steps between checkpoints
+        self.auto_tune_input = True  # Tune the input reader and the thread pools to this machine and the dataset
+        self.tune_dry_run_batches = 20  # The batches of each dry run of the input tuning, 0 to skip the dry runs
+        self.thread_settings = None  # The TensorFlow thread pools of the training, None for the defaults
+        self.run_eval_sidecar = True  # Evaluate the checkpoints in a low priority process while training
+        self.eval_threads = 2  # The number of TensorFlow threads of the evaluation process
+        self.eval_sidecar = None  # The EvalSidecar of the running training
+        self.training_runner = None  # The TrainingRunner of the running in-process training
+        self.training_process = None  # The model_main_tf2.py process of the running subprocess training
+        self.use_tensorboard = True  # Serve the training directory with TensorBoard while training
+        self.tensorboard = TensorBoardManager()  # The TensorBoard server of the last training session
 
         # Testing
         self.category_index = None  # The label map of the current loaded model
@@ -45,30 +65,106 @@ class ModelHandler:
         PrintUtils.info('A config file was created at {}'.format(os.path.join(self.training_dir, 'pipeline.config')))
         PrintUtils.getinput('Press enter once you have finished customizing your config')
 
-        tb_proc = subprocess.Popen(['tensorboard',
-                                    '--logdir={path}/'.format(path=self.training_dir),
-                                    '--host=localhost',
-                                    # '--port=6006'],
-                                    '--port=0'],
-                                   env=os.environ.copy())
+        # TensorBoard starts next to the training and reports its url once it serves
+        if self.use_tensorboard:
+            self.tensorboard.start(self.training_dir)
 
-        time.sleep(15)
+        # Collect the throughput and losses of the steps into a timeline in the training directory
+        train_config = self.__load_pipeline().train_config  # The train config the user finished customizing
+        metrics = MetricsCollector(self.training_dir, train_config.num_steps, train_config.batch_size)
 
-        # PrintUtils.info('Tensorboard is open, enter link "http://localhost:6006/"')
+        # Evaluate every new checkpoint next to the training, on a few low priority threads
+        if self.run_eval_sidecar:
+            self.eval_sidecar = EvalSidecar(os.path.join(self.training_dir, 'pipeline.config'), self.training_dir,
+                                            num_threads=self.eval_threads)
+            self.eval_sidecar.start()
 
         start_time = time.time()
+        if self.train_in_process:
+            self.__train_in_process(metrics)
+        else:
+            self.__train_subprocess(metrics)
+        end_time = time.time()
+
+        PrintUtils.info('Training finished! Time taken: {:.2f} minutes'.format((end_time - start_time) / 60))
+        for line in summary_lines(metrics.close()):
+            PrintUtils.info(line)
+
+        if self.eval_sidecar is not None:
+            PrintUtils.info('Waiting for the evaluation of the last checkpoint...')
+            self.eval_sidecar.finish()
+            best = self.eval_sidecar.best()  # The (step, mAP) of the best checkpoint
+            if best is not None:
+                PrintUtils.info('Best checkpoint: step {}, mAP {:.4f}'.format(*best))
+            self.eval_sidecar = None
+        if self.tensorboard.url is not None:
+            PrintUtils.info(f'TensorBoard keeps serving the training at {self.tensorboard.url}')
+
+    def cancel_training(self):
+        """
+        Stop the running training, the in-process training stops after the current step and saves a checkpoint.
+        Can be called from the gui thread.
+
+        :return: None
+        """
+        if self.training_runner is not None:
+            PrintUtils.info('Stopping the training after the current step...')
+            self.training_runner.cancel()
+        elif self.training_process is not None:
+            PrintUtils.info('Stopping the training process...')
+            self.training_process.terminate()
+
+    def __train_in_process(self, metrics):
+        """
+        Train the model of the current training directory in this process,
+        the status of every step is reported to the gui and the metrics collector.
+
+        :param metrics: The MetricsCollector of the session
+        :return: None
+        """
+        self.training_runner = TrainingRunner(os.path.join(self.training_dir, 'pipeline.config'), self.training_dir,
+                                              checkpoint_every_n=self.checkpoint_every_n)
+        self.training_runner.add_callback(self.gui.report_training)
+        self.training_runner.add_callback(metrics.on_status)
+        try:
+            status = self.training_runner.run()  # The status of the last step
+            if self.training_runner.cancelled:
+                PrintUtils.warning('The training was cancelled, the last step was saved to a checkpoint')
+            if status is not None:
+                PrintUtils.info('Stopped at step {}, total loss {:.4f}'.format(
+                    status.step, status.losses.get('Loss/total_loss', float('nan'))))
+            elif not self.training_runner.cancelled:
+                PrintUtils.warning('No training step ran, the model directory already reached num_steps')
+        except Exception as e:
+            PrintUtils.error('The training failed')
+            print(e)
+        finally:
+            self.training_runner = None
+
+    def __train_subprocess(self, metrics):
+        """
+        Train the model of the current training directory in a model_main_tf2.py subprocess.
+        The output of the process is printed and its step lines are given to the metrics collector.
+
+        :param metrics: The MetricsCollector of the session
+        :return: None
+        """
         with subprocess.Popen(
                 ['python', os.path.join(os.getcwd(), 'resources/models/research/object_detection/model_main_tf2.py'),
                  '--pipeline_config_path={path}'.format(path=os.path.join(self.training_dir, 'pipeline.config').replace(os.path.sep, '/')),
                  '--model_dir={path}'.format(path=self.training_dir),
+                 '--checkpoint_every_n={}'.format(self.checkpoint_every_n),
                  '--alsologtostderr'],
-                env=os.environ.copy(), stdout=sys.stdout, stderr=sys.stderr) as out:
-            out.communicate()
+                env=dict(os.environ, **(thread_environment(self.thread_settings) if self.thread_settings else {})),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True) as out:
+            self.training_process = out
+            for line in out.stdout:
+                sys.stdout.write(line)
+                metrics.on_output_line(line)
+            out.wait()
             print(out.returncode)
-        tb_proc.kill()
-        end_time = time.time()
-
-        PrintUtils.info('Training finished! Time taken: {:.2f} minutes'.format((end_time - start_time) / 60))
+        self.training_process = None
 
     def export_model(self):
         """
@@ -138,7 +234,7 @@ class ModelHandler:
             if extract_dir == '' or extract_dir is None:
                 return False
 
-            extract_zip(model_zip, extract_dir)
+            extract_zip(model_zip, extract_dir, progress=functools.partial(self.gui.report_progress, 'Extracting'))
 
             PATH_TO_LABEL_MAP = os.path.join(extract_dir, 'label_map.pbtxt')
             label_map = label_map_util.load_labelmap(PATH_TO_LABEL_MAP)
@@ -274,12 +370,59 @@ class ModelHandler:
         )
         return image_np
 
+    def __load_pipeline(self):
+        """
+        Load the pipeline config of the current training directory.
+
+        :return: The TrainEvalPipelineConfig
+        """
+        pipeline = pipeline_pb2.TrainEvalPipelineConfig()  # The config pipeline
+        with tf.io.gfile.GFile(os.path.join(self.training_dir, 'pipeline.config'), "r") as f:
+            text_format.Merge(f.read(), pipeline)
+        return pipeline
+
+    def __tune_input(self, pipeline, train_record_path, eval_record_path):
+        """
+        Tune the input readers of a pipeline config to this machine and the dataset,
+        the report is saved to input_tuning.json in the training directory.
+
+        :param pipeline: The TrainEvalPipelineConfig of the session
+        :param train_record_path: The glob pattern of the train shards the session reads
+        :param eval_record_path: The glob pattern of the eval shards the session reads
+        :return: None
+        """
+        train_shards = glob(train_record_path)  # The train shards of the session
+        num_examples = max(1, self.data_handler.num_train or 0)  # The number of train examples
+        bytes_per_example = sum(os.path.getsize(path) for path in train_shards) // num_examples
+        if self.tune_dry_run_batches > 0:
+            PrintUtils.info('Measuring the input pipeline to tune it...')
+        report = tune_pipeline(pipeline, len(train_shards), num_examples, bytes_per_example,
+                               dry_run_batches=self.tune_dry_run_batches,
+                               input_size=self.data_handler.model_input_size)
+        report['threads'] = self.thread_settings
+        pipeline.eval_input_reader[0].num_readers = max(1, min(len(glob(eval_record_path)), report['cores']))
+
+        settings = report[report['chosen']]  # The input reader settings the session trains with
+        PrintUtils.info('Input pipeline: {} ({})'.format(
+            ', '.join(f'{name} {value}' for name, value in settings.items()), report['chosen']))
+        if 'base_examples_per_sec' in report:
+            PrintUtils.info('Dry run: {} examples/s with the base settings, {} with the suggested settings'.format(
+                report['base_examples_per_sec'], report['suggested_examples_per_sec']))
+        with open(os.path.join(self.training_dir, 'input_tuning.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
     def __prepare_config(self):
         """
         Prepare a config file for testing and save it in the current training directory.
 
         :return: None
         """
+        # The thread pools of this process can only be set before TensorFlow runs an op, so they're set first
+        if self.auto_tune_input:
+            self.thread_settings = suggest_thread_settings(available_cores())
+            if not apply_thread_settings(self.thread_settings):
+                PrintUtils.warning('TensorFlow already started, the in-process training keeps the default thread pools')
+
         pipeline = pipeline_pb2.TrainEvalPipelineConfig()  # The config pipeline
 
         with tf.io.gfile.GFile(os.path.join(os.getcwd(), 'resources/base_pipeline.config'), "r") as f:
@@ -291,17 +434,27 @@ class ModelHandler:
                                                                   'resources/models/pretrained_model/ssd_resnet50_v1_fpn/checkpoint/ckpt-0').replace(
             os.path.sep, '/')
 
-        # Configure the train data path
+        # The input reader only reads uncompressed records, the shards are never compressed,
+        # the compressed copies of an archived dataset are only for storing or transferring it
+        train_record_path = self.data_handler.train_record_path  # The pattern of the train shards of the session
+        eval_record_path = self.data_handler.eval_record_path  # The pattern of the eval shards of the session
+
+        # Configure the train data path, the input reader expands the shards pattern and interleaves the shards
         pipeline.train_input_reader.label_map_path = self.data_handler.label_map_path.replace(os.path.sep, '/')
-        pipeline.train_input_reader.tf_record_input_reader.input_path[0] = self.data_handler.train_record_path.replace(
-            os.path.sep, '/')
+        del pipeline.train_input_reader.tf_record_input_reader.input_path[:]
+        pipeline.train_input_reader.tf_record_input_reader.input_path.append(
+            train_record_path.replace(os.path.sep, '/'))
 
         # Configure the eval data path
         pipeline.eval_input_reader[0].label_map_path = self.data_handler.label_map_path.replace(os.path.sep, '/')
-        pipeline.eval_input_reader[0].tf_record_input_reader.input_path[
-            0] = self.data_handler.eval_record_path.replace(os.path.sep, '/')
+        del pipeline.eval_input_reader[0].tf_record_input_reader.input_path[:]
+        pipeline.eval_input_reader[0].tf_record_input_reader.input_path.append(
+            eval_record_path.replace(os.path.sep, '/'))
         pipeline.eval_config.num_examples = self.data_handler.num_eval
 
+        if self.auto_tune_input:
+            self.__tune_input(pipeline, train_record_path, eval_record_path)
+
         config_text = text_format.MessageToString(pipeline)  # The config in text form
         with tf.io.gfile.GFile(os.path.join(self.training_dir, 'pipeline.config'), "wb") as f:
             f.write(config_text)
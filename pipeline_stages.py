@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import time
+
+"""
+This is the stage runner of the dataset pipeline.
+It records the inputs hash, the outputs and the completion of every stage in a state file in the working directory,
+so a re-run skips the completed stages and resumes the one that didn't finish.
+"""
+
+STATE_FILE = 'pipeline_state.json'  # The name of the state file in the working directory
+
+def hash_inputs(*values):
+    """
+    Hash the inputs of a stage.
+
+    :param values: Json serializable values the stage depends on, usually starting with the previous stage's hash
+    :return: The hex digest of the values
+    """
+    return hashlib.blake2b(json.dumps(values, sort_keys=True, default=str).encode('utf8'),
+                           digest_size=16).hexdigest()
+
+def file_identity(path):
+    """
+    Get a cheap identity of a file, without reading it.
+
+    :param path: The path to the file
+    :return: The (absolute path, size, modification time) of the file
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+class StageRunner:
+    """
+    Keeps the state of the pipeline stages in the working directory.
+    """
+    def __init__(self, work_dir):
+        self.path = os.path.join(work_dir, STATE_FILE)  # The path to the state file
+        self.__stages = {}  # The state of each stage, by name
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.__stages = json.load(f)['stages']
+
+    def completed(self, name, inputs_hash):
+        """
+        Check if a stage already completed with the same inputs.
+
+        :param name: The name of the stage
+        :param inputs_hash: The current inputs hash of the stage
+        :return: The outputs of the completed stage, None if it has to run
+        """
+        stage = self.__stages.get(name)
+        if stage is None or stage['inputs_hash'] != inputs_hash or not stage['completed']:
+            return None
+        return stage['outputs']
+
+    def begin(self, name, inputs_hash):
+        """
+        Mark the start of a stage.
+        If the stage already started with the same inputs and didn't complete, its partial outputs are kept.
+
+        :param name: The name of the stage
+        :param inputs_hash: The current inputs hash of the stage
+        :return: The partial outputs of the previous attempt with the same inputs, an empty dict otherwise
+        """
+        stage = self.__stages.get(name)
+        if stage is not None and stage['inputs_hash'] == inputs_hash:
+            outputs = stage['outputs']
+        else:
+            outputs = {}
+        self.__stages[name] = {'inputs_hash': inputs_hash, 'outputs': outputs, 'completed': False,
+                               'started_at': time.time()}
+        self.__save()
+        return dict(outputs)
+
+    def update(self, name, **outputs):
+        """
+        Record partial outputs of a running stage, they are kept if the stage is resumed.
+
+        :param name: The name of the stage
+        :param outputs: The outputs to record
+        :return: None
+        """
+        self.__stages[name]['outputs'].update(outputs)
+        self.__save()
+
+    def complete(self, name, **outputs):
+        """
+        Mark a running stage as completed.
+
+        :param name: The name of the stage
+        :param outputs: The outputs of the stage
+        :return: None
+        """
+        self.__stages[name]['outputs'].update(outputs)
+        self.__stages[name]['completed'] = True
+        self.__stages[name]['completed_at'] = time.time()
+        self.__save()
+
+    def __save(self):
+        """
+        Write the state file, through a temporary file so a crash never leaves it half written.
+
+        :return: None
+        """
+        tmp_path = self.path + '.tmp'  # The path to the temporary state file
+        with open(tmp_path, 'w') as f:
+            json.dump({'stages': self.__stages}, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -1,3 +1,4 @@
+import queue
 import tkinter as tk
 
 from LoadTestWindow import LoadTestWindow
@@ -12,12 +13,34 @@ class ProjectGui:
     """
     def __init__(self):
         self.root = tk.Tk()  # Tkinter main window
+        self.progress_events = queue.Queue()  # The (task, done, total) progress events of the worker threads
+        self.training_events = queue.Queue()  # The TrainingStatus events of the running training
         self.data_handler = DataHandler(self)  # Dataset handler
         self.model_handler = ModelHandler(self, self.data_handler)  # Model handler
 
         self.__menubar = None  # The window's Exit menubar
         self.__btn = None  # The main start button
 
+    def report_progress(self, task, done, total):
+        """
+        Report the progress of a task running on a worker thread, the open window shows it.
+
+        :param task: The name of the task, e.g. Extracting
+        :param done: The number of finished items
+        :param total: The total number of items
+        :return: None
+        """
+        self.progress_events.put((task, done, total))
+
+    def report_training(self, status):
+        """
+        Report the status of the running training, the train window shows it.
+
+        :param status: The TrainingStatus of the last step
+        :return: None
+        """
+        self.training_events.put(status)
+
     def main_window(self):
         """
         Loads the start window.
@@ -0,0 +1,175 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from glob import glob
+
+import numpy as np
+
+from BasicFunctions import *
+
+"""
+This is the sharded TFRecord writer of the dataset.
+It spreads the examples over several .record shards, every shard is written by its own worker process.
+A shard is written under a temporary name and renamed when it's done, so an existing shard file is always complete.
+"""
+
+INCOMPLETE_PREFIX = 'incomplete-'  # The prefix of a shard file that is still being written
+COMPRESSION_TYPES = (None, 'GZIP', 'ZLIB')  # The supported compressions of the shards, None for uncompressed
+
+def shard_path(record_path, shard, num_shards, generation=None):
+    """
+    Get the path to a single shard.
+
+    :param record_path: The path to the record file without the shard suffix, e.g. train_labels.record
+    :param shard: The number of the shard
+    :param num_shards: The total number of shards
+    :param generation: The number of the appended batch the shard belongs to, None for the shards of the first encoding
+    :return: The shard's path, e.g. train_labels.record-00001-of-00004 or train_labels.record-g0002-00001-of-00004
+    """
+    if generation is None:
+        return '{}-{:05d}-of-{:05d}'.format(record_path, shard, num_shards)
+    return '{}-g{:04d}-{:05d}-of-{:05d}'.format(record_path, generation, shard, num_shards)
+
+def generation_files(record_path, generation):
+    """
+    Get the files of an appended batch's shards, including the shards that are still being written.
+
+    :param record_path: The path to the record file without the shard suffix, e.g. train_labels.record
+    :param generation: The number of the appended batch
+    :return: A list of the paths
+    """
+    name = '{}-g{:04d}-*'.format(os.path.basename(record_path), generation)  # The shard names of the generation
+    directory = os.path.dirname(record_path)  # The directory of the shards
+    return glob(os.path.join(directory, name)) + glob(os.path.join(directory, INCOMPLETE_PREFIX + name))
+
+def shard_pattern(record_path):
+    """
+    Get the glob pattern matching all the shards of a record file.
+    The Object Detection input reader expands the pattern and interleaves the shards.
+
+    :param record_path: The path to the record file without the shard suffix, e.g. train_labels.record
+    :return: The glob pattern of the shards
+    """
+    return record_path + '-*'
+
+def write_shard(annotation_index, images_dir, label_to_id, source, output_path, max_side=None, jpeg_quality=95,
+                compression=None):
+    """
+    Write the examples of an annotation index to a single record file.
+    Runs inside the worker processes.
+
+    :param annotation_index: The AnnotationIndex of the shard's images
+    :param images_dir: The member name of the directory of the images
+    :param label_to_id: A dict converting label string to id
+    :param source: The file source to read the images from
+    :param output_path: The path to the shard file
+    :param max_side: Downsize the images so their longer side is at most max_side, None to keep the original images
+    :param jpeg_quality: The jpg quality of the downsized images
+    :param compression: The compression of the shard, one of COMPRESSION_TYPES
+    :return: The number of examples written
+    """
+    count = 0  # The number of examples written
+    # The path the shard is written to until it's done, doesn't match the shard pattern
+    incomplete_path = os.path.join(os.path.dirname(output_path), INCOMPLETE_PREFIX + os.path.basename(output_path))
+    options = tf.io.TFRecordOptions(compression_type=compression or '')  # The compression of the shard
+    with tf.io.TFRecordWriter(incomplete_path, options=options) as writer:
+        for tf_example in iter_tf_examples(annotation_index.iter_records(), images_dir, label_to_id, source=source,
+                                           max_side=max_side, jpeg_quality=jpeg_quality):
+            writer.write(tf_example)
+            count += 1
+    os.replace(incomplete_path, output_path)
+    return count
+
+def write_sharded_records(annotation_index, images_dir, label_to_id, source, record_path, num_shards,
+                          num_workers=None, max_side=None, jpeg_quality=95, resume=False, compression=None,
+                          generation=None):
+    """
+    Write the examples of an annotation index to record shards on a pool of worker processes.
+
+    :param annotation_index: The AnnotationIndex of the images to write
+    :param images_dir: The member name of the directory of the images
+    :param label_to_id: A dict converting label string to id
+    :param source: The file source to read the images from
+    :param record_path: The path to the record file without the shard suffix, e.g. train_labels.record
+    :param num_shards: The number of shards to write, never more than the number of examples
+    :param num_workers: The number of worker processes, None for the number of cores
+    :param max_side: Downsize the images so their longer side is at most max_side, None to keep the original images
+    :param jpeg_quality: The jpg quality of the downsized images
+    :param resume: Keep the shards a previous run with the same arguments already finished, write only the rest
+    :param compression: The compression of the shards, one of COMPRESSION_TYPES
+    :param generation: The number of the appended batch, its shards are added next to the existing shards
+    :return: The paths to the shards and the number of examples written
+    """
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError('Unknown compression {}, must be one of {}'.format(compression, COMPRESSION_TYPES))
+    num_shards = max(1, min(num_shards, len(annotation_index)))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    shard_paths = [shard_path(record_path, shard, num_shards, generation) for shard in range(num_shards)]
+    shard_indexes = [annotation_index.subset(positions)
+                     for positions in np.array_split(np.arange(len(annotation_index)), num_shards)]
+
+    count = 0  # The number of examples written
+    missing = []  # The (shard index, path) of the shards to write
+    for shard_index, path in zip(shard_indexes, shard_paths):
+        if resume and os.path.isfile(path):
+            count += len(shard_index)
+        else:
+            missing.append((shard_index, path))
+    if len(missing) < num_shards:
+        PrintUtils.info(f'Resuming, {num_shards - len(missing)} of {num_shards} shards are already written')
+
+    num_workers = max(1, min(num_workers, len(missing)))
+    if num_workers == 1:
+        counts = [write_shard(shard_index, images_dir, label_to_id, source, path, max_side, jpeg_quality, compression)
+                  for shard_index, path in missing]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(write_shard, shard_index, images_dir, label_to_id, source, path,
+                                       max_side, jpeg_quality, compression)
+                       for shard_index, path in missing]
+            counts = [future.result() for future in futures]
+
+    return shard_paths, count + sum(counts)
+
+def compress_shard(input_path, output_path, compression):
+    """
+    Write a compressed copy of an uncompressed shard.
+
+    :param input_path: The path to the uncompressed shard
+    :param output_path: The path to the compressed copy
+    :param compression: The compression of the copy, one of COMPRESSION_TYPES
+    :return: None
+    """
+    incomplete_path = os.path.join(os.path.dirname(output_path), INCOMPLETE_PREFIX + os.path.basename(output_path))
+    options = tf.io.TFRecordOptions(compression_type=compression)  # The compression of the copy
+    with tf.io.TFRecordWriter(incomplete_path, options=options) as writer:
+        for serialized in tf.data.TFRecordDataset(input_path):
+            writer.write(serialized.numpy())
+    os.replace(incomplete_path, output_path)
+
+def archive_records(shard_paths, compression, archive_dir, num_workers=None):
+    """
+    Write compressed copies of shards, to archive or transfer the dataset.
+    The training reads the uncompressed shards, the Object Detection input reader can't read compressed records.
+    The copies are written on a pool of threads, a copy that already exists is kept.
+
+    :param shard_paths: The paths to the uncompressed shards
+    :param compression: The compression of the copies, 'GZIP' or 'ZLIB'
+    :param archive_dir: The path to the directory of the compressed copies
+    :param num_workers: The number of threads, None for the number of cores
+    :return: The paths to the compressed copies, in the order of the shards
+    """
+    if compression is None or compression not in COMPRESSION_TYPES:
+        raise ValueError('Unknown archive compression {}, must be one of {}'.format(compression,
+                                                                                    COMPRESSION_TYPES[1:]))
+    os.makedirs(archive_dir, exist_ok=True)
+    suffix = '.gz' if compression == 'GZIP' else '.zz'  # The extension of the compressed copies
+    archive_paths = [os.path.join(archive_dir, os.path.basename(path) + suffix) for path in shard_paths]
+    missing = [(path, archive_path) for path, archive_path in zip(shard_paths, archive_paths)
+               if not os.path.isfile(archive_path)]  # The (shard, compressed copy) of the shards to compress
+    if missing:
+        PrintUtils.info(f'Archiving {len(missing)} record files with {compression} into {archive_dir}...')
+        with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count() or 1) as executor:
+            list(executor.map(lambda item: compress_shard(item[0], item[1], compression), missing))
+    return archive_paths
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from sklearn.model_selection import GroupShuffleSplit, train_test_split
+
+"""
+This is the train/eval split manifest of the dataset.
+Instead of copying the annotation files to a directory per split, the split is saved as a small json file
+listing the members of each split, so re-splitting doesn't touch the dataset files.
+"""
+
+MATERIALIZE_MODES = ('hardlink', 'symlink', 'copy')  # The ways to create the split directories
+
+def create_split(annotation_index, train_size=0.8, seed=42, groups=None):
+    """
+    Split the images of an annotation index to train and eval.
+    If groups are given every group goes entirely to one split, so near-duplicate images don't leak between them.
+
+    :param annotation_index: The AnnotationIndex of the dataset
+    :param train_size: The part of the images that goes to train, the part of the groups if groups are given
+    :param seed: The random seed of the split
+    :param groups: The group of every image, e.g. from image_dedup.find_duplicate_groups, None for no groups
+    :return: The split manifest dict
+    """
+    positions = np.arange(len(annotation_index))  # The positions of all the images in the annotation index
+    if groups is None:
+        train, eval = train_test_split(positions, train_size=train_size, test_size=1 - train_size,
+                                       shuffle=True, random_state=seed)
+    else:
+        splitter = GroupShuffleSplit(n_splits=1, train_size=train_size, test_size=1 - train_size, random_state=seed)
+        train, eval = next(splitter.split(positions, groups=groups))
+    train = np.sort(train)
+    eval = np.sort(eval)
+    return {
+        'seed': seed,
+        'train_size': train_size,
+        'num_images': len(annotation_index),
+        'num_groups': len(annotation_index) if groups is None else len(np.unique(groups)),
+        'train': train.tolist(),
+        'eval': eval.tolist(),
+        'train_files': annotation_index.xml_names[train].tolist(),
+        'eval_files': annotation_index.xml_names[eval].tolist(),
+    }
+
+def stable_split(keys, train_size=0.8, seed=42):
+    """
+    Assign images to train or eval by a hash of a stable key, e.g. the image's file name.
+    The same key always goes to the same split, no matter what else is in the dataset,
+    so the images added to an encoded dataset never move the images that are already in it.
+
+    :param keys: The key of every image, the images with the same key go to the same split
+    :param train_size: The part of the keys that goes to train
+    :param seed: The seed mixed into the hash, a different seed gives a different assignment
+    :return: A boolean numpy array, True for the images that go to train
+    """
+    fractions = np.array([int.from_bytes(hashlib.blake2b(f'{seed}:{key}'.encode('utf8'), digest_size=8).digest(),
+                                         'big') / 2 ** 64 for key in keys], dtype=np.float64)
+    return fractions < train_size
+
+def save_split(split, path):
+    """
+    Save a split manifest to a json file.
+
+    :param split: The split manifest dict
+    :param path: The path to the json file
+    :return: None
+    """
+    with open(path, 'w') as f:
+        json.dump(split, f)
+
+def load_split(path):
+    """
+    Load a split manifest saved with save_split.
+
+    :param path: The path to the json file
+    :return: The split manifest dict
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def materialize_split(split, source, anns_dir, output_dir, mode='hardlink'):
+    """
+    Create a directory of annotation files for each split, for anyone who still needs the files on disk.
+
+    :param split: The split manifest dict
+    :param source: The file source of the dataset
+    :param anns_dir: The member name of the directory of the annotations in the source
+    :param output_dir: The path to the directory to create the training/ and evaluating/ directories in
+    :param mode: How to create the files, one of MATERIALIZE_MODES
+    :return: The paths to the (train, eval) directories
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError('Unknown materialize mode {}, must be one of {}'.format(mode, ', '.join(MATERIALIZE_MODES)))
+
+    train_dir = os.path.join(output_dir, 'training/')  # The directory of the split train data
+    eval_dir = os.path.join(output_dir, 'evaluating/')  # The directory of the split eval data
+    for split_dir, files in ((train_dir, split['train_files']), (eval_dir, split['eval_files'])):
+        os.mkdir(split_dir)
+        for xml_name in files:
+            source.materialize(anns_dir + '/' + xml_name, split_dir, mode)
+    return train_dir, eval_dir
@@ -0,0 +1,167 @@
+import atexit
+import os
+import re
+import socket
+import subprocess
+import threading
+
+from BasicFunctions import *
+
+try:
+    from tensorboard import manager as tb_manager
+except ImportError:
+    tb_manager = None
+
+"""
+This is the TensorBoard server of the training sessions.
+The server starts next to the training instead of before it, it binds a free port (--port=0)
+and the port is found by reading the server's output, or by the info file TensorBoard writes for every server.
+A server that already serves the same log directory, started by this run of the app or an earlier one, is reused,
+e.g. when a training directory is trained again. Every training session has its own directory,
+so a new session gets a new server and the server of the previous session is stopped.
+"""
+
+URL_PATTERN = re.compile(r'TensorBoard \S+ at (http://\S+?)/? ')  # The serving line TensorBoard prints
+
+def is_serving(port, host='localhost'):
+    """
+    Probe if a server accepts connections on a port.
+
+    :param port: The port
+    :param host: The host of the server
+    :return: True if a connection was accepted
+    """
+    try:
+        with socket.create_connection((host, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+class TensorBoardManager:
+    """
+    Starts, finds and stops the TensorBoard server of a log directory.
+    """
+    def __init__(self, on_ready=None):
+        self.on_ready = on_ready  # A function called with the url once the server serves
+        self.logdir = None  # The log directory of the current server
+        self.url = None  # The url of the current server, None until it serves
+        self.__process = None  # The server process, None if the server wasn't started by this manager
+        self.__ready = threading.Event()  # Set once the url is known or the server failed
+        self.__output = []  # The last output lines of the server, for the error message if it fails
+        atexit.register(self.stop)
+
+    def start(self, logdir):
+        """
+        Start serving a log directory without waiting for the server.
+        A running server of the same directory is reused, the server of another directory is stopped first.
+
+        :param logdir: The path to the log directory
+        :return: None
+        """
+        logdir = os.path.abspath(logdir)
+        if logdir == self.logdir and (self.__process is None or self.__process.poll() is None) and self.url:
+            PrintUtils.info(f'TensorBoard is already serving {logdir} at {self.url}')
+            return
+        self.stop()
+        self.logdir = logdir
+        self.__ready.clear()
+        self.__output = []
+
+        url = self.__find_existing(logdir)  # The url of a server of a previous session
+        if url is not None:
+            self.__set_url(url)
+            return
+
+        try:
+            self.__process = subprocess.Popen(['tensorboard', f'--logdir={logdir}/', '--host=localhost', '--port=0'],
+                                              env=os.environ.copy(), stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT, universal_newlines=True)
+        except OSError as e:
+            PrintUtils.error(f'Unable to start TensorBoard: {e}')
+            self.__ready.set()
+            return
+        threading.Thread(target=self.__read_output, args=(self.__process,), daemon=True).start()
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until the server serves, only for the callers that need the url.
+
+        :param timeout: The max seconds to wait, None to wait until it serves or fails
+        :return: The url, None if the server isn't serving
+        """
+        self.__ready.wait(timeout)
+        return self.url
+
+    def stop(self):
+        """
+        Stop the server if this manager started it, a reused server of another session keeps running.
+
+        :return: None
+        """
+        process = self.__process  # The server process, forgotten first so its reader thread doesn't report it
+        self.__process = None
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.logdir = None
+        self.url = None
+
+    def __read_output(self, process):
+        """
+        Read the output of the server until it exits, and find its url.
+        Runs on its own thread.
+
+        :param process: The server process
+        :return: None
+        """
+        for line in process.stdout:
+            self.__output = (self.__output + [line.rstrip()])[-20:]
+            if self.url is None:
+                match = URL_PATTERN.search(line)
+                if match is not None:
+                    self.__set_url(match.group(1))
+                elif tb_manager is not None:
+                    # The serving line changed between TensorBoard versions, the info file has the port too
+                    url = self.__find_existing(self.logdir, pid=process.pid)
+                    if url is not None:
+                        self.__set_url(url)
+        if self.url is None and process is self.__process:
+            PrintUtils.error('TensorBoard failed to start:\n{}'.format('\n'.join(self.__output)))
+        self.__ready.set()
+
+    def __set_url(self, url):
+        """
+        Set the url of the server and report it.
+
+        :param url: The url of the server
+        :return: None
+        """
+        self.url = url
+        self.__ready.set()
+        PrintUtils.info(f'TensorBoard is serving at {url}')
+        if self.on_ready is not None:
+            self.on_ready(url)
+
+    @staticmethod
+    def __find_existing(logdir, pid=None):
+        """
+        Find a running TensorBoard server of a log directory, by the info files TensorBoard writes.
+        An info file can outlive its server, so the port is probed before it's used.
+
+        :param logdir: The path to the log directory
+        :param pid: Only find the server of this process id, None for any server
+        :return: The url of the server, None if there isn't one or tensorboard isn't importable
+        """
+        if tb_manager is None:
+            return None
+        try:
+            for info in tb_manager.get_all():
+                if ((pid is None or info.pid == pid) and info.logdir.rstrip('/\\') == logdir.rstrip('/\\')
+                        and is_serving(info.port)):
+                    return f'http://localhost:{info.port}'
+        except Exception:
+            pass  # A broken info file isn't a reason to fail the training
+        return None
@@ -0,0 +1,199 @@
+import csv
+import json
+import os
+import re
+import time
+from glob import glob
+
+import numpy as np
+import tensorflow as tf
+
+"""
+This is the metrics timeline of a training session.
+It collects the throughput, the input pipeline stall and the losses of the training steps,
+from the status of the in-process training, the output of a model_main_tf2.py training
+and the train event files in the training directory, into a timeline and a summary next to the checkpoints:
+training_metrics.jsonl is written while training, training_metrics.csv and training_metrics_summary.json at the end.
+"""
+
+METRICS_FILE = 'training_metrics'  # The name of the metrics files in the training directory, without the extension
+TIMELINE_FIELDS = ('step', 'time', 'steps_per_sec', 'examples_per_sec', 'input_wait', 'total_loss', 'learning_rate',
+                   'eta_seconds')  # The columns of the timeline
+STEP_PATTERN = re.compile(r'Step (\d+) per-step time ([\d.]+)s')  # The step line model_main_tf2.py logs
+# The total loss in the losses model_main_tf2.py logs after a step line
+LOSS_PATTERN = re.compile(r"'Loss/total_loss': (?:np\.float32\()?([-\d.e]+)")
+WARMUP_STEPS = 10  # The first steps build the graph and fill the input pipeline, they're left out of the summary
+
+def read_scalars(event_dir, tags=None):
+    """
+    Read the scalar summaries of the event files in a directory.
+
+    :param event_dir: The path to the directory of the event files, e.g. the train directory of a training
+    :param tags: The tags to read, None for all the scalars
+    :return: A dict of step to a dict of tag to value
+    """
+    scalars = {}  # Step to the scalars of the step
+    for path in sorted(glob(os.path.join(event_dir, 'events.out.tfevents.*'))):
+        try:
+            for event in tf.compat.v1.train.summary_iterator(path):
+                for value in event.summary.value:
+                    if tags is not None and value.tag not in tags:
+                        continue
+                    if value.HasField('simple_value'):
+                        scalars.setdefault(event.step, {})[value.tag] = value.simple_value
+                    elif (value.HasField('tensor') and not value.tensor.tensor_shape.dim and
+                          value.tensor.dtype in (tf.float32.as_datatype_enum, tf.float64.as_datatype_enum)):
+                        scalars.setdefault(event.step, {})[value.tag] = float(tf.make_ndarray(value.tensor))
+        except tf.errors.DataLossError:
+            pass  # The last record of a file that is still being written
+    return scalars
+
+class MetricsCollector:
+    """
+    Collects the metrics of a training session into a timeline.
+    """
+    def __init__(self, training_dir, num_steps, batch_size, smoothing=0.1):
+        self.training_dir = training_dir  # The path to the training directory
+        self.num_steps = num_steps  # The step the training trains until, 0 or less if it trains until cancelled
+        self.batch_size = batch_size  # The number of examples of a step
+        self.smoothing = smoothing  # The weight of the last step in the smoothed steps/sec of the ETA
+        self.rows = {}  # The timeline, step to its row
+        self.__start_time = time.time()  # The time the collection started
+        self.__smoothed_rate = None  # The smoothed steps/sec
+        self.__pending_step = None  # The (step, per-step time) of the last step line, waiting for its losses
+        self.__jsonl = open(os.path.join(training_dir, METRICS_FILE + '.jsonl'), 'a')  # The live timeline file
+
+    def on_status(self, status):
+        """
+        Add the status of an in-process training step, a callback of the TrainingRunner.
+
+        :param status: The TrainingStatus of the step
+        :return: None
+        """
+        self.__add_row(status.step, status.steps_per_sec, input_wait=status.input_wait,
+                       total_loss=status.losses.get('Loss/total_loss'), learning_rate=status.learning_rate)
+
+    def on_output_line(self, line):
+        """
+        Add the steps a model_main_tf2.py training logs, a step line is followed by the step's losses.
+
+        :param line: A line of the training's output
+        :return: None
+        """
+        match = STEP_PATTERN.search(line)
+        if match is not None:
+            self.__pending_step = (int(match.group(1)), float(match.group(2)))
+            return
+        match = LOSS_PATTERN.search(line)
+        if match is not None and self.__pending_step is not None:
+            step, step_time = self.__pending_step
+            self.__pending_step = None
+            self.__add_row(step, 1.0 / step_time if step_time > 0 else None, total_loss=float(match.group(1)))
+
+    def __add_row(self, step, steps_per_sec, input_wait=None, total_loss=None, learning_rate=None):
+        """
+        Add a step to the timeline and append it to the live timeline file.
+
+        :return: None
+        """
+        if steps_per_sec is not None:
+            self.__smoothed_rate = steps_per_sec if self.__smoothed_rate is None else (
+                self.smoothing * steps_per_sec + (1 - self.smoothing) * self.__smoothed_rate)
+        eta = None  # The seconds left until num_steps, at the smoothed rate
+        if self.__smoothed_rate and self.num_steps > 0:
+            eta = max(0, self.num_steps - step) / self.__smoothed_rate
+        row = {'step': step, 'time': round(time.time() - self.__start_time, 3),
+               'steps_per_sec': steps_per_sec,
+               'examples_per_sec': steps_per_sec * self.batch_size if steps_per_sec is not None else None,
+               'input_wait': input_wait, 'total_loss': total_loss, 'learning_rate': learning_rate,
+               'eta_seconds': round(eta, 1) if eta is not None else None}
+        self.rows[step] = row
+        self.__jsonl.write(json.dumps(row) + '\n')
+        self.__jsonl.flush()
+
+    def read_event_files(self):
+        """
+        Fill the timeline from the train event files, for the steps the status or the output didn't report,
+        e.g. the steps between the log lines of a model_main_tf2.py training.
+
+        :return: The number of added steps
+        """
+        scalars = read_scalars(os.path.join(self.training_dir, 'train'),
+                               ('steps_per_sec', 'Loss/total_loss', 'learning_rate', 'input_wait'))
+        added = 0  # The number of added steps
+        for step in sorted(set(scalars) - set(self.rows)):
+            values = scalars[step]
+            steps_per_sec = values.get('steps_per_sec')
+            self.rows[step] = {'step': step, 'time': None, 'steps_per_sec': steps_per_sec,
+                               'examples_per_sec': steps_per_sec * self.batch_size if steps_per_sec else None,
+                               'input_wait': values.get('input_wait'), 'total_loss': values.get('Loss/total_loss'),
+                               'learning_rate': values.get('learning_rate'), 'eta_seconds': None}
+            added += 1
+        return added
+
+    def summarize(self):
+        """
+        Summarize the timeline, the throughput leaves out the warmup steps.
+
+        :return: The summary dict
+        """
+        steps = sorted(self.rows)  # The steps of the timeline
+        measured = [self.rows[step] for step in steps[WARMUP_STEPS:] if self.rows[step]['steps_per_sec']]
+        rates = np.array([row['steps_per_sec'] for row in measured], dtype=np.float64)  # The steps/sec of the steps
+        waits = np.array([row['input_wait'] for row in measured if row['input_wait'] is not None], dtype=np.float64)
+        losses = [self.rows[step]['total_loss'] for step in steps if self.rows[step]['total_loss'] is not None]
+
+        summary = {'num_steps': self.num_steps, 'last_step': steps[-1] if steps else 0, 'batch_size': self.batch_size,
+                   'wall_seconds': round(time.time() - self.__start_time, 1), 'measured_steps': len(measured)}
+        if len(rates):
+            summary['steps_per_sec'] = {'mean': round(float(len(rates) / np.sum(1 / rates)), 4),
+                                        'median': round(float(np.median(rates)), 4),
+                                        'p10': round(float(np.percentile(rates, 10)), 4),
+                                        'p90': round(float(np.percentile(rates, 90)), 4)}
+            summary['examples_per_sec'] = round(summary['steps_per_sec']['mean'] * self.batch_size, 2)
+        if len(waits):
+            # The part of the step time spent waiting for the input pipeline
+            step_times = np.array([1 / row['steps_per_sec'] for row in measured if row['input_wait'] is not None])
+            summary['input_wait'] = {'mean_seconds': round(float(np.mean(waits)), 4),
+                                     'fraction': round(float(np.sum(waits) / np.sum(step_times)), 4)}
+        if losses:
+            summary['total_loss'] = {'first': losses[0], 'last': losses[-1], 'min': min(losses)}
+        return summary
+
+    def close(self):
+        """
+        Fill the timeline from the event files and write the timeline csv and the summary.
+
+        :return: The summary dict
+        """
+        self.__jsonl.close()
+        self.read_event_files()
+        with open(os.path.join(self.training_dir, METRICS_FILE + '.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=TIMELINE_FIELDS)
+            writer.writeheader()
+            for step in sorted(self.rows):
+                writer.writerow(self.rows[step])
+        summary = self.summarize()
+        with open(os.path.join(self.training_dir, METRICS_FILE + '_summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+def summary_lines(summary):
+    """
+    Get the readable lines of a metrics summary.
+
+    :param summary: The summary dict
+    :return: A list of lines
+    """
+    of_steps = f' of {summary["num_steps"]}' if summary['num_steps'] > 0 else ''  # Unbounded trainings have no end
+    lines = [f'Trained until step {summary["last_step"]}{of_steps} in {summary["wall_seconds"] / 60:.1f} minutes']
+    if 'steps_per_sec' in summary:
+        lines.append('{:.2f} steps/s (10%-90% {:.2f} - {:.2f}), {:.1f} examples/s'.format(
+            summary['steps_per_sec']['mean'], summary['steps_per_sec']['p10'], summary['steps_per_sec']['p90'],
+            summary['examples_per_sec']))
+    if 'input_wait' in summary:
+        lines.append('Waited for the input pipeline {:.1%} of the step time'.format(summary['input_wait']['fraction']))
+    if 'total_loss' in summary:
+        lines.append('Total loss {:.4f} -> {:.4f} (min {:.4f})'.format(
+            summary['total_loss']['first'], summary['total_loss']['last'], summary['total_loss']['min']))
+    return lines
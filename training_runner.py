@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import tensorflow as tf
+from object_detection import inputs, model_lib_v2
+from object_detection.builders import model_builder, optimizer_builder
+from object_detection.utils import config_util
+
+"""
+This is the in-process training runner of the Object Detection API.
+It runs the model_lib_v2 training loop in the current process, built from the same model_lib_v2 pieces
+model_main_tf2.py uses, so a training session doesn't pay the interpreter and TensorFlow start-up of a subprocess.
+Every step reports its status to callbacks, and the training can be cancelled cleanly between steps.
+The checkpoints and the train summaries are written to the model directory like model_main_tf2.py writes them.
+"""
+
+# The status of the training after a step.
+# losses is a dict of loss name to value, e.g. Loss/total_loss.
+# input_wait is the seconds the step waited for its batch, the stall of the input pipeline.
+TrainingStatus = namedtuple('TrainingStatus', ['step', 'num_steps', 'losses', 'learning_rate', 'steps_per_sec',
+                                               'examples_per_sec', 'input_wait', 'elapsed'])
+
+class TrainingRunner:
+    """
+    Runs the training of a pipeline config in the current process.
+    The run resumes from the latest checkpoint in the model directory, if there is one.
+    """
+    def __init__(self, pipeline_config_path, model_dir, checkpoint_every_n=1000, checkpoint_max_to_keep=7,
+                 report_every_n=1):
+        self.pipeline_config_path = pipeline_config_path  # The path to the pipeline.config file
+        self.model_dir = model_dir  # The path to the directory of the checkpoints and the summaries
+        self.checkpoint_every_n = checkpoint_every_n  # The number of steps between checkpoints
+        self.checkpoint_max_to_keep = checkpoint_max_to_keep  # The number of checkpoints to keep
+        self.report_every_n = report_every_n  # The number of steps between the callbacks
+        self.callbacks = []  # The functions called with the TrainingStatus of every reported step
+        self.__cancel_event = threading.Event()  # Set to stop the training after the current step
+
+    def add_callback(self, callback):
+        """
+        Add a function to call with the status of the training.
+        The callbacks run on the training thread, a gui should only queue the status.
+
+        :param callback: A function that gets a TrainingStatus
+        :return: None
+        """
+        self.callbacks.append(callback)
+
+    def cancel(self):
+        """
+        Stop the training after the current step, a checkpoint of the last step is saved.
+        Can be called from any thread.
+
+        :return: None
+        """
+        self.__cancel_event.set()
+
+    @property
+    def cancelled(self):
+        """
+        :return: True if the training was cancelled
+        """
+        return self.__cancel_event.is_set()
+
+    def run(self):
+        """
+        Run the training until the pipeline's num_steps or until it's cancelled.
+        A num_steps of 0 trains indefinitely like in model_main_tf2.py, until the training is cancelled.
+
+        :return: The last TrainingStatus, None if no step ran
+        """
+        configs = config_util.get_configs_from_pipeline_file(self.pipeline_config_path)
+        model_config = configs['model']  # The model config of the pipeline
+        train_config = configs['train_config']  # The train config of the pipeline
+        train_input_config = configs['train_input_config']  # The train input reader config of the pipeline
+        unpad_groundtruth_tensors = train_config.unpad_groundtruth_tensors
+        add_regularization_loss = train_config.add_regularization_loss
+        clip_gradients_value = None  # The gradients clipping norm, None for no clipping
+        if train_config.gradient_clipping_by_norm > 0:
+            clip_gradients_value = train_config.gradient_clipping_by_norm
+        if train_config.load_all_detection_checkpoint_vars:
+            raise ValueError('train_pb2.load_all_detection_checkpoint_vars unsupported in TF2')
+
+        strategy = tf.distribute.get_strategy()  # The default strategy, the training runs on a single device
+        summary_writer = tf.summary.create_file_writer(os.path.join(self.model_dir, 'train'))
+        with summary_writer.as_default(), strategy.scope():
+            detection_model = model_builder.build(model_config=model_config, is_training=True)
+
+            def train_dataset_fn(input_context):
+                train_input = inputs.train_input(train_config=train_config, train_input_config=train_input_config,
+                                                 model_config=model_config, model=detection_model,
+                                                 input_context=input_context)
+                return train_input.repeat()
+
+            train_input = strategy.experimental_distribute_datasets_from_function(train_dataset_fn)
+            global_step = tf.Variable(0, trainable=False, dtype=tf.int64, name='global_step',
+                                      aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+            optimizer, (learning_rate,) = optimizer_builder.build(train_config.optimizer, global_step=global_step)
+            learning_rate_fn = learning_rate if callable(learning_rate) else (lambda: learning_rate)
+
+            # Load the fine tune checkpoint, the latest checkpoint of the model directory overrides it
+            if train_config.fine_tune_checkpoint:
+                model_lib_v2.load_fine_tune_checkpoint(
+                    detection_model, train_config.fine_tune_checkpoint, train_config.fine_tune_checkpoint_type,
+                    train_config.fine_tune_checkpoint_version, train_config.run_fine_tune_checkpoint_dummy_computation,
+                    train_input, unpad_groundtruth_tensors)
+            checkpoint = tf.train.Checkpoint(step=global_step, model=detection_model, optimizer=optimizer)
+            manager = tf.train.CheckpointManager(checkpoint, self.model_dir, max_to_keep=self.checkpoint_max_to_keep)
+            checkpoint.restore(tf.train.latest_checkpoint(self.model_dir))
+
+            def train_step_fn(features, labels):
+                losses_dict = model_lib_v2.eager_train_step(
+                    detection_model, features, labels, unpad_groundtruth_tensors, optimizer,
+                    add_regularization_loss=add_regularization_loss, clip_gradients_value=clip_gradients_value,
+                    num_replicas=strategy.num_replicas_in_sync)
+                global_step.assign_add(1)
+                return losses_dict
+
+            # The batch is fetched outside of the step function, so the time the step waits for it can be measured
+            @tf.function
+            def train_step(features, labels):
+                per_replica_losses = strategy.run(train_step_fn, args=(features, labels))
+                return {name: strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+                        for name, loss in per_replica_losses.items()}
+
+            return self.__train_loop(train_step, iter(train_input), global_step, learning_rate_fn, manager,
+                                     train_config.num_steps, train_config.batch_size)
+
+    def __train_loop(self, train_step, data_iterator, global_step, learning_rate_fn, manager, num_steps, batch_size):
+        """
+        Run the training steps, report them to the callbacks and save the checkpoints.
+
+        :param train_step: The tf.function of a single training step, gets the features and labels of a batch
+        :param data_iterator: The iterator of the distributed train input
+        :param global_step: The global step variable
+        :param learning_rate_fn: A function returning the current learning rate
+        :param manager: The CheckpointManager of the model directory
+        :param num_steps: The step to train until, 0 or less to train until cancelled
+        :param batch_size: The number of examples of a step
+        :return: The last TrainingStatus, None if no step ran
+        """
+        status = None  # The status of the last step
+        start_time = time.time()  # The time the loop started
+        checkpointed_step = int(global_step.value())  # The step of the last checkpoint
+        last_step_time = time.time()  # The time the last step finished
+        while (num_steps <= 0 or int(global_step.value()) < num_steps) and not self.cancelled:
+            features, labels = next(data_iterator)
+            input_wait = time.time() - last_step_time  # The time the step waited for the input pipeline
+            losses = train_step(features, labels)  # The losses of the step
+            step_time = time.time() - last_step_time  # The time the step took
+            last_step_time = time.time()
+            step = int(global_step.value())
+
+            steps_per_sec = 1.0 / step_time
+            learning_rate = learning_rate_fn()
+            tf.summary.scalar('steps_per_sec', steps_per_sec, step=global_step)
+            tf.summary.scalar('learning_rate', learning_rate, step=global_step)
+            tf.summary.scalar('input_wait', input_wait, step=global_step)
+            for name, value in losses.items():
+                tf.summary.scalar(name, value, step=global_step)
+
+            if step - checkpointed_step >= self.checkpoint_every_n:
+                manager.save()
+                checkpointed_step = step
+
+            if step % self.report_every_n == 0 or 0 < num_steps <= step:
+                status = TrainingStatus(step, num_steps, {name: float(value) for name, value in losses.items()},
+                                        float(learning_rate), steps_per_sec, steps_per_sec * batch_size,
+                                        input_wait, last_step_time - start_time)
+                for callback in self.callbacks:
+                    callback(status)
+
+        # Keep the last step, a cancelled run resumes from it
+        if int(global_step.value()) > checkpointed_step:
+            manager.save()
+        return status
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+"""
+This is the persistent validation cache of the dataset.
+It stores the validation verdict and the parsed objects of every annotation file in a SQLite file,
+keyed by the fingerprints of the annotation and its image (the CRC and size of their zip members),
+so unchanged files aren't validated again.
+"""
+
+__HASH_CHUNK_SIZE = 1 << 20  # The number of bytes read at once when hashing a file
+__read_connections = {}  # The read only connections of the current process, by cache path
+
+def file_hash(path):
+    """
+    Calculate the content hash of a file.
+
+    :param path: The path to the file
+    :return: The hex digest of the file's content
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(__HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def lookup(cache_path, xml_name):
+    """
+    Get the cached entry of an annotation file.
+    Used by the validation workers, every process opens its own read only connection.
+
+    :param cache_path: The path to the cache file
+    :param xml_name: The name of the annotation file
+    :return: The (xml_hash, image_name, image_hash, valid, errors, record) entry, None if the file isn't cached
+    """
+    connection = __read_connections.get(cache_path)
+    if connection is None:
+        connection = sqlite3.connect(Path(cache_path).absolute().as_uri() + '?mode=ro', uri=True)
+        __read_connections[cache_path] = connection
+
+    row = connection.execute('SELECT xml_hash, image_name, image_hash, valid, errors, record '
+                             'FROM validation WHERE xml_name = ?', (xml_name,)).fetchone()
+    if row is None:
+        return None
+    xml_hash, image_name, image_hash, valid, errors, record = row
+    if record is not None:
+        record = json.loads(record)
+        record = (*record[:4], [tuple(obj) for obj in record[4]])
+    return xml_hash, image_name, image_hash, bool(valid), json.loads(errors), record
+
+class ValidationCache:
+    """
+    The writer side of the validation cache.
+    Only the main process writes to the cache, the workers read it with lookup.
+    """
+    def __init__(self, path):
+        self.path = path  # The path to the cache file
+        self.hits = 0  # The number of files taken from the cache
+        self.misses = 0  # The number of files that were validated
+
+        self.__connection = sqlite3.connect(path)  # The connection to the cache file
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS validation ('
+                                  'xml_name TEXT PRIMARY KEY, xml_hash TEXT NOT NULL, '
+                                  'image_name TEXT, image_hash TEXT, valid INTEGER NOT NULL, '
+                                  'errors TEXT NOT NULL, record TEXT)')
+        self.__connection.commit()
+
+    def put_many(self, entries):
+        """
+        Store the validation results of annotation files.
+
+        :param entries: An iterable of (xml_name, xml_hash, image_name, image_hash, valid, errors, record) entries
+        :return: None
+        """
+        self.__connection.executemany(
+            'INSERT OR REPLACE INTO validation VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((xml_name, xml_hash, image_name, image_hash, int(valid), json.dumps(errors),
+              None if record is None else json.dumps(record))
+             for xml_name, xml_hash, image_name, image_hash, valid, errors, record in entries))
+        self.__connection.commit()
+
+    def close(self):
+        """
+        Close the cache file.
+
+        :return: None
+        """
+        self.__connection.close()
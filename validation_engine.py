@@ -0,0 +1,358 @@
+import os
+import xml.etree.ElementTree as ET
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+
+import validation_cache
+from annotation_importers import read_yolo_entry
+from image_probe import probe_image_file
+
+"""
+This is the dataset validation engine.
+It validates the annotation files and their images on a pool of worker processes.
+"""
+
+# The validation result of a single annotation file.
+# cache_entry is the entry to store in the validation cache, None if the result was taken from the cache
+ValidationResult = namedtuple('ValidationResult', ['xml_file', 'valid', 'errors', 'record', 'cache_hit', 'cache_entry'])
+
+def validate_annotation(source, xml_file, images_dir='images', image_ext='jpg'):
+    """
+    Validate a single annotation file and its image.
+    This function runs inside the worker processes so it doesn't print anything,
+    the error messages are returned to the caller instead.
+
+    :param source: The file source of the dataset
+    :param xml_file: The member name of the xml annotation file
+    :param images_dir: The member name of the directory of the images
+    :param image_ext: The extension of the images
+    :return: A tuple (xml_file, valid, errors, record), errors is a list of the error messages found in the file,
+             record is the parsed (xml_name, filename, width, height, objects) of a valid file, None otherwise
+    """
+    errors = []  # The error messages of the current file
+    error = False  # If there is an error in the file
+
+    xml_file_name = xml_file.split('/')[-1]  # The current file's name
+    try:
+        with source.open(xml_file) as f:
+            xml_tree = ET.parse(f)  # The xml tree
+        xml_root = xml_tree.getroot()  # The root element of the xml file
+    except Exception:
+        errors.append(f'Error parsing file {xml_file_name}')
+        error = True
+
+    if not error:
+        try:
+            filename = xml_root.find('filename').text  # The filename taken from the label file
+        except Exception:
+            errors.append(f'Error in file {xml_file_name}, reading filename attribute ')
+            error = True
+
+        try:
+            img_width = int(xml_root.find('size').find('width').text)  # The image width taken from the label file
+        except Exception:
+            errors.append(f'Error in file {xml_file_name}, reading width attribute')
+            error = True
+
+        try:
+            img_height = int(xml_root.find('size').find('height').text)  # The image height taken from the label file
+        except Exception:
+            errors.append(f'Error in file {xml_file_name}, reading height attribute')
+            error = True
+
+        try:
+            xml_objects = xml_root.findall('object')  # The image's objects taken from the label file
+        except Exception:
+            errors.append(f'Error in file {xml_file_name}, reading objects')
+            error = True
+
+    if not error:
+        objects = []  # The objects in the current label file
+        for i, member in enumerate(xml_objects):
+            obj_err = False  # There is an error in the current object
+
+            try:
+                clazz = member.find('name').text  # The class of the current object
+            except Exception:
+                errors.append(f'Error in file {xml_file_name}, object {i}, reading class name attribute')
+                obj_err = True
+                error = True
+
+            bndbox = member.find('bndbox')  # The bounding box element of the current object
+            if bndbox is None:
+                errors.append(f'Error in file {xml_file_name}, object {i}, reading bndbox attribute')
+                obj_err = True
+                error = True
+
+            if not obj_err:
+                try:
+                    xmin = int(bndbox.find('xmin').text)  # The left bound of the current object
+                except Exception:
+                    errors.append(f'Error in file {xml_file_name}, object {i}, reading xmin attribute')
+                    obj_err = True
+                    error = True
+                try:
+                    ymin = int(bndbox.find('ymin').text)  # The bottom bound of the current object
+                except Exception:
+                    errors.append(f'Error in file {xml_file_name}, object {i}, reading ymin attribute')
+                    obj_err = True
+                    error = True
+                try:
+                    xmax = int(bndbox.find('xmax').text)  # The right bound of the current object
+                except Exception:
+                    errors.append(f'Error in file {xml_file_name}, object {i}, reading xmax attribute')
+                    obj_err = True
+                    error = True
+                try:
+                    ymax = int(bndbox.find('ymax').text)  # The top bound of the current object
+                except Exception:
+                    errors.append(f'Error in file {xml_file_name}, object {i}, reading ymax attribute')
+                    obj_err = True
+                    error = True
+
+            if not obj_err:
+                objects.append((clazz, xmin, ymin, xmax, ymax))
+
+    if error:
+        errors.append(f'Error(s) in file {xml_file_name}')
+        return xml_file, False, errors, None
+    return (xml_file, *check_label(source, xml_file_name, filename + '.' + image_ext, img_width, img_height, objects,
+                                   images_dir, errors))
+
+def check_label(source, label_name, image_name, width, height, objects, images_dir='images', errors=None,
+                normalized=False):
+    """
+    Check the parsed label of a single image against its image, for any annotation format.
+    This function runs inside the worker processes so it doesn't print anything.
+    The geometry of the boxes is checked later for the whole dataset at once, by box_rules.
+
+    :param source: The file source of the dataset
+    :param label_name: The name of the label in the error messages, e.g. the annotation file's name
+    :param image_name: The file name of the image, with its extension
+    :param width: The image width taken from the label, None if the label has no size
+    :param height: The image height taken from the label, None if the label has no size
+    :param objects: A list of (class, xmin, ymin, xmax, ymax) tuples
+    :param images_dir: The member name of the directory of the images
+    :param errors: The list to add the error messages to, None for a new list
+    :param normalized: The coordinates of the objects are relative to the image size, like in YOLO labels
+    :return: A tuple (valid, errors, record), record is the (label_name, image_name, width, height, objects)
+             of a valid label, None otherwise
+    """
+    errors = [] if errors is None else errors
+    error = False  # If there is an error in the label
+    try:
+        img_name = images_dir + '/' + image_name  # The member name of the image file
+        with source.open(img_name) as f:
+            org_width, org_height = probe_image_file(f)  # The real image dimentions, read from the image header
+    except Exception:
+        errors.append(f'Error in file {label_name}, filename attribute ')
+        error = True
+
+    if not error:
+        if normalized:
+            objects = [(clazz, int(round(xmin * org_width)), int(round(ymin * org_height)),
+                        int(round(xmax * org_width)), int(round(ymax * org_height)))
+                       for clazz, xmin, ymin, xmax, ymax in objects]
+        if width is not None and not org_width == width:
+            errors.append(f'Error in file {label_name}, width {width} != {org_width}')
+            error = True
+        if height is not None and not org_height == height:
+            errors.append(f'Error in file {label_name}, width {height} != {org_height}')
+            error = True
+
+    if error:
+        errors.append(f'Error(s) in file {label_name}')
+        return False, errors, None
+    return True, errors, (label_name, image_name, org_width, org_height, objects)
+
+def validate_uncached(source, xml_file, images_dir, image_ext):
+    """
+    Validate a single annotation file and its image without the validation cache.
+
+    :param source: The file source of the dataset
+    :param xml_file: The member name of the xml annotation file
+    :param images_dir: The member name of the directory of the images
+    :param image_ext: The extension of the images
+    :return: The ValidationResult of the file
+    """
+    return ValidationResult(*validate_annotation(source, xml_file, images_dir, image_ext), False, None)
+
+def validate_annotation_cached(source, xml_file, images_dir, image_ext, cache_path):
+    """
+    Validate a single annotation file and its image, using the validation cache.
+    The file is validated only if the content of the annotation or its image changed since it was cached.
+
+    :param source: The file source of the dataset
+    :param xml_file: The member name of the xml annotation file
+    :param images_dir: The member name of the directory of the images
+    :param image_ext: The extension of the images
+    :param cache_path: The path to the validation cache file
+    :return: The ValidationResult of the file
+    """
+    xml_name = xml_file.split('/')[-1]  # The current file's name
+    xml_hash = source.fingerprint(xml_file)  # The content fingerprint of the annotation file
+
+    cached = validation_cache.lookup(cache_path, xml_name)  # The cached entry of the file
+    if cached is not None and cached[0] == xml_hash:
+        _, image_name, image_hash, valid, errors, record = cached
+        if image_name is None:
+            # The annotation can't point to an image, its verdict doesn't depend on one
+            return ValidationResult(xml_file, valid, errors, record, True, None)
+        image_file = images_dir + '/' + image_name  # The member name of the image file
+        if source.exists(image_file) and source.fingerprint(image_file) == image_hash:
+            return ValidationResult(xml_file, valid, errors, record, True, None)
+
+    xml_file, valid, errors, record = validate_annotation(source, xml_file, images_dir, image_ext)
+
+    if record is not None:
+        image_name = record[1]
+    else:
+        try:
+            with source.open(xml_file) as f:
+                image_name = ET.parse(f).getroot().find('filename').text + '.' + image_ext
+        except Exception:
+            image_name = None  # The annotation file doesn't name its image
+    image_file = None if image_name is None else images_dir + '/' + image_name  # The member name of the image file
+    image_hash = source.fingerprint(image_file) \
+        if image_file is not None and source.exists(image_file) else None  # The content fingerprint of the image
+
+    return ValidationResult(xml_file, valid, errors, record, False,
+                            (xml_name, xml_hash, image_name, image_hash, valid, errors, record))
+
+def validate_annotations(source, xml_files, images_dir='images', image_ext='jpg', num_workers=None, chunk_size=None,
+                         cache_path=None):
+    """
+    Validate the given annotation files on a pool of worker processes.
+    The files are sent to the workers in chunks and the results are yielded in the order of xml_files,
+    so the output doesn't depend on which worker finished first.
+
+    :param source: The file source of the dataset, every worker reads it with its own handles
+    :param xml_files: A list of member names of the xml annotation files
+    :param images_dir: The member name of the directory of the images
+    :param image_ext: The extension of the images
+    :param num_workers: The number of worker processes, None for the number of cores
+    :param chunk_size: The number of files sent to a worker at once, None to pick one from the number of files
+    :param cache_path: The path to an existing validation cache file, None to validate every file
+    :return: A generator of ValidationResult, one for each file in xml_files
+    """
+    if cache_path is None:
+        validate_func = validate_uncached
+        args = (repeat(images_dir), repeat(image_ext))
+    else:
+        validate_func = validate_annotation_cached
+        args = (repeat(images_dir), repeat(image_ext), repeat(cache_path))
+    yield from run_on_pool(validate_func, len(xml_files), repeat(source), xml_files, *args,
+                           num_workers=num_workers, chunk_size=chunk_size)
+
+def run_chunk(func, calls):
+    """
+    Run a function over a chunk of calls inside a worker process.
+
+    :param func: The function to run
+    :param calls: A list of the arguments tuple of every call
+    :return: A list of the results
+    """
+    return [func(*call) for call in calls]
+
+def run_on_pool(func, count, *args, num_workers=None, chunk_size=None):
+    """
+    Map a function over the given arguments on a pool of worker processes, like executor.map with chunks.
+    The results are yielded in the order of the arguments, so the output doesn't depend on which worker finished first.
+    The arguments are read lazily, only a few chunks per worker are in flight at once,
+    so the arguments can be a generator that is never held in memory whole.
+
+    :param func: The function to run, a module level function so it can be sent to the workers
+    :param count: The number of calls, None if it isn't known up front
+    :param args: The iterables of the function's arguments, like in map
+    :param num_workers: The number of worker processes, None for the number of cores
+    :param chunk_size: The number of calls sent to a worker at once, None to pick one from the number of calls
+    :return: A generator of the results
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if count is not None:
+        num_workers = max(1, min(num_workers, count))
+
+    # No need for the overhead of a pool
+    if num_workers == 1:
+        yield from map(func, *args)
+        return
+
+    if chunk_size is None:
+        chunk_size = 64 if count is None else max(1, min(256, count // (num_workers * 4)))
+
+    calls = zip(*args)  # The arguments tuple of every call
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()  # The futures of the submitted chunks, in the order of the arguments
+        for chunk in iter(lambda: list(islice(calls, chunk_size)), []):
+            pending.append(executor.submit(run_chunk, func, chunk))
+            if len(pending) > num_workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def validate_entry(source, entry, images_dir):
+    """
+    Validate a single label of a bulk annotation file (COCO or YOLO) and its image.
+
+    :param source: The file source of the dataset
+    :param entry: The annotation_importers.LabelEntry of the image
+    :param images_dir: The member name of the directory of the images
+    :return: The ValidationResult of the label
+    """
+    errors = list(entry.errors)  # The errors the importer found while parsing the label
+    if errors:
+        errors.append(f'Error(s) in file {entry.name}')
+        return ValidationResult(entry.name, False, errors, None, False, None)
+    valid, errors, record = check_label(source, entry.name, entry.image_name, entry.width, entry.height,
+                                        entry.objects, images_dir, errors, normalized=entry.normalized)
+    return ValidationResult(entry.name, valid, errors, record, False, None)
+
+def validate_entries(source, entries, images_dir='images', num_workers=None, chunk_size=None):
+    """
+    Validate the labels of a bulk annotation file on a pool of worker processes.
+    The labels were already parsed by the importer, so the workers only read the image headers.
+    The results are yielded in the order of entries.
+
+    :param source: The file source of the dataset, every worker reads it with its own handles
+    :param entries: An iterable of annotation_importers.LabelEntry, e.g. the generator of an importer, read lazily
+    :param images_dir: The member name of the directory of the images
+    :param num_workers: The number of worker processes, None for the number of cores
+    :param chunk_size: The number of labels sent to a worker at once, None to pick one from the number of labels
+    :return: A generator of ValidationResult, one for each entry
+    """
+    yield from run_on_pool(validate_entry, None, repeat(source), entries, repeat(images_dir),
+                           num_workers=num_workers, chunk_size=chunk_size)
+
+def validate_yolo_label(source, txt_file, class_names, images_dir, image_ext):
+    """
+    Read, parse and validate a single YOLO label file and its image.
+
+    :param source: The file source of the dataset
+    :param txt_file: The member name of the txt label file
+    :param class_names: The class names of the dataset
+    :param images_dir: The member name of the directory of the images
+    :param image_ext: The extension of the images
+    :return: The ValidationResult of the label
+    """
+    return validate_entry(source, read_yolo_entry(source, txt_file, class_names, image_ext), images_dir)._replace(
+        xml_file=txt_file)
+
+def validate_yolo_labels(source, txt_files, class_names, images_dir='images', image_ext='jpg', num_workers=None,
+                         chunk_size=None):
+    """
+    Validate YOLO label files on a pool of worker processes, the files are parsed inside the workers.
+    The results are yielded in the order of txt_files.
+
+    :param source: The file source of the dataset, every worker reads it with its own handles
+    :param txt_files: A list of member names of the txt label files
+    :param class_names: The class names of the dataset
+    :param images_dir: The member name of the directory of the images
+    :param image_ext: The extension of the images
+    :param num_workers: The number of worker processes, None for the number of cores
+    :param chunk_size: The number of files sent to a worker at once, None to pick one from the number of files
+    :return: A generator of ValidationResult, one for each file in txt_files
+    """
+    yield from run_on_pool(validate_yolo_label, len(txt_files), repeat(source), txt_files, repeat(class_names),
+                           repeat(images_dir), repeat(image_ext), num_workers=num_workers, chunk_size=chunk_size)